@@ -43,9 +43,10 @@ from common import (
 )
 
 from compression import (
- COMPRESS_NONE, COMPRESS_BZ2, COMPRESS_GZ, COMPRESS_LZMA,
+ COMPRESS_NONE, COMPRESS_BZ2, COMPRESS_GZ, COMPRESS_LZMA, COMPRESS_ZSTD, COMPRESS_LZ4,
+ COMPRESS_GZ_INDEXED,
 )
-COMPRESSION_FORMATS = (COMPRESS_NONE, COMPRESS_BZ2, COMPRESS_GZ, COMPRESS_LZMA,)
+COMPRESSION_FORMATS = (COMPRESS_NONE, COMPRESS_BZ2, COMPRESS_GZ, COMPRESS_LZMA, COMPRESS_ZSTD, COMPRESS_LZ4, COMPRESS_GZ_INDEXED,)
 
 from client import Client
 from storage_proxy import StorageProxyClient
@@ -68,6 +68,12 @@ class Client(interfaces.ControlConstruct):
              'memory': {'percent': 1.2, 'rss': 8220392,},
              'threads': 4,
             },
+            'workers': {
+             'workers': 2, 'pending': 3, 'queued': 1, 'capacity': 16, 'completed': 812,
+            },
+            'load': {
+             'latency': 0.012, 'lag': 0.001, 'pressure': 1.0,
+            },
             'system': {
              'load': {'t1': 0.2, 't5': 0.5, 't15': 0.1,},
             }
@@ -78,6 +84,29 @@ class Client(interfaces.ControlConstruct):
         (properties, response) = common.send_request(request, timeout=timeout)
         return json.loads(response)
         
+    def maintainers(self, name=None, action=None, timeout=2.5):
+        """
+        Yields a dictionary describing every maintainer running on the server, keyed by name, after
+        applying `action`, one of 'trigger', 'pause', or 'resume', to the one called `name`, if
+        given::
+        
+            'deletion-maintainer': {
+             'status': 'waiting', 'paused': False, 'triggered': False,
+             'resumeTime': 1350594000.0, 'nextWindow': 1350594000.0,
+             'processed': 1822, 'failed': 3, 'backlog': 0, 'rate': 0.8, 'throttled': 12.5,
+            },
+            
+        Only trusted hosts may make this request.
+        
+        `timeout` is the number of seconds to allow for the request to complete, defaulting to 2.5s.
+        """
+        request = common.assemble_request(self._server.get_host() + common.SERVER_MAINTAINERS, {
+         'name': name,
+         'action': action,
+        })
+        (properties, response) = common.send_request(request, timeout=timeout)
+        return json.loads(response)['maintainers']
+        
     def ping(self, timeout=1.0):
         """
         Indicates whether the server is online or not, raising an exception in case of failure.
@@ -140,6 +169,8 @@ class Client(interfaces.ControlConstruct):
                 try:
                     if type(data) in types.StringTypes: #The compressors expect file-like objects
                         data = StringIO.StringIO(data)
+                    #The compressed content is spooled once, since its length must be sent before
+                    #it; the request then streams it from there
                     data = compression.get_compressor(comp)(data)
                 except ValueError:
                     headers[common.HEADER_COMPRESS_ON_SERVER] = common.HEADER_COMPRESS_ON_SERVER_TRUE
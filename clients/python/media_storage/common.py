@@ -32,8 +32,8 @@ GNU Lesser General Public License along with this program. If not, see
 (C) Neil Tallim, 2011
 """
 import json
-import mmap
 import random
+import StringIO
 import sys
 import tempfile
 import types
@@ -48,6 +48,7 @@ except ImportError: #DNS is not available
 SERVER_PING = 'ping'
 SERVER_LIST_FAMILIES = 'list/families'
 SERVER_STATUS = 'status'
+SERVER_MAINTAINERS = 'maintainers'
 SERVER_PUT = 'put'
 SERVER_GET = 'get'
 SERVER_DESCRIBE = 'describe'
@@ -71,6 +72,7 @@ PROPERTY_APPLIED_COMPRESSION = 'applied-compression'
 PROPERTY_FILE_ATTRIBUTES = 'file-attributes'
 
 _CHUNK_SIZE = 32 * 1024 #Transfer data in 32k chunks
+_SPOOLED_FILESIZE = 10 * 1024 * 1024 #Buffer up to 10M of unmeasurable content in memory
 
 #Constants to expedite construction of multipart/formdata packets
 _FORM_SEP = '--'
@@ -85,22 +87,64 @@ _FORM_PRE_CONTENT = (_FORM_CRLF + _FORM_SEP + _FORM_BOUNDARY + _FORM_CRLF +
  'Content-Transfer-Encoding: binary' + _FORM_CRLF * 2)
 _FORM_FOOTER = _FORM_CRLF + _FORM_SEP + _FORM_BOUNDARY + _FORM_SEP + _FORM_CRLF
 
-def _encode_multipart_formdata(header, content):
+class _MultipartBody(object):
     """
-    Assembles a multipart/formdata request, needed for some transfer methods.
+    A read-only file-like object that presents a multipart/formdata packet, reading `content`
+    in place between the envelope's parts, so that it can be sent without being copied.
+    
+    HTTP requires the length of the packet up-front, which ``len()`` provides; if `content` cannot
+    be measured, it is spooled to a tempfile first.
     """
-    temp = tempfile.SpooledTemporaryFile(10 * 1024 * 1024)
-    temp.write(_FORM_HEADER)
-    temp.write(header)
-    temp.write(_FORM_PRE_CONTENT)
-    if type(content) in types.StringTypes:
-        temp.write(content)
-    else:
-        transfer_data(content, temp)
-    temp.write(_FORM_FOOTER)
-    temp.seek(0)
-    return mmap.mmap(temp.fileno(), 0, access=mmap.ACCESS_READ)
+    _parts = None #The file-like objects that make up the packet, in order
+    _length = None #The number of bytes in the packet
     
+    def __init__(self, header, content):
+        """
+        `header` is the JSON-encoded request-descriptor and `content` is a string or file-like
+        object, which is read from its current position.
+        """
+        if type(content) in types.StringTypes:
+            content = StringIO.StringIO(content)
+        size = measure(content)
+        if size is None: #A stream of unknown length
+            temp = tempfile.SpooledTemporaryFile(_SPOOLED_FILESIZE)
+            size = transfer_data(content, temp)
+            temp.seek(0)
+            content = temp
+            
+        prefix = _FORM_HEADER + header + _FORM_PRE_CONTENT
+        self._parts = [StringIO.StringIO(prefix), content, StringIO.StringIO(_FORM_FOOTER)]
+        self._length = len(prefix) + size + len(_FORM_FOOTER)
+        
+    def __len__(self):
+        return self._length
+        
+    def read(self, size=-1):
+        chunks = []
+        while self._parts and (size < 0 or size > 0):
+            chunk = self._parts[0].read(size)
+            if chunk:
+                chunks.append(chunk)
+                if size > 0:
+                    size -= len(chunk)
+            else:
+                self._parts.pop(0)
+        return ''.join(chunks)
+        
+def measure(data):
+    """
+    Provides the number of bytes remaining in the file-like object `data`, without moving it, or
+    ``None`` if it isn't seekable.
+    """
+    try:
+        position = data.tell()
+        data.seek(0, 2)
+        size = data.tell() - position
+        data.seek(position)
+        return size
+    except (AttributeError, IOError):
+        return None
+        
 def transfer_data(source, destination):
     """
     Reads every byte, in reasonable-sized chunks, from the file-like object `source` into the
@@ -128,7 +172,8 @@ def assemble_request(destination, header, headers={}, data=None):
     to any required by the protocol (new headers will overwrite base ones).
     
     `data` is an optional file-like object containing additional binary content to be delivered with
-    the request. It can also be a string, theoretically. Just sayin'.
+    the request. It can also be a string, theoretically. Just sayin'. It is streamed from its
+    current position when the request is sent, rather than being copied.
     """
     base_headers = {
      'Content-Type': 'application/json',
@@ -137,13 +182,7 @@ def assemble_request(destination, header, headers={}, data=None):
     
     body = json.dumps(header)
     if data:
-        try:
-            body = _encode_multipart_formdata(body, (
-             (type(data) in types.StringTypes or type(data) is mmap.mmap) and data or
-             mmap.mmap(data.fileno(), 0, access=mmap.ACCESS_READ)
-            ))
-        except MemoryError:
-            raise MemoryError("Insufficient memory to buffer data for storage")
+        body = _MultipartBody(body, data)
         base_headers['Content-Type'] = _FORM_CONTENT_TYPE
         
     return urllib2.Request(
@@ -222,6 +261,10 @@ class QueryStruct(object):
      - `atime_min`/`atime_max` : if either is set, it serves as an <=/>= check against atime
      - `accesses_min`/`accesses_max` : if either is set, it serves as an <=/>= check against
        accesses
+     - `size_min`/`size_max` : if either is set, it serves as an <=/>= check against the
+       uncompressed size, in bytes
+     - `stored_size_min`/`stored_size_max` : if either is set, it serves as an <=/>= check against
+       the size on disk, in bytes
      - `family` : if set, performs an explicit match against family
      - `mime` : if set, if a '/' is present, performs an explicit match against MIME; otherwise,
        performs a match against the super-type of MIME
@@ -232,6 +275,10 @@ class QueryStruct(object):
     atime_max = None #The maximum atime (int) of records to enumerate
     accesses_min = None #The minimum access-count (int) of records to enumerate
     accesses_max = None #The maximum access-count (int) of records to enumerate
+    size_min = None #The minimum uncompressed size (int) of records to enumerate
+    size_max = None #The maximum uncompressed size (int) of records to enumerate
+    stored_size_min = None #The minimum on-disk size (int) of records to enumerate
+    stored_size_max = None #The maximum on-disk size (int) of records to enumerate
     family = None #The family (string) of records to enumerate
     mime = None #The MIME-type (string; omitting '/' selects supertype) of records to enumerate
     meta = None #A dictionary of metadata to match, either literally or using provided filters, encoded as strings
@@ -259,6 +306,14 @@ class QueryStruct(object):
           'min': self.accesses_min,
           'max': self.accesses_max,
          },
+         'size': {
+          'min': self.size_min,
+          'max': self.size_max,
+         },
+         'storedSize': {
+          'min': self.stored_size_min,
+          'max': self.stored_size_max,
+         },
          'family': self.family,
          'mime': self.mime,
          'meta': self.meta,
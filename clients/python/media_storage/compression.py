@@ -5,15 +5,36 @@ media-storage : compression
 Offers efficient handlers for compressing and decompressing data, using
 file-like objects (often tempfiles).
 
-This module is shared by every Python facet of the media-storage project and
-changes to one instance should be reflected in all.
+This module is shared by every Python facet of the media-storage project; the
+server's copy is canonical, and the others are regenerated from it with
+tools/sync_shared.py.
 
 Usage
 -----
 
 (De)compressors may be called explicitly or retrieved with one of the getter
 functions.
- 
+
+The gz-indexed format stores independently compressed frames and an index of
+their offsets; `IndexedReader` uses it to seek within the decompressed content
+while decompressing only the frames that are actually read.
+
+Streaming (de)compressors, retrieved with `get_stream_compressor()` and
+`get_stream_decompressor()`, wrap a file-like object without reading it
+up-front, processing only as much as each `read()` requires, so they may be
+chained without intermediate tempfiles.
+
+Compressors accept an optional dictionary of tuning `options`, like 'level',
+and an optional `workers` count; if greater than one, formats that can still
+produce a single stream work in parallel: gz splits the input into independent
+blocks, joined into one zlib stream, and zstd uses the library's own threads.
+Other formats ignore `workers`, since their blocks could only be joined as
+concatenated streams, which many single-stream decoders reject; the
+decompressors here still read such streams, as earlier versions wrote them.
+
+The lzma, zstd, and lz4 formats are optional, depending on the availability of
+their modules (python-lzma, zstandard, and lz4).
+
 Legal
 -----
 
@@ -31,11 +52,15 @@ GNU Lesser General Public License for more details.
 You should have received a copy of the GNU General Public License and
 GNU Lesser General Public License along with this program. If not, see
 <http://www.gnu.org/licenses/>.
- 
+
 (C) Neil Tallim, 2011
 """
 import bz2
+import functools
 import logging
+import multiprocessing.pool
+import StringIO
+import struct
 import tempfile
 import zlib
 
@@ -44,38 +69,118 @@ try:
 except ImportError:
     lzma = None
     
+try:
+    import zstandard as zstd
+except ImportError:
+    zstd = None
+    
+try:
+    import lz4.frame as lz4
+except ImportError:
+    lz4 = None
+    
 #Compression type constants
 COMPRESS_NONE = None
 COMPRESS_BZ2 = 'bz2'
 COMPRESS_GZ = 'gz'
 COMPRESS_LZMA = 'lzma'
+COMPRESS_ZSTD = 'zstd'
+COMPRESS_LZ4 = 'lz4'
+COMPRESS_GZ_INDEXED = 'gz-indexed'
 
-SUPPORTED_FORMATS = [COMPRESS_GZ, COMPRESS_BZ2]
+SUPPORTED_FORMATS = [COMPRESS_GZ, COMPRESS_BZ2, COMPRESS_GZ_INDEXED]
 if lzma:
     SUPPORTED_FORMATS.append(COMPRESS_LZMA)
+if zstd:
+    SUPPORTED_FORMATS.append(COMPRESS_ZSTD)
+if lz4:
+    SUPPORTED_FORMATS.append(COMPRESS_LZ4)
 SUPPORTED_FORMATS = tuple(SUPPORTED_FORMATS)
+_AVAILABLE_FORMATS = SUPPORTED_FORMATS #Unaffected by consumers narrowing SUPPORTED_FORMATS
+
+_MAX_FRAME_SIZE = 1024 * 1024 * 64 #gz-indexed frames are held in memory while (de)compressed
+
+#The tuning options each format accepts, all integers, with the (minimum, maximum) of each
+COMPRESSION_OPTIONS = {
+ COMPRESS_GZ: {'level': (0, 9),},
+ COMPRESS_BZ2: {'level': (1, 9),},
+ COMPRESS_LZMA: {'preset': (0, 9), 'dict_size': (4096, 1536 * 1024 * 1024),},
+ COMPRESS_ZSTD: {'level': (1, 22),},
+ COMPRESS_LZ4: {'level': (0, 16),},
+ COMPRESS_GZ_INDEXED: {'level': (0, 9), 'frame_size': (1, _MAX_FRAME_SIZE),},
+}
 
 _MAX_SPOOLED_FILESIZE = 1024 * 256 #Allow up to 256k in memory
 _BUFFER_SIZE = 1024 * 32 #Work with 32k chunks
+_PARALLEL_BLOCK_SIZE = 1024 * 1024 #Compress independent 1M blocks when working in parallel
+_GZ_HEADER = '\x78\x9c' #A zlib header declaring a 32k window and the default compression level
+_SAMPLE_SIZE = 1024 * 64 #Examine 64k windows when estimating compressibility
+
+#The gz-indexed container is a series of independent zlib frames, each preceded by its length, with
+#a zero length marking the end of the series; after that comes the length of every frame, then a
+#footer describing the content, so that any offset can be reached by decompressing a single frame
+_INDEX_LENGTH = struct.Struct('>I')
+_INDEX_FOOTER = struct.Struct('>IIQ4s') #frame-size, frame-count, uncompressed size, magic
+_INDEX_MAGIC = 'MSGI'
 
 _logger = logging.getLogger('media_storage-compression')
 
-def get_compressor(format):
+def filter_options(format, options):
+    """
+    Returns a copy of `options`, a dictionary of tuning values, limited to those understood by
+    `format`, as listed in `COMPRESSION_OPTIONS`.
+    
+    Raises ``ValueError`` if any retained value is not an integer or is out of range.
+    """
+    ranges = COMPRESSION_OPTIONS.get(format, {})
+    filtered = {}
+    for (name, value) in (options or {}).items():
+        if name in ranges:
+            value = int(value)
+            (minimum, maximum) = ranges[name]
+            if not minimum <= value <= maximum:
+                raise ValueError("%(format)s option '%(name)s' must be between %(minimum)i and %(maximum)i, not %(value)i" % {
+                 'format': format,
+                 'name': name,
+                 'minimum': minimum,
+                 'maximum': maximum,
+                 'value': value,
+                })
+            filtered[name] = value
+    return filtered
+    
+def get_compressor(format, workers=1, options=None):
     """
     Returns a callable that accepts a file-like object and returns a compressed version of the
     file's contents as a file-like object.
     
     `format` is the format to which conversion should occur, one of the compression type constants.
+    
+    `workers`, if greater than 1, is the number of blocks that may be compressed concurrently, in
+    formats that support it.
+    
+    `options` is an optional dictionary of tuning values, like 'level'; see `COMPRESSION_OPTIONS`.
     """
     if format is COMPRESS_NONE:
         return (lambda x:x)
     elif format == COMPRESS_GZ:
-        return compress_gz
+        compressor = compress_gz
     elif format == COMPRESS_BZ2:
-        return compress_bz2
+        compressor = compress_bz2
     elif format == COMPRESS_LZMA and lzma:
-        return compress_lzma
-    raise ValueError(format + " is unsupported")
+        compressor = compress_lzma
+    elif format == COMPRESS_ZSTD and zstd:
+        compressor = compress_zstd
+    elif format == COMPRESS_LZ4 and lz4:
+        compressor = compress_lz4
+    elif format == COMPRESS_GZ_INDEXED:
+        compressor = compress_gz_indexed
+    else:
+        raise ValueError(format + " is unsupported")
+        
+    if workers > 1 or options:
+        return functools.partial(compressor, workers=workers, options=options)
+    return compressor
     
 def get_decompressor(format):
     """
@@ -92,18 +197,106 @@ def get_decompressor(format):
         return decompress_bz2
     elif format == COMPRESS_LZMA and lzma:
         return decompress_lzma
+    elif format == COMPRESS_ZSTD and zstd:
+        return decompress_zstd
+    elif format == COMPRESS_LZ4 and lz4:
+        return decompress_lz4
+    elif format == COMPRESS_GZ_INDEXED:
+        return decompress_gz_indexed
     raise ValueError(format + " is unsupported")
     
-def _process(data, handler, flush_handler):
+def get_stream_compressor(format, workers=1, options=None):
+    """
+    Returns a callable that accepts a file-like object and returns a read-only file-like object
+    that compresses the original's contents incrementally, as they're read.
+    
+    `format` is the format to which conversion should occur, one of the compression type constants.
+    
+    `workers`, if greater than 1, is the number of blocks that may be compressed concurrently, in
+    formats that support it.
+    
+    `options` is an optional dictionary of tuning values, like 'level'; see `COMPRESSION_OPTIONS`.
+    """
+    if format is COMPRESS_NONE:
+        return (lambda x:x)
+    elif not format in _AVAILABLE_FORMATS:
+        raise ValueError(format + " is unsupported")
+    elif format == COMPRESS_GZ_INDEXED:
+        return (lambda data: IndexedCompressingReader(data, workers, options))
+    elif workers > 1 and format == COMPRESS_GZ: #zstd parallelises internally; the rest can't
+        block_handler = functools.partial(_compress_block, format, options)
+        return (lambda data: ParallelCompressingReader(data, block_handler, workers, header=_GZ_HEADER, trailer_handler=_GzTrailer()))
+        
+    def _build(data):
+        (compressor, header) = _new_compressor(format, options, workers)
+        return CompressingReader(data, compressor, header)
+    return _build
+    
+def get_stream_decompressor(format):
+    """
+    Returns a callable that accepts a file-like object and returns a read-only file-like object
+    that decompresses the original's contents incrementally, as they're read.
+    
+    `format` is the format from which conversion should occur, one of the compression type constants.
+    """
+    if format is COMPRESS_NONE:
+        return (lambda x:x)
+    elif format == COMPRESS_GZ:
+        factory = zlib.decompressobj
+    elif format == COMPRESS_BZ2:
+        factory = lambda: _MultiStreamDecompressor(bz2.BZ2Decompressor)
+    elif format == COMPRESS_LZMA and lzma:
+        factory = lambda: _MultiStreamDecompressor(lzma.LZMADecompressor)
+    elif format == COMPRESS_ZSTD and zstd:
+        factory = lambda: _MultiStreamDecompressor(lambda: zstd.ZstdDecompressor().decompressobj())
+    elif format == COMPRESS_LZ4 and lz4:
+        factory = lambda: _MultiStreamDecompressor(lz4.LZ4FrameDecompressor)
+    elif format == COMPRESS_GZ_INDEXED:
+        factory = _IndexedDecompressor
+    else:
+        raise ValueError(format + " is unsupported")
+    return (lambda data: DecompressingReader(data, factory()))
+    
+def estimate_saving(data, format, samples=4, options=None):
+    """
+    Estimates the fraction of space that would be saved by compressing the file-like object `data`
+    in `format`, tuned by `options`, by compressing up to `samples` evenly spaced windows from it.
+    The result may be negative if compression would make the data larger.
+    
+    `data` must be seekable; it is seeked back to 0 when the estimate is complete.
+    """
+    data.seek(0, 2)
+    size = data.tell()
+    if not size:
+        data.seek(0)
+        return 0.0
+        
+    compressor = get_compressor(format, options=options)
+    stride = max(_SAMPLE_SIZE, size // samples)
+    (original, compressed) = (0, 0)
+    try:
+        for offset in range(0, size, stride)[:samples]:
+            data.seek(offset)
+            sample = data.read(_SAMPLE_SIZE)
+            original += len(sample)
+            compressed += len(compressor(StringIO.StringIO(sample)).read())
+    finally:
+        data.seek(0)
+    return 1.0 - float(compressed) / original
+    
+def _process(data, handler, flush_handler, header=''):
     """
     Iterates over the given `data`, reading a reasonable number of bytes, passing them through the
     given (de)compression `handler`, and writing the output to a temporary file, which is ultimately
     returned (seeked to 0).
     
+    `header` is written before any processed data.
+    
     If an exception occurs, it is raised directly.
     """
     try:
         temp = tempfile.SpooledTemporaryFile(_MAX_SPOOLED_FILESIZE)
+        temp.write(header)
         while True:
             chunk = data.read(_BUFFER_SIZE)
             if chunk:
@@ -125,17 +318,484 @@ def _process(data, handler, flush_handler):
         })
         raise
         
-def compress_bz2(data):
+def _spool(reader):
+    """
+    Drains `reader`, one of the streaming readers defined here, into a temporary file, which is
+    ultimately returned (seeked to 0). The reader's resources are released, but its source is left
+    open.
+    
+    If an exception occurs, it is raised directly.
+    """
+    try:
+        temp = tempfile.SpooledTemporaryFile(_MAX_SPOOLED_FILESIZE)
+        while True:
+            chunk = reader.read(_BUFFER_SIZE)
+            if not chunk:
+                break
+            temp.write(chunk)
+        temp.flush()
+        temp.seek(0)
+        return temp
+    except Exception as e:
+        _logger.error("A problem occurred during streamed compression: %(error)s" % {
+         'error': str(e),
+        })
+        raise
+    finally:
+        reader.release()
+        
+class _MultiStreamDecompressor(object):
+    """
+    Wraps a decompressor that handles only a single stream, transparently starting a new one
+    whenever the current stream ends, so that concatenated streams are read in full.
+    """
+    _factory = None #A callable that produces a fresh single-stream decompressor
+    _decompressor = None #The decompressor handling the current stream
+    _finished = False #True if the current stream has ended
+    
+    def __init__(self, factory):
+        self._factory = factory
+        self._decompressor = factory()
+        
+    def decompress(self, chunk):
+        output = []
+        while chunk:
+            if self._finished:
+                self._decompressor = self._factory()
+                self._finished = False
+            try:
+                output.append(self._decompressor.decompress(chunk))
+            except EOFError: #The previous stream ended exactly at a chunk boundary
+                self._finished = True
+                continue
+            chunk = getattr(self._decompressor, 'unused_data', '')
+            if chunk or getattr(self._decompressor, 'eof', False):
+                self._finished = True
+        return ''.join(output)
+        
+    def flush(self):
+        flush = getattr(self._decompressor, 'flush', None)
+        if flush and not self._finished:
+            return flush() or ''
+        return ''
+        
+class _StreamReader(object):
+    """
+    The foundation of read-only file-like objects that transform the content of another as it is
+    read, buffering only what's needed to satisfy each request.
+    """
+    _data = None #The source file-like object
+    _buffer = '' #Transformed bytes not yet returned
+    _eof = False #True once the source has been exhausted and every transformed byte buffered
+    
+    def __init__(self, data, header=''):
+        """
+        `data` is the source file-like object and `header` is returned ahead of everything else.
+        """
+        self._data = data
+        self._buffer = header
+        
+    def _next(self):
+        """
+        Returns the next run of transformed bytes, which may be empty, or ``None`` once nothing
+        remains.
+        """
+        raise NotImplementedError("_next() must be overridden in a subclass")
+        
+    def read(self, size=-1):
+        """
+        Returns up to `size` transformed bytes, or everything that remains if `size` is negative;
+        an empty string indicates that the end of the content has been reached.
+        """
+        while not self._eof and (size < 0 or len(self._buffer) < size):
+            chunk = self._next()
+            if chunk is None:
+                self._eof = True
+            else:
+                self._buffer += chunk
+                
+        if size < 0:
+            (chunk, self._buffer) = (self._buffer, '')
+        else:
+            (chunk, self._buffer) = (self._buffer[:size], self._buffer[size:])
+        return chunk
+        
+    def release(self):
+        """
+        Frees any resources held by the transformation, without closing the source.
+        """
+        self._buffer = ''
+        
+    def close(self):
+        """
+        Frees any resources held by the transformation and closes the source.
+        """
+        self.release()
+        self._data.close()
+        
+class _TransformingReader(_StreamReader):
+    """
+    Passes each chunk read from the source through a streaming (de)compressor.
+    """
+    _handler = None #Transforms each chunk
+    _flush_handler = None #Returns any bytes still held by the (de)compressor, or None if not needed
+    _flushed = False #True once the (de)compressor has been flushed
+    
+    def __init__(self, data, handler, flush_handler, header=''):
+        _StreamReader.__init__(self, data, header)
+        self._handler = handler
+        self._flush_handler = flush_handler
+        
+    def _next(self):
+        if self._flushed:
+            return None
+        chunk = self._data.read(_BUFFER_SIZE)
+        if chunk:
+            return self._handler(chunk)
+        self._flushed = True
+        return self._flush_handler and self._flush_handler() or ''
+        
+class CompressingReader(_TransformingReader):
+    """
+    A read-only file-like object that yields the compressed content of another, reading and
+    compressing only as much of it as is needed to satisfy each request.
+    """
+    def __init__(self, data, compressor, header=''):
+        """
+        `data` is the uncompressed file-like object and `compressor` is an object exposing
+        ``compress()`` and ``flush()``; `header` is any output the compressor emitted on setup.
+        """
+        _TransformingReader.__init__(self, data, compressor.compress, compressor.flush, header)
+        
+class DecompressingReader(_TransformingReader):
+    """
+    A read-only file-like object that yields the decompressed content of another, reading and
+    decompressing only as much of it as is needed to satisfy each request.
+    """
+    def __init__(self, data, decompressor):
+        """
+        `data` is the compressed file-like object and `decompressor` is an object exposing
+        ``decompress()`` and, optionally, ``flush()``.
+        """
+        _TransformingReader.__init__(self, data, decompressor.decompress, getattr(decompressor, 'flush', None))
+        
+class ParallelCompressingReader(_StreamReader):
+    """
+    A read-only file-like object that yields the compressed content of another, compressing
+    independent blocks on a pool of threads, ahead of what has been requested.
+    
+    At most twice as many blocks as there are workers are held in memory at once.
+    """
+    _block_handler = None #Compresses a single block
+    _trailer_handler = None #Called with every block read, then with None to get the trailing bytes
+    _workers = None #The number of threads in the pool
+    _block_size = None #The number of bytes of input in each block
+    _pool = None #The pool of threads on which blocks are compressed
+    _pending = None #Results for blocks submitted to the pool, in order
+    _exhausted = False #True once the source has been fully read
+    
+    def __init__(self, data, block_handler, workers, header='', trailer_handler=None, block_size=_PARALLEL_BLOCK_SIZE):
+        """
+        `block_handler` compresses a single block of `data`, `block_size` bytes long (except for
+        the last), independently of all others.
+        
+        `header` is returned before the first block; `trailer_handler`, if given, is called with
+        every block of input as it's read, and once more with ``None`` at the end, when its return
+        value is returned after the last block.
+        """
+        _StreamReader.__init__(self, data, header)
+        self._block_handler = block_handler
+        self._block_size = block_size
+        self._trailer_handler = trailer_handler
+        self._workers = workers
+        self._pool = multiprocessing.pool.ThreadPool(workers)
+        self._pending = []
+        
+    def _next(self):
+        while not self._exhausted and len(self._pending) < self._workers * 2:
+            block = self._data.read(self._block_size)
+            if not block:
+                self._exhausted = True
+                break
+            if self._trailer_handler:
+                self._trailer_handler(block)
+            self._pending.append(self._pool.apply_async(self._block_handler, (block,)))
+            
+        if self._pending:
+            return self._pending.pop(0).get()
+        self._stop_pool()
+        if self._trailer_handler:
+            (trailer_handler, self._trailer_handler) = (self._trailer_handler, None)
+            return trailer_handler(None)
+        return None
+        
+    def _stop_pool(self):
+        """
+        Terminates the thread pool, discarding any outstanding work.
+        """
+        self._pending = []
+        if self._pool:
+            self._pool.terminate()
+            self._pool = None
+            
+    def release(self):
+        _StreamReader.release(self)
+        self._stop_pool()
+        
+def _new_compressor(format, options=None, workers=1):
+    """
+    Builds a streaming compressor for `format`, tuned by `options`, returning it and any bytes it
+    emits before compression begins in a tuple.
+    
+    `workers` is honoured only by formats whose libraries parallelise internally (zstd); the others
+    always produce a single stream, which every decoder can read.
+    """
+    options = options or {}
+    if format == COMPRESS_GZ:
+        return (zlib.compressobj(options.get('level', zlib.Z_DEFAULT_COMPRESSION)), '')
+    elif format == COMPRESS_BZ2:
+        return (bz2.BZ2Compressor(options.get('level', 9)), '')
+    elif format == COMPRESS_LZMA and lzma:
+        return (_new_lzma_compressor(options), '')
+    elif format == COMPRESS_ZSTD and zstd:
+        return (zstd.ZstdCompressor(level=options.get('level', 3), threads=(workers > 1 and workers or 0)).compressobj(), '')
+    elif format == COMPRESS_LZ4 and lz4:
+        compressor = lz4.LZ4FrameCompressor(compression_level=options.get('level', 0))
+        return (compressor, compressor.begin())
+    raise ValueError(format + " is unsupported")
+    
+def _new_lzma_compressor(options):
+    """
+    Builds an lzma compressor from `options`, using whichever interface the available library
+    provides.
+    """
+    preset = options.get('preset')
+    dict_size = options.get('dict_size')
+    if hasattr(lzma, 'FILTER_LZMA2'): #The standard library's interface
+        if dict_size is None:
+            return lzma.LZMACompressor(preset=preset)
+        return lzma.LZMACompressor(filters=[{
+         'id': lzma.FILTER_LZMA2,
+         'preset': (preset is None and 6 or preset),
+         'dict_size': dict_size,
+        }])
+        
+    tuning = {} #pyliblzma's interface
+    if not preset is None:
+        tuning['level'] = preset
+    if not dict_size is None:
+        tuning['dict_size'] = dict_size
+    return lzma.LZMACompressor(tuning)
+    
+def _compress_block(format, options, block):
+    """
+    Compresses `block` in `format`, either gz or gz-indexed, independently of all others, such
+    that the results for consecutive blocks may be concatenated.
+    
+    gz blocks are raw deflate sequences that end on a byte boundary without marking the end of the
+    stream, to be wrapped by a zlib header and a `_GzTrailer`; gz-indexed blocks are frames.
+    """
+    if format == COMPRESS_GZ:
+        compressor = zlib.compressobj((options or {}).get('level', zlib.Z_DEFAULT_COMPRESSION), zlib.DEFLATED, -zlib.MAX_WBITS)
+        return compressor.compress(block) + compressor.flush(zlib.Z_SYNC_FLUSH)
+    frame = zlib.compress(block, (options or {}).get('level', zlib.Z_DEFAULT_COMPRESSION))
+    return _INDEX_LENGTH.pack(len(frame)) + frame
+    
+class _GzTrailer(object):
+    """
+    Accumulates the checksum of parallel-compressed input to produce the end of a zlib stream.
+    """
+    _checksum = 1 #The adler32 seed value
+    
+    def __call__(self, block):
+        if block is None: #Close the deflate sequence with an empty final block, then the checksum
+            return zlib.compressobj(zlib.Z_DEFAULT_COMPRESSION, zlib.DEFLATED, -zlib.MAX_WBITS).flush() + struct.pack('>I', self._checksum & 0xffffffff)
+        self._checksum = zlib.adler32(block, self._checksum)
+        
+class IndexedCompressingReader(ParallelCompressingReader):
+    """
+    A read-only file-like object that yields the content of another as a gz-indexed container,
+    compressing frames on a pool of threads.
+    """
+    _frame_size = None #The number of bytes of input in each frame
+    _lengths = None #The compressed length of every frame returned so far
+    _size = 0 #The number of bytes of input read so far
+    _trailing = False #True once the index has been produced
+    
+    def __init__(self, data, workers=1, options=None):
+        """
+        `options` may specify 'level' (0-9) and 'frame_size' (bytes, 1M by default); smaller frames
+        make seeking cheaper at the cost of ratio.
+        
+        Raises ``ValueError`` if 'frame_size' is not positive, since no input could be read.
+        """
+        self._frame_size = (options or {}).get('frame_size', _PARALLEL_BLOCK_SIZE)
+        if self._frame_size <= 0:
+            raise ValueError("gz-indexed frame_size must be positive, not %(frame_size)r" % {
+             'frame_size': self._frame_size,
+            })
+        self._lengths = []
+        ParallelCompressingReader.__init__(self, data,
+         functools.partial(_compress_block, COMPRESS_GZ_INDEXED, options), max(1, workers),
+         trailer_handler=self._build_index, block_size=self._frame_size
+        )
+        
+    def _next(self):
+        chunk = ParallelCompressingReader._next(self)
+        if chunk and not self._trailing:
+            self._lengths.append(len(chunk) - _INDEX_LENGTH.size)
+        return chunk
+        
+    def _build_index(self, block):
+        """
+        Tallies the size of each `block`, producing the terminator, index, and footer once ``None``
+        is received.
+        """
+        if not block is None:
+            self._size += len(block)
+            return
+        self._trailing = True
+        return (
+         _INDEX_LENGTH.pack(0) +
+         struct.pack('>%iI' % len(self._lengths), *self._lengths) +
+         _INDEX_FOOTER.pack(self._frame_size, len(self._lengths), self._size, _INDEX_MAGIC)
+        )
+        
+class _IndexedDecompressor(object):
+    """
+    Decompresses a gz-indexed container sequentially, frame by frame, ignoring the index.
+    """
+    _buffer = '' #Input not yet decompressed
+    _finished = False #True once the end-of-frames marker has been seen
+    
+    def decompress(self, chunk):
+        if self._finished:
+            return ''
+        self._buffer += chunk
+        output = []
+        while len(self._buffer) >= _INDEX_LENGTH.size:
+            (length,) = _INDEX_LENGTH.unpack(self._buffer[:_INDEX_LENGTH.size])
+            if not length:
+                self._finished = True
+                self._buffer = ''
+                break
+            end = _INDEX_LENGTH.size + length
+            if len(self._buffer) < end: #Frame incomplete
+                break
+            output.append(zlib.decompress(self._buffer[_INDEX_LENGTH.size:end]))
+            self._buffer = self._buffer[end:]
+        return ''.join(output)
+        
+    def flush(self):
+        if not self._finished:
+            raise ValueError("gz-indexed content is truncated")
+        return ''
+        
+class IndexedReader(object):
+    """
+    A read-only, seekable file-like object that exposes the decompressed content of a gz-indexed
+    container, decompressing only the frames that are actually read.
+    """
+    size = 0 #The length of the decompressed content
+    _data = None #The seekable container
+    _frame_size = None #The number of decompressed bytes in each frame, except the last
+    _offsets = None #The position of each frame within `_data`
+    _lengths = None #The compressed length of each frame
+    _position = 0 #The current offset within the decompressed content
+    _frame = (None, '') #The most recently decompressed frame, as (index, content)
+    
+    def __init__(self, data):
+        """
+        `data` is the container, a seekable file-like object.
+        
+        Raises ``ValueError`` if `data` is not a gz-indexed container.
+        """
+        self._data = data
+        data.seek(0, 2)
+        if data.tell() < _INDEX_FOOTER.size:
+            raise ValueError("Content is not a gz-indexed container")
+        data.seek(-_INDEX_FOOTER.size, 2)
+        (self._frame_size, count, self.size, magic) = _INDEX_FOOTER.unpack(data.read(_INDEX_FOOTER.size))
+        if not magic == _INDEX_MAGIC or (count and self._frame_size <= 0):
+            raise ValueError("Content is not a gz-indexed container")
+            
+        data.seek(-(_INDEX_FOOTER.size + _INDEX_LENGTH.size * count), 2)
+        self._lengths = struct.unpack('>%iI' % count, data.read(_INDEX_LENGTH.size * count))
+        self._offsets = []
+        offset = 0
+        for length in self._lengths:
+            self._offsets.append(offset + _INDEX_LENGTH.size)
+            offset += _INDEX_LENGTH.size + length
+            
+    def seek(self, offset, whence=0):
+        if whence == 1:
+            offset += self._position
+        elif whence == 2:
+            offset += self.size
+        self._position = max(0, offset)
+        
+    def tell(self):
+        return self._position
+        
+    def read(self, size=-1):
+        """
+        Returns up to `size` decompressed bytes from the current position, or everything that
+        remains if `size` is negative.
+        """
+        if size < 0:
+            size = self.size
+        output = []
+        while size > 0 and self._position < self.size:
+            index = self._position // self._frame_size
+            if not self._frame[0] == index:
+                self._data.seek(self._offsets[index])
+                self._frame = (index, zlib.decompress(self._data.read(self._lengths[index])))
+            start = self._position - index * self._frame_size
+            chunk = self._frame[1][start:start + size]
+            output.append(chunk)
+            self._position += len(chunk)
+            size -= len(chunk)
+        return ''.join(output)
+        
+    def close(self):
+        self._frame = (None, '')
+        self._data.close()
+        
+def _compress(format, data, workers, options):
+    """
+    Compresses the file-like object `data` in `format`, tuned by `options`, returning a file-like
+    object; see `get_compressor()`.
+    """
+    if format == COMPRESS_GZ_INDEXED:
+        _logger.debug("Compressing data with %(format)s..." % {
+         'format': format,
+        })
+        return _spool(IndexedCompressingReader(data, workers, options))
+    elif workers > 1 and format == COMPRESS_GZ: #zstd parallelises internally; the rest can't
+        _logger.debug("Compressing data with %(format)s, using %(workers)i workers..." % {
+         'format': format,
+         'workers': workers,
+        })
+        return _spool(ParallelCompressingReader(data, functools.partial(_compress_block, format, options), workers, header=_GZ_HEADER, trailer_handler=_GzTrailer()))
+        
+    _logger.debug("Compressing data with %(format)s..." % {
+     'format': format,
+    })
+    (compressor, header) = _new_compressor(format, options, workers)
+    return _process(data, compressor.compress, compressor.flush, header)
+    
+def compress_bz2(data, workers=1, options=None):
     """
     Compresses the given file-like object `data` with the bz2 algorithm, returning a file-like
-    object and its size in a tuple.
+    object.
+    
+    `workers` is accepted for uniformity, but bz2 is always compressed serially, as a single stream.
+    `options` may specify 'level' (1-9).
     
     Any exceptions are raised directly.
     """
-    _logger.debug("Compressing data with bz2...")
-    compressor = bz2.BZ2Compressor()
-    return _process(data, compressor.compress, compressor.flush)
-
+    return _compress(COMPRESS_BZ2, data, workers, options)
+    
 def decompress_bz2(data):
     """
     Decompresses the given file-like object `data` with the bz2 algorithm, returning a file-like
@@ -144,19 +804,20 @@ def decompress_bz2(data):
     Any exceptions are raised directly.
     """
     _logger.debug("Decompressing data with bz2...")
-    decompressor = bz2.BZ2Decompressor()
+    decompressor = _MultiStreamDecompressor(bz2.BZ2Decompressor)
     return _process(data, decompressor.decompress, None)
     
-def compress_gz(data):
+def compress_gz(data, workers=1, options=None):
     """
     Compresses the given file-like object `data` with the gz algorithm, returning a file-like
-    object and its size in a tuple.
+    object.
+    
+    If `workers` is greater than 1, blocks are compressed in parallel and joined into a single
+    stream. `options` may specify 'level' (0-9).
     
     Any exceptions are raised directly.
     """
-    _logger.debug("Compressing data with gz...")
-    compressor = zlib.compressobj()
-    return _process(data, compressor.compress, compressor.flush)
+    return _compress(COMPRESS_GZ, data, workers, options)
     
 def decompress_gz(data):
     """
@@ -170,18 +831,19 @@ def decompress_gz(data):
     return _process(data, decompressor.decompress, decompressor.flush)
     
 if lzma: #If the module is unavailable, don't even define the functions
-    def compress_lzma(data):
+    def compress_lzma(data, workers=1, options=None):
         """
         Compresses the given file-like object `data` with the lzma algorithm, returning a file-like
-        object and its size in a tuple.
+        object.
+        
+        `workers` is accepted for uniformity, but lzma is always compressed serially, as a single
+        stream. `options` may specify 'preset' (0-9) and 'dict_size' (bytes).
         
         Any exceptions are raised directly.
         
         This function is not available if no LZMA library is present.
         """
-        _logger.debug("Compressing data with lzma...")
-        compressor = lzma.LZMACompressor()
-        return _process(data, compressor.compress, compressor.flush)
+        return _compress(COMPRESS_LZMA, data, workers, options)
         
     def decompress_lzma(data):
         """
@@ -193,6 +855,85 @@ if lzma: #If the module is unavailable, don't even define the functions
         This function is not available if no LZMA library is present.
         """
         _logger.debug("Decompressing data with lzma...")
-        decompressor = lzma.LZMADecompressor()
+        decompressor = _MultiStreamDecompressor(lzma.LZMADecompressor)
         return _process(data, decompressor.decompress, decompressor.flush)
         
+if zstd: #If the module is unavailable, don't even define the functions
+    def compress_zstd(data, workers=1, options=None):
+        """
+        Compresses the given file-like object `data` with the zstd algorithm, returning a file-like
+        object.
+        
+        If `workers` is greater than 1, the library's own threads compress blocks in parallel,
+        producing a single frame. `options` may specify 'level' (1-22).
+        
+        Any exceptions are raised directly.
+        
+        This function is not available if no zstd library is present.
+        """
+        return _compress(COMPRESS_ZSTD, data, workers, options)
+        
+    def decompress_zstd(data):
+        """
+        Decompresses the given file-like object `data` with the zstd algorithm, returning a
+        file-like object.
+        
+        Any exceptions are raised directly.
+        
+        This function is not available if no zstd library is present.
+        """
+        _logger.debug("Decompressing data with zstd...")
+        decompressor = _MultiStreamDecompressor(lambda: zstd.ZstdDecompressor().decompressobj())
+        return _process(data, decompressor.decompress, decompressor.flush)
+        
+if lz4: #If the module is unavailable, don't even define the functions
+    def compress_lz4(data, workers=1, options=None):
+        """
+        Compresses the given file-like object `data` with the lz4 algorithm, returning a file-like
+        object.
+        
+        `workers` is accepted for uniformity, but lz4 is always compressed serially, as a single
+        frame. `options` may specify 'level' (0-16).
+        
+        Any exceptions are raised directly.
+        
+        This function is not available if no lz4 library is present.
+        """
+        return _compress(COMPRESS_LZ4, data, workers, options)
+        
+    def decompress_lz4(data):
+        """
+        Decompresses the given file-like object `data` with the lz4 algorithm, returning a
+        file-like object.
+        
+        Any exceptions are raised directly.
+        
+        This function is not available if no lz4 library is present.
+        """
+        _logger.debug("Decompressing data with lz4...")
+        decompressor = _MultiStreamDecompressor(lz4.LZ4FrameDecompressor)
+        return _process(data, decompressor.decompress, decompressor.flush)
+        
+def compress_gz_indexed(data, workers=1, options=None):
+    """
+    Compresses the given file-like object `data` as a gz-indexed container, returning a file-like
+    object.
+    
+    If `workers` is greater than 1, frames are compressed in parallel. `options` may specify 'level'
+    (0-9) and 'frame_size' (bytes).
+    
+    Any exceptions are raised directly.
+    """
+    return _compress(COMPRESS_GZ_INDEXED, data, workers, options)
+    
+def decompress_gz_indexed(data):
+    """
+    Decompresses the given gz-indexed file-like object `data`, returning a file-like object.
+    
+    Any exceptions are raised directly.
+    """
+    _logger.debug("Decompressing data with gz-indexed...")
+    decompressor = _IndexedDecompressor()
+    return _process(data, decompressor.decompress, decompressor.flush)
+    
+    
\ No newline at end of file
@@ -83,10 +83,13 @@ class StorageConstruct(BaseConstruct):
          - 'stale': The number of seconds that must elapse after the file was last downloaded to
                     qualify it for deletion
                     
-        `compression_policy` is the same as `deletion_policy`, only with one extra element:
+        `compression_policy` is the same as `deletion_policy`, only with extra elements:
          - 'comp': Any of the compression type constants, except for none, which disables the
                    policy; this will cause the data to be (re)compressed in that format when either
                    condition is met.
+         - 'options': An optional dictionary of integer tuning values for the chosen format, like
+                      'level' (or 'preset' and 'dict_size' for lzma), overriding the server's
+                      settings for the family.
         
         `meta` is a dictionary (or `None`) containing any metadata to be used to identify the
         uploaded content through querying. All scalar value-types are supported.
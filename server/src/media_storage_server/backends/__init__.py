@@ -37,6 +37,7 @@ from common import (
  NoFilehandleError,
 )
 from local import LocalBackend
+from pack import PackBackend
 
 _URI_RE = re.compile(
  r'(?P<schema>[a-z]+)://(?:(?P<username>.+?)(?::(?P<password>.+?))?@)?(?P<host>.*?)(?::(?P<port>\d+))?(?P<path>/.*)'
@@ -74,6 +75,8 @@ def get_backend(uri):
     
     if schema == 'file':
         return LocalBackend(path, options)
+    elif schema == 'pack':
+        return PackBackend(path, options)
         
     _logger.error("Unknown schema")
     raise UnknownSchemaError("'%(schema)s' does not match any recognised type" % {
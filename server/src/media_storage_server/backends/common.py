@@ -26,6 +26,8 @@ Legal
 from abc import ABCMeta, abstractmethod
 import logging
 
+_TEMPFILE_EXTENSION = '.temp' #The marking every backend gives files written with `tempfile` set
+
 _logger = logging.getLogger("media_storage.backends.common")
 
 class BaseBackend(object):
@@ -42,10 +44,16 @@ class BaseBackend(object):
         raise NotImplementedError("'resolve_path()' needs to be overridden in a subclass")
         
     @abstractmethod
-    def get(self, path):
+    def get(self, path, cache=True):
         """
         Retrieves the requested file from the backend as a file-like object, given a
         backend-specific `path`.
+        
+        The file-like object must support ``seek()`` and ``tell()``, so that byte-ranges and
+        gz-indexed frames can be read without consuming everything before them.
+        
+        If `cache` is unset, the backend should avoid keeping what's read in any caches, since it
+        won't be needed again soon, as when scrubbing.
         """
         raise NotImplementedError("'get()' needs to be overridden in a subclass")
         
@@ -67,6 +75,12 @@ class BaseBackend(object):
         """
         raise NotImplementedError("'make_permanent()' needs to be overridden in a subclass")
         
+    def discard(self, path):
+        """
+        Removes a file stored at `path` via `put(tempfile=True)` that won't be made permanent.
+        """
+        self.unlink(path + _TEMPFILE_EXTENSION)
+        
     @abstractmethod
     def unlink(self, path, rmcontainer=False):
         """
@@ -76,6 +90,14 @@ class BaseBackend(object):
         """
         raise NotImplementedError("'_unlink()' needs to be overridden in a subclass")
         
+    @abstractmethod
+    def prune(self, path):
+        """
+        Removes the container-structure of the file at a backend-specific `path`, as much as
+        possible, provided that it is empty; the file itself need not exist.
+        """
+        raise NotImplementedError("'prune()' needs to be overridden in a subclass")
+        
     @abstractmethod
     def file_exists(self, path):
         """
@@ -84,12 +106,41 @@ class BaseBackend(object):
         raise NotImplementedError("'file_exists()' needs to be overridden in a subclass")
         
     @abstractmethod
-    def walk(self):
+    def get_usage(self):
+        """
+        Provides the (used:int, total:int) bytes of the storage on which the backend resides.
+        """
+        raise NotImplementedError("'get_usage()' needs to be overridden in a subclass")
+        
+    def compact(self, threshold, throttle=None):
+        """
+        Reclaims the space held by unlinked files, where the backend doesn't release it at once,
+        from every unit of storage in which at least `threshold` (0.0-1.0) of the space is held that
+        way, returning the number of bytes reclaimed; `throttle`, if given, is called with the size
+        of every file before it is rewritten.
+        
+        Most backends release space as soon as files are unlinked, so nothing happens by default.
+        """
+        return 0
+        
+    @abstractmethod
+    def list_container(self, path):
+        """
+        Enumerates the names of every file that shares the container of the file at a
+        backend-specific `path`, as a set, which is empty if the container does not exist.
+        """
+        raise NotImplementedError("'list_container()' needs to be overridden in a subclass")
+        
+    @abstractmethod
+    def walk(self, after=None):
         """
         Provides a generator that enumerates every file in the filesystem, yielding results as
         (sub-path:str, [filename:str]) tuples, where the sub-path is relative to the end of the
         filesystem's location as specified in the instantiating URI. Concatenating the sub-path and
         filename will allow use by other methods.
+        
+        Sub-paths are yielded in a stable order; if `after` is a sub-path previously yielded, the
+        walk resumes with whatever follows it.
         """
         raise NotImplementedError("'walk()' needs to be overridden in a subclass")
         
@@ -23,7 +23,10 @@ Legal
  (C) Neil Tallim, 2012 <flan@uguu.ca>
 """
 from abc import ABCMeta, abstractmethod
+import collections
+import hashlib
 import logging
+import threading
 import time
 
 import common
@@ -33,40 +36,73 @@ from common import (
  NoFilehandleError,
 )
 
+_HASHED_DEPTH = 2 #The number of hash-prefix directories above each file in the hashed layout
+_HASHED_WIDTH = 2 #The number of hex digits that name each hash-prefix directory
+_CREATED_DIRECTORIES = 16 ** (_HASHED_DEPTH * _HASHED_WIDTH) #The number of created directories remembered, enough to cover every hashed shard
+
 _logger = logging.getLogger("media_storage.backends.directory")
 
+def path_key(path):
+    """
+    Provides a key by which sub-paths are ordered when walking, comparing components numerically
+    where they're numbers, as in the time-bucket layout.
+    """
+    return tuple(int(component) if component.isdigit() else component for component in path.split('/') if component)
+    
+def resolve_path(record):
+    """
+    Provides the path of the file associated with `record`.
+    
+    Records created with the 'hashed' layout resolve to a fixed-depth tree of directories named by
+    prefixes of the SHA-1 digest of their UID, like 'ab/cd/<uid>'; all others, including those that
+    predate layouts, resolve to a directory that covers their creation time.
+    """
+    if record['physical'].get('layout') == 'hashed':
+        digest = hashlib.sha1(record['_id'].encode('utf-8')).hexdigest()
+        return '/'.join(
+         [digest[i * _HASHED_WIDTH:(i + 1) * _HASHED_WIDTH] for i in range(_HASHED_DEPTH)] + [record['_id']]
+        )
+        
+    ts = time.gmtime(record['physical']['ctime'])
+    return '%(year)i/%(month)i/%(day)i/%(hour)i/%(min)i/%(uid)s' % {
+     'year': ts.tm_year,
+     'month': ts.tm_mon,
+     'day': ts.tm_mday,
+     'hour': ts.tm_hour,
+     'min': ts.tm_min - ts.tm_min % record['physical']['minRes'],
+     'uid': record['_id'],
+    }
+    
+
 class DirectoryBackend(common.BaseBackend):
     """
     A backend base-class for directory-based filesystems.
     """
     __metaclass__ = ABCMeta
-    _last_accessed_directory = None #A TLB-like placeholder, preventing unnecessary directory-creation requests
+    _created_directories = None #An LRU-ordered set of directories known to exist, preventing unnecessary directory-creation requests
+    _created_directories_lock = None #Guards the set, since files are written from several threads
     
+    def __init__(self):
+        self._created_directories = collections.OrderedDict()
+        self._created_directories_lock = threading.Lock()
+        
     def resolve_path(self, record):
         """
-        See ``common.BaseBackend.resolve_path()``.
+        See ``common.BaseBackend.resolve_path()`` and ``resolve_path()``.
         """
-        ts = time.gmtime(record['physical']['ctime'])
-        return '%(year)i/%(month)i/%(day)i/%(hour)i/%(min)i/%(uid)s' % {
-         'year': ts.tm_year,
-         'month': ts.tm_mon,
-         'day': ts.tm_mday,
-         'hour': ts.tm_hour,
-         'min': ts.tm_min - ts.tm_min % record['physical']['minRes'],
-         'uid': record['_id'],
-        }
+        return resolve_path(record)
         
-    def get(self, path):
+    def get(self, path, cache=True):
         """
         See ``common.BaseBackend.get()``.
         """
         _logger.debug("Retrieving filesystem entity at %(path)s..." % {
          'path': path,
         })
-        return self._get(path)
+        return self._get(path, cache)
         
     @abstractmethod
-    def _get(self, path):
+    def _get(self, path, cache):
         raise NotImplementedError("'_get()' needs to be overridden in a subclass")
         
     def put(self, path, data, tempfile):
@@ -80,15 +116,36 @@ class DirectoryBackend(common.BaseBackend):
          'path': path,
         })
         directory = path[:path.rfind('/') + 1]
-        if not directory == self._last_accessed_directory:
-            try:
-                self.mkdir(directory)
-            except CollisionError: #Competition for directory ID
-                _logger.warn("Error for creation of " + directory + " is not a problem")
-                pass
-            self._last_accessed_directory = directory
-        self._put(path, data, tempfile)
-        
+        with self._created_directories_lock:
+            created = self._created_directories.pop(directory, False)
+            if created: #Refresh its position
+                self._created_directories[directory] = True
+        if not created:
+            self._create_directory(directory)
+            
+        try:
+            self._put(path, data, tempfile)
+        except FileNotFoundError: #The directory was pruned after it was remembered; nothing has been read from `data` yet
+            _logger.warn("Directory %(directory)s disappeared; recreating it..." % {
+             'directory': directory,
+            })
+            self._create_directory(directory)
+            self._put(path, data, tempfile)
+            
+    def _create_directory(self, directory):
+        """
+        Ensures that `directory` exists, then remembers it, forgetting the least recently used
+        directory if too many are remembered.
+        """
+        try:
+            self.mkdir(directory)
+        except CollisionError: #Competition for directory ID
+            _logger.warn("Error for creation of " + directory + " is not a problem")
+        with self._created_directories_lock:
+            self._created_directories[directory] = True
+            if len(self._created_directories) > _CREATED_DIRECTORIES:
+                self._created_directories.popitem(last=False)
+                
     @abstractmethod
     def _put(self, path, data, tempfile):
         raise NotImplementedError("'_put()' needs to be overridden in a subclass")
@@ -115,27 +172,39 @@ class DirectoryBackend(common.BaseBackend):
         })
         self._unlink(path)
         if rmcontainer:
-            while True:
-                path = path[:path.rfind('/')]
-                if not path: #Arrived at root
-                    break
-                    
-                try:
-                    if not self._lsdir(path): #Directory empty; remove
-                        _logger.info("Unlinking empty directory at %(path)s..." % {
+            self.prune(path)
+            
+    def prune(self, path):
+        """
+        See ``common.BaseBackend.prune()``.
+        
+        Directories are recursively unlinked until the root level is reached, so long as they are
+        empty.
+        """
+        while True:
+            path = path[:path.rfind('/')]
+            if not path: #Arrived at root
+                break
+                
+            try:
+                if not self._lsdir(path): #Directory empty; remove
+                    _logger.info("Unlinking empty directory at %(path)s..." % {
+                     'path': path,
+                    })
+                    with self._created_directories_lock:
+                        self._created_directories.pop(path + '/', None)
+                    try:
+                        self.rmdir(path)
+                    except NotEmptyError as e:
+                        _logger.info("Directory at %(path)s unexpectedly found to be non-empty" % {
                          'path': path,
                         })
-                        try:
-                            self.rmdir(path)
-                        except NotEmptyError as e:
-                            _logger.info("Directory at %(path)s unexpectedly found to be non-empty" % {
-                             'path': path,
-                            })
-                            break
-                    else: #Directory not empty; bail
                         break
-                except FileNotFoundError as e: #Directory does not exist; may have been removed by a co-process
+                else: #Directory not empty; bail
                     break
+            except FileNotFoundError as e: #Directory does not exist; may have been removed by a co-process
+                break
+                
     @abstractmethod
     def _unlink(self, path):
         raise NotImplementedError("'_unlink()' needs to be overridden in a subclass")
@@ -179,14 +248,27 @@ class DirectoryBackend(common.BaseBackend):
     def _file_exists(self, path):
         raise NotImplementedError("'_file_exists()' needs to be overridden in a subclass")
         
-    def walk(self):
+    def list_container(self, path):
+        """
+        See ``common.BaseBackend.list_container()``.
+        """
+        path = path[:path.rfind('/')]
+        _logger.debug("Listing directory at %(path)s..." % {
+         'path': path,
+        })
+        try:
+            return set(self._lsdir(path))
+        except FileNotFoundError:
+            return set()
+            
+    def walk(self, after=None):
         """
         See ``common.BaseBackend.walk()``.
         """
         _logger.debug("Walking filesystem...")
-        return self._walk(path)
+        return self._walk(after)
         
     @abstractmethod
-    def _walk(self):
+    def _walk(self, after):
         raise NotImplementedError("'walk()' needs to be overridden in a subclass")
         
@@ -22,10 +22,21 @@ Legal
  
  (C) Neil Tallim, 2012 <flan@uguu.ca>
 """
+import ctypes
+import ctypes.util
 import logging
+import multiprocessing.pool
 import os
 import subprocess
 
+try: #os.scandir() was introduced in Python 3.5, but is available as a package
+    from os import scandir
+except ImportError:
+    try:
+        from scandir import scandir
+    except ImportError:
+        scandir = None
+
 from common import (
  FileNotFoundError, PermissionsError, CollisionError, NotEmptyError, NoSpaceError,
  NoFilehandleError,
@@ -35,8 +46,20 @@ import directory
 _CHUNK_SIZE = 32 * 1024 #Work with 32K chunks
 _TEMPFILE_EXTENSION = '.temp'
 
+_POSIX_FADV_DONTNEED = 4 #Linux's value
+_WALK_WORKERS = 4 #The number of directories listed concurrently while walking
+
 _logger = logging.getLogger("media_storage.backends.local")
 
+try: #Not exposed by the os module until Python 3.3
+    _libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+    _posix_fadvise = _libc.posix_fadvise
+    _posix_fadvise.argtypes = (ctypes.c_int, ctypes.c_int64, ctypes.c_int64, ctypes.c_int)
+except (OSError, AttributeError):
+    _logger.warn("posix_fadvise() is unavailable; uncached reads will populate the page cache")
+    _posix_fadvise = None
+    
+
 def _handle_error(e):
     """
     A generic error-handling construct that raises the appropriate exception,
@@ -53,6 +76,35 @@ def _handle_error(e):
     elif e.errno == 28:
         raise NoSpaceError(str(e))
         
+class _UncachedFile(object):
+    """
+    A read-only file-like wrapper that tells the kernel to drop everything read through it from the
+    page cache, so that a sweep over many files doesn't displace frequently requested content.
+    """
+    _file = None #The wrapped file
+    _dropped = 0 #The offset up to which the page cache has been told to drop content
+    
+    def __init__(self, file):
+        self._file = file
+        
+    def read(self, size=-1):
+        chunk = self._file.read(size)
+        position = self._file.tell()
+        if _posix_fadvise and position > self._dropped:
+            _posix_fadvise(self._file.fileno(), self._dropped, position - self._dropped, _POSIX_FADV_DONTNEED)
+            self._dropped = position
+        return chunk
+        
+    def seek(self, offset, whence=0):
+        self._file.seek(offset, whence)
+        self._dropped = min(self._dropped, self._file.tell())
+        
+    def tell(self):
+        return self._file.tell()
+        
+    def close(self):
+        self._file.close()
+        
 class LocalBackend(directory.DirectoryBackend):
     """
     Defines a final implementation for local contemporary filesystems.
@@ -64,6 +116,7 @@ class LocalBackend(directory.DirectoryBackend):
         """
         Ensures that `path` ends with a directory delimiter.
         """
+        directory.DirectoryBackend.__init__(self)
         if not path.endswith(('/', '\\')):
             self._path = path + os.path.sep
         else:
@@ -71,12 +124,14 @@ class LocalBackend(directory.DirectoryBackend):
             
         self._zerodel = 'zerodel' in options
         
-    def _get(self, path):
+    def _get(self, path, cache):
         """
         Returns an open file handle for the requested file, or raises an exception.
         """
         target_path = self._path + path
         try:
+            if not cache:
+                return _UncachedFile(open(target_path, 'rb'))
             return open(target_path, 'rb')
         except IOError as e:
             _logger.error("Unable to open file at %(path)s: %(error)s" % {
@@ -231,6 +286,23 @@ class LocalBackend(directory.DirectoryBackend):
         """
         self._action(path, os.rmdir)
         
+    def get_usage(self):
+        """
+        See ``common.BaseBackend.get_usage()``.
+        
+        Space reserved for the superuser counts as used, since this process can't write to it.
+        """
+        try:
+            stats = os.statvfs(self._path)
+        except (IOError, OSError) as e:
+            _logger.error("Unable to examine filesystem at %(path)s: %(error)s" % {
+             'path': self._path,
+             'error': str(e),
+            })
+            _handle_error(e)
+            raise
+        return ((stats.f_blocks - stats.f_bavail) * stats.f_frsize, stats.f_blocks * stats.f_frsize)
+        
     def _file_exists(self, path):
         """
         Indicates, with a boolean value, whether a file exists at `path`. If the file cannot be
@@ -238,11 +310,70 @@ class LocalBackend(directory.DirectoryBackend):
         """
         return os.path.exists(self._path + path)
         
-    def _walk(self):
+    def _walk(self, after):
         """
         Provides a generator that enumerates every file in the system, as tuples of (path:str,
-        [file:str]).
+        [file:str]), ordered by ``directory.path_key()``, skipping everything up to and including
+        the directory at `after`, if given.
+        
+        The order is depth-first, but the sub-directories of each directory, like the minute-buckets
+        of an hour, are listed concurrently, ahead of being yielded.
+        """
+        pool = multiprocessing.pool.ThreadPool(_WALK_WORKERS)
+        try:
+            for result in self._walk_directory(pool, '', self._scan(''), after and directory.path_key(after)):
+                yield result
+        finally:
+            pool.terminate()
+            
+    def _walk_directory(self, pool, path, listing, after):
+        """
+        Yields the files in the directory at `path`, whose `listing` is (directories, files), then
+        those of each of its sub-directories that lead to or follow `after`, recursively.
+        """
+        key = directory.path_key(path)
+        (directories, files) = listing
+        if not after or key > after:
+            yield (path, files)
+            
+        if path:
+            path += '/'
+        directories = [
+         path + name for name in sorted(directories, key=directory.path_key)
+         if not after or key + directory.path_key(name) >= after[:len(key) + 1]
+        ]
+        for (subpath, sublisting) in zip(directories, pool.imap(self._scan, directories)):
+            for result in self._walk_directory(pool, subpath, sublisting, after):
+                yield result
+                
+    def _scan(self, path):
+        """
+        Lists the directory at `path`, returning ([directory:str], [file:str]), which are empty if
+        it no longer exists.
+        
+        With ``scandir()``, entries are classified by the type the OS reports alongside their
+        names, where supported, instead of being examined individually.
         """
-        for (root, dirnames, files) in os.walk(self.path):
-            yield (root[len(self._path):], files)
+        target_path = self._path + path
+        (directories, files) = ([], [])
+        try:
+            if scandir:
+                entries = ((entry.name, entry.is_dir(follow_symlinks=False)) for entry in scandir(target_path))
+            else:
+                entries = ((name, os.path.isdir(target_path + '/' + name)) for name in os.listdir(target_path))
+            for (name, is_directory) in entries:
+                if is_directory:
+                    directories.append(name)
+                else:
+                    files.append(name)
+        except (IOError, OSError) as e:
+            if e.errno == 2: #Pruned while walking
+                return ([], [])
+            _logger.error("Unable to list directory at %(path)s: %(error)s" % {
+             'path': target_path,
+             'error': str(e),
+            })
+            _handle_error(e)
+            raise
+        return (directories, files)
             
@@ -0,0 +1,703 @@
+"""
+media-storage_server.backends.pack
+==================================
+
+Provides a backend that appends files to large segment files, instead of giving each one its own,
+so that vast numbers of small files don't spend their storage on inodes, metadata I/O, and
+directory entries.
+
+Legal
++++++
+ This file is part of media-storage.
+ media-storage is free software; you can redistribute it and/or modify
+ it under the terms of the GNU General Public License as published by
+ the Free Software Foundation; either version 3 of the License, or
+ (at your option) any later version.
+ 
+ This program is distributed in the hope that it will be useful,
+ but WITHOUT ANY WARRANTY; without even the implied warranty of
+ MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+ GNU General Public License for more details.
+ 
+ You should have received a copy of the GNU General Public License
+ along with this program. If not, see <http://www.gnu.org/licenses/>.
+ 
+ (C) Neil Tallim, 2012 <flan@uguu.ca>
+"""
+import logging
+import mmap
+import os
+import re
+import struct
+import threading
+import zlib
+from tempfile import SpooledTemporaryFile
+
+import common
+from common import (
+ FileNotFoundError, PermissionsError, CollisionError, NotEmptyError, NoSpaceError,
+ NoFilehandleError,
+)
+import directory
+from local import _handle_error, _posix_fadvise, _POSIX_FADV_DONTNEED
+
+_CHUNK_SIZE = 32 * 1024 #Work with 32K chunks
+_TEMPFILE_EXTENSION = '.temp'
+_SEGMENT_SIZE = 256 * 1024 * 1024 #The size past which a segment is sealed, unless overridden by a 'segment_size=<bytes>' option
+_SPOOL_SIZE = 1024 * 1024 #Files up to this size are gathered in memory before being appended; larger ones go through a tempfile
+
+_PUT = 'P' #An entry that holds a file's content
+_DELETE = 'D' #An entry that marks a file as unlinked
+_ENTRY = struct.Struct('>cHQI') #(kind, key-length, data-length, CRC-32 of data), followed by the key, then the data, in a segment
+_INDEX_ENTRY = struct.Struct('>cHQQI') #(kind, key-length, data-offset, data-length, CRC-32 of data), followed by the key, in an index
+_SEGMENT_RE = re.compile(r'^(?P<number>\d+)\.seg$')
+
+_logger = logging.getLogger("media_storage.backends.pack")
+
+def _key(path):
+    """
+    Provides `path` as the byte-string under which its entries are stored.
+    """
+    if isinstance(path, unicode):
+        return path.encode('utf-8')
+    return path
+    
+def _split(key):
+    """
+    Provides the (container, name) of `key`, as though it were a path in a directory tree.
+    """
+    (container, _, name) = key.rpartition('/')
+    return (container, name)
+    
+def _checksum(data, offset, length):
+    """
+    Computes the CRC-32 of the `length` bytes at `offset` in `data`, a buffer.
+    """
+    crc = 0
+    for position in xrange(offset, offset + length, _CHUNK_SIZE):
+        crc = zlib.crc32(data[position:min(position + _CHUNK_SIZE, offset + length)], crc)
+    return crc & 0xffffffff
+    
+    
+class _EntryFile(object):
+    """
+    A read-only file-like view of the data of one entry in a segment, which is either a memory-map
+    of the segment or, for uncached reads, an open handle to it, through which the kernel is told
+    to drop everything read from the page cache.
+    """
+    _source = None #The memory-map or file from which the data is read
+    _offset = 0 #The offset of the data in the segment
+    _length = 0 #The length of the data
+    _position = 0 #The current position within the data
+    _uncached = False #Whether `_source` is a file whose reads shouldn't be cached
+    
+    def __init__(self, source, offset, length, uncached=False):
+        self._source = source
+        self._offset = offset
+        self._length = length
+        self._uncached = uncached
+        
+    def read(self, size=-1):
+        remaining = self._length - self._position
+        if size < 0 or size > remaining:
+            size = remaining
+        start = self._offset + self._position
+        if self._uncached:
+            self._source.seek(start)
+            chunk = self._source.read(size)
+            if _posix_fadvise and chunk:
+                _posix_fadvise(self._source.fileno(), start, len(chunk), _POSIX_FADV_DONTNEED)
+        else:
+            chunk = self._source[start:start + size]
+        self._position += len(chunk)
+        return chunk
+        
+    def seek(self, offset, whence=0):
+        if whence == 1:
+            offset += self._position
+        elif whence == 2:
+            offset += self._length
+        self._position = min(max(0, offset), self._length)
+        
+    def tell(self):
+        return self._position
+        
+    def close(self):
+        if self._uncached:
+            self._source.close()
+            
+            
+class PackBackend(common.BaseBackend):
+    """
+    Stores files as entries appended to a sequence of numbered segment files, of which only the
+    last is written to; unlinking a file appends a tombstone, and the space the file held is
+    reclaimed by ``compact()``, which rewrites whatever remains live in mostly-dead segments.
+    
+    The location of every live file is held in memory, loaded at startup from the index written
+    alongside each segment when it's sealed, or by scanning segments that have no index, like the
+    one that was being written, whose tail is discarded if it was left incomplete.
+    
+    Paths are resolved as they are by directory-based backends, with the leading components of
+    each one naming a virtual container, so that the filesystem can be walked and listed in the
+    same way. A location must not be served by more than one backend.
+    """
+    _path = None #The directory that holds the segments
+    _segment_size = _SEGMENT_SIZE #The size past which a segment is sealed
+    _index = None #{container: {name: (segment, offset, length)}} for every live file
+    _segments = None #{segment: [size, live]}, where live is the number of bytes held by live files and current tombstones
+    _tombstones = None #{key: (segment, size)} for the latest tombstone of every unlinked path
+    _maps = None #{segment: mmap} for segments that have been read
+    _active = None #The number of the segment being written
+    _active_file = None #The unbuffered handle of the segment being written
+    _active_entries = None #[(kind, key, offset, length, crc)] for the segment being written, for its index
+    _lock = None #Guards the index, segment sizes, and memory-maps
+    _write_lock = None #Serialises appends; acquired before `_lock` when both are needed
+    
+    def __init__(self, path, options):
+        """
+        Ensures that `path` ends with a directory delimiter, then loads the index.
+        """
+        if not path.endswith(('/', '\\')):
+            self._path = path + os.path.sep
+        else:
+            self._path = path
+            
+        for option in options:
+            if option.startswith('segment_size='):
+                self._segment_size = int(option.split('=', 1)[1])
+                
+        self._index = {}
+        self._segments = {}
+        self._tombstones = {}
+        self._maps = {}
+        self._lock = threading.Lock()
+        self._write_lock = threading.Lock()
+        self._load()
+        
+    def _segment_path(self, number):
+        return '%(path)s%(number)08i.seg' % {
+         'path': self._path,
+         'number': number,
+        }
+        
+    def _index_path(self, number):
+        return '%(path)s%(number)08i.idx' % {
+         'path': self._path,
+         'number': number,
+        }
+        
+    def _load(self):
+        """
+        Rebuilds the index from every segment, in order, and resumes writing the last one.
+        """
+        try:
+            names = os.listdir(self._path)
+        except (IOError, OSError) as e:
+            _logger.error("Unable to list segments in %(path)s: %(error)s" % {
+             'path': self._path,
+             'error': str(e),
+            })
+            _handle_error(e)
+            raise
+        numbers = sorted(int(match.group('number')) for match in (_SEGMENT_RE.match(name) for name in names) if match)
+        
+        _logger.info("Loading %(count)i segments from %(path)s..." % {
+         'count': len(numbers),
+         'path': self._path,
+        })
+        for number in numbers[:-1]:
+            entries = self._read_index(number)
+            if entries is None:
+                entries = self._scan(number, truncate=False)
+                self._write_index(number, entries)
+            self._segments[number] = [os.path.getsize(self._segment_path(number)), 0]
+            for (kind, key, offset, length, crc) in entries:
+                self._apply(number, kind, key, offset, length)
+                
+        self._active = numbers and numbers[-1] or 1
+        self._active_entries = numbers and self._scan(self._active, truncate=True) or []
+        try:
+            self._active_file = open(self._segment_path(self._active), 'ab', 0)
+        except IOError as e:
+            _logger.error("Unable to open segment %(number)08i in %(path)s: %(error)s" % {
+             'number': self._active,
+             'path': self._path,
+             'error': str(e),
+            })
+            _handle_error(e)
+            raise
+        self._segments[self._active] = [os.path.getsize(self._segment_path(self._active)), 0]
+        for (kind, key, offset, length, crc) in self._active_entries:
+            self._apply(self._active, kind, key, offset, length)
+            
+        _logger.info("Loaded %(count)i containers from %(path)s" % {
+         'count': len(self._index),
+         'path': self._path,
+        })
+        
+    def _read_index(self, number):
+        """
+        Provides the entries of segment `number` as [(kind, key, offset, length, crc)] from its
+        index, or ``None`` if it has no usable index.
+        """
+        try:
+            with open(self._index_path(number), 'rb') as index:
+                content = index.read()
+        except IOError:
+            return None
+            
+        entries = []
+        position = 0
+        while position < len(content):
+            if position + _INDEX_ENTRY.size > len(content):
+                return None
+            (kind, key_length, offset, length, crc) = _INDEX_ENTRY.unpack_from(content, position)
+            position += _INDEX_ENTRY.size
+            entries.append((kind, content[position:position + key_length], offset, length, crc))
+            position += key_length
+        return entries
+        
+    def _write_index(self, number, entries):
+        """
+        Writes `entries`, as [(kind, key, offset, length, crc)], as the index of segment `number`,
+        logging, rather than raising, any failure, since the segment can be scanned instead.
+        """
+        path = self._index_path(number)
+        try:
+            with open(path + _TEMPFILE_EXTENSION, 'wb') as index:
+                for (kind, key, offset, length, crc) in entries:
+                    index.write(_INDEX_ENTRY.pack(kind, len(key), offset, length, crc) + key)
+            os.rename(path + _TEMPFILE_EXTENSION, path)
+        except (IOError, OSError) as e:
+            _logger.warn("Unable to write index at %(path)s; its segment will be scanned at startup: %(error)s" % {
+             'path': path,
+             'error': str(e),
+            })
+            
+    def _scan(self, number, truncate):
+        """
+        Reads every entry in segment `number`, returning [(kind, key, offset, length, crc)], with
+        each one's CRC verified; reading stops at the first entry that's incomplete or corrupt, as
+        when the process died while writing it, and, if `truncate` is set, the segment is cut
+        short there.
+        """
+        path = self._segment_path(number)
+        entries = []
+        position = 0
+        damaged = False
+        with open(path, 'rb') as segment:
+            while True:
+                header = segment.read(_ENTRY.size)
+                if not header:
+                    break
+                try:
+                    if len(header) < _ENTRY.size:
+                        raise ValueError("incomplete header")
+                    (kind, key_length, length, crc) = _ENTRY.unpack(header)
+                    if not kind in (_PUT, _DELETE):
+                        raise ValueError("unknown kind of entry: %(kind)r" % {
+                         'kind': kind,
+                        })
+                    key = segment.read(key_length)
+                    if len(key) < key_length:
+                        raise ValueError("incomplete key")
+                    remaining = length
+                    actual_crc = 0
+                    while remaining:
+                        chunk = segment.read(min(remaining, _CHUNK_SIZE))
+                        if not chunk:
+                            raise ValueError("incomplete data")
+                        actual_crc = zlib.crc32(chunk, actual_crc)
+                        remaining -= len(chunk)
+                    if actual_crc & 0xffffffff != crc:
+                        raise ValueError("CRC mismatch")
+                except ValueError as e:
+                    _logger.error("Segment at %(path)s is damaged at offset %(offset)i: %(error)s; %(action)s" % {
+                     'path': path,
+                     'offset': position,
+                     'error': str(e),
+                     'action': truncate and "discarding everything that follows" or "ignoring everything that follows",
+                    })
+                    damaged = True
+                    break
+                entries.append((kind, key, position + _ENTRY.size + key_length, length, crc))
+                position += _ENTRY.size + key_length + length
+                
+        if damaged and truncate:
+            with open(path, 'r+b') as segment:
+                segment.truncate(position)
+        return entries
+        
+    def _apply(self, number, kind, key, offset, length):
+        """
+        Updates the index and the live size of each affected segment to reflect an entry in segment
+        `number`; `_lock` must be held, or the backend must still be loading.
+        
+        A path's latest tombstone counts as live, since it may be needed to hide entries in older
+        segments until it's dropped by compaction; once superseded, by a new file or tombstone at the
+        same path, it's dead.
+        """
+        (container, name) = _split(key)
+        names = self._index.get(container)
+        previous = names and names.get(name)
+        if previous:
+            self._segments[previous[0]][1] -= _ENTRY.size + len(key) + previous[2]
+        tombstone = self._tombstones.pop(key, None)
+        if tombstone and tombstone[0] in self._segments:
+            self._segments[tombstone[0]][1] -= tombstone[1]
+            
+        size = _ENTRY.size + len(key) + length
+        self._segments[number][1] += size
+        if kind == _PUT:
+            if names is None:
+                names = self._index[container] = {}
+            names[name] = (number, offset, length)
+        else:
+            self._tombstones[key] = (number, size)
+            if previous:
+                del names[name]
+                if not names: #Containers are only virtual
+                    del self._index[container]
+                
+    def _locate(self, key):
+        """
+        Provides the (segment, offset, length) of the live file at `key`, or ``None`` if there isn't
+        one; `_lock` must be held.
+        """
+        (container, name) = _split(key)
+        names = self._index.get(container)
+        return names and names.get(name)
+        
+    def _map(self, number, end):
+        """
+        Provides a memory-map of segment `number` that spans at least `end` bytes, mapping it anew
+        if it has grown since it was last mapped; `_lock` must be held.
+        
+        Superseded maps are left to be closed when the last reader is done with them.
+        """
+        mapped = self._maps.get(number)
+        if mapped is None or len(mapped) < end:
+            path = self._segment_path(number)
+            try:
+                with open(path, 'rb') as segment:
+                    mapped = self._maps[number] = mmap.mmap(segment.fileno(), 0, access=mmap.ACCESS_READ)
+            except (IOError, OSError, mmap.error) as e:
+                _logger.error("Unable to map segment at %(path)s: %(error)s" % {
+                 'path': path,
+                 'error': str(e),
+                })
+                _handle_error(e)
+                raise
+        return mapped
+        
+    def _append(self, kind, key, source, length, crc):
+        """
+        Appends an entry to the active segment, sealing it first if it's full, with `length` bytes
+        of data read from `source`, then updates the index; `_write_lock` must be held.
+        
+        If the entry can't be written in full, the segment is truncated to where it began.
+        """
+        if self._segments[self._active][0] >= self._segment_size:
+            self._seal()
+            
+        offset = self._segments[self._active][0]
+        try:
+            self._active_file.write(_ENTRY.pack(kind, len(key), length, crc) + key)
+            remaining = length
+            while remaining:
+                chunk = source.read(min(remaining, _CHUNK_SIZE))
+                if not chunk:
+                    raise IOError("Content ended %(remaining)i bytes early" % {
+                     'remaining': remaining,
+                    })
+                self._active_file.write(chunk)
+                remaining -= len(chunk)
+        except (IOError, OSError) as e:
+            _logger.error("Unable to append to segment %(number)08i in %(path)s: %(error)s" % {
+             'number': self._active,
+             'path': self._path,
+             'error': str(e),
+            })
+            try:
+                self._active_file.truncate(offset)
+            except (IOError, OSError) as e2:
+                _logger.error("Unable to truncate incomplete entry in segment %(number)08i in %(path)s: %(error)s" % {
+                 'number': self._active,
+                 'path': self._path,
+                 'error': str(e2),
+                })
+            _handle_error(e)
+            raise
+            
+        entry = (kind, key, offset + _ENTRY.size + len(key), length, crc)
+        self._active_entries.append(entry)
+        with self._lock:
+            self._segments[self._active][0] = entry[2] + length
+            self._apply(self._active, kind, key, entry[2], length)
+            
+    def _seal(self):
+        """
+        Stops writing the active segment, writing its index, and begins the next one; `_write_lock`
+        must be held.
+        """
+        number = self._active + 1
+        _logger.info("Sealing segment %(number)08i in %(path)s..." % {
+         'number': self._active,
+         'path': self._path,
+        })
+        try:
+            active_file = open(self._segment_path(number), 'ab', 0)
+        except IOError as e:
+            _logger.error("Unable to create segment %(number)08i in %(path)s: %(error)s" % {
+             'number': number,
+             'path': self._path,
+             'error': str(e),
+            })
+            _handle_error(e)
+            raise
+        self._active_file.close()
+        self._write_index(self._active, self._active_entries)
+        
+        with self._lock:
+            self._segments[number] = [0, 0]
+        self._active = number
+        self._active_file = active_file
+        self._active_entries = []
+        
+    def resolve_path(self, record):
+        """
+        See ``common.BaseBackend.resolve_path()`` and ``directory.resolve_path()``.
+        """
+        return directory.resolve_path(record)
+        
+    def get(self, path, cache=True):
+        """
+        See ``common.BaseBackend.get()``.
+        
+        Cached reads are served from a memory-map of the segment; uncached reads go through a
+        handle of their own.
+        """
+        _logger.debug("Retrieving filesystem entity at %(path)s..." % {
+         'path': path,
+        })
+        with self._lock:
+            location = self._locate(_key(path))
+            if not location:
+                raise FileNotFoundError(path)
+            (number, offset, length) = location
+            if cache:
+                return _EntryFile(self._map(number, offset + length), offset, length)
+                
+            try: #Opened while locked, so that compaction can't remove it first
+                segment = open(self._segment_path(number), 'rb')
+            except IOError as e:
+                _logger.error("Unable to open segment %(number)08i in %(path)s: %(error)s" % {
+                 'number': number,
+                 'path': self._path,
+                 'error': str(e),
+                })
+                _handle_error(e)
+                raise
+        return _EntryFile(segment, offset, length, uncached=True)
+        
+    def put(self, path, data, tempfile):
+        """
+        See ``common.BaseBackend.put()``.
+        
+        `data` is gathered in full before anything is appended, so that appends are never held up
+        by whatever produces it.
+        """
+        _logger.info("Setting filesystem entity at %(path)s..." % {
+         'path': path,
+        })
+        key = _key(path)
+        if tempfile:
+            key += _TEMPFILE_EXTENSION
+            
+        spool = SpooledTemporaryFile(max_size=_SPOOL_SIZE)
+        try:
+            length = 0
+            crc = 0
+            while True:
+                chunk = data.read(_CHUNK_SIZE)
+                if not chunk:
+                    break
+                spool.write(chunk)
+                length += len(chunk)
+                crc = zlib.crc32(chunk, crc)
+            spool.seek(0)
+            with self._write_lock:
+                self._append(_PUT, key, spool, length, crc & 0xffffffff)
+        finally:
+            spool.close()
+            
+    def make_permanent(self, path):
+        """
+        See ``common.BaseBackend.make_permanent()``.
+        
+        The content is appended again under its permanent path, and its temporary entry is
+        tombstoned.
+        """
+        key = _key(path)
+        with self._write_lock:
+            with self._lock:
+                location = self._locate(key + _TEMPFILE_EXTENSION)
+                if not location:
+                    raise FileNotFoundError(path + _TEMPFILE_EXTENSION)
+                (number, offset, length) = location
+                mapped = self._map(number, offset + length)
+            self._append(_PUT, key, _EntryFile(mapped, offset, length), length, _checksum(mapped, offset, length))
+            self._append(_DELETE, key + _TEMPFILE_EXTENSION, None, 0, 0)
+            
+    def unlink(self, path, rmcontainer=False):
+        """
+        See ``common.BaseBackend.unlink()``.
+        
+        Containers are virtual, so `rmcontainer` has no effect.
+        """
+        _logger.info("Unlinking filesystem entity at %(path)s..." % {
+         'path': path,
+        })
+        key = _key(path)
+        with self._write_lock:
+            with self._lock:
+                if not self._locate(key):
+                    raise FileNotFoundError(path)
+            self._append(_DELETE, key, None, 0, 0)
+            
+    def prune(self, path):
+        """
+        See ``common.BaseBackend.prune()``.
+        
+        Containers are virtual and disappear with their last file, so there is nothing to do.
+        """
+        
+    def file_exists(self, path):
+        """
+        See ``common.BaseBackend.file_exists()``.
+        """
+        _logger.debug("Testing existence of filesystem entity at %(path)s..." % {
+         'path': path,
+        })
+        with self._lock:
+            return bool(self._locate(_key(path)))
+            
+    def get_usage(self):
+        """
+        See ``common.BaseBackend.get_usage()``.
+        
+        Space held by unlinked files counts as used until compaction releases it, since that's what
+        the filesystem actually holds.
+        """
+        try:
+            stats = os.statvfs(self._path)
+        except (IOError, OSError) as e:
+            _logger.error("Unable to examine filesystem at %(path)s: %(error)s" % {
+             'path': self._path,
+             'error': str(e),
+            })
+            _handle_error(e)
+            raise
+        return ((stats.f_blocks - stats.f_bavail) * stats.f_frsize, stats.f_blocks * stats.f_frsize)
+        
+    def list_container(self, path):
+        """
+        See ``common.BaseBackend.list_container()``.
+        """
+        (container, name) = _split(_key(path))
+        with self._lock:
+            return set(self._index.get(container, ()))
+            
+    def walk(self, after=None):
+        """
+        See ``common.BaseBackend.walk()``.
+        
+        Every non-empty container is yielded, ordered by ``directory.path_key()``.
+        """
+        _logger.debug("Walking filesystem...")
+        after = after and directory.path_key(after)
+        with self._lock:
+            containers = sorted(self._index, key=directory.path_key)
+        for container in containers:
+            if after and directory.path_key(container) <= after:
+                continue
+            with self._lock:
+                names = list(self._index.get(container, ()))
+            if names:
+                yield (container, names)
+                
+    def compact(self, threshold, throttle=None):
+        """
+        See ``common.BaseBackend.compact()``.
+        
+        Every sealed segment in which at least `threshold` of the space is held by unlinked files is
+        rewritten, one live file at a time, so that writes can continue meanwhile.
+        """
+        with self._lock:
+            candidates = sorted(
+             number for (number, (size, live)) in self._segments.items()
+             if number != self._active and size and float(size - live) / size >= threshold
+            )
+        reclaimed = 0
+        for number in candidates:
+            reclaimed += self._compact_segment(number, throttle)
+        return reclaimed
+        
+    def _compact_segment(self, number, throttle):
+        """
+        Appends every live file in segment `number` to the active segment, along with any tombstones
+        that may still hide entries in older segments, then removes it, returning the number of
+        bytes reclaimed.
+        """
+        entries = self._read_index(number)
+        if entries is None:
+            entries = self._scan(number, truncate=False)
+        with self._lock:
+            (size, live) = self._segments[number]
+            oldest = min(self._segments)
+        _logger.info("Compacting segment %(number)08i in %(path)s, of which %(live)i of %(size)i bytes are live..." % {
+         'number': number,
+         'path': self._path,
+         'live': live,
+         'size': size,
+        })
+        
+        for (kind, key, offset, length, crc) in entries:
+            if kind == _PUT:
+                with self._lock:
+                    if self._locate(key) != (number, offset, length): #Since superseded or unlinked
+                        continue
+                if throttle:
+                    throttle(length)
+                with self._write_lock:
+                    with self._lock:
+                        if self._locate(key) != (number, offset, length): #Changed while throttled
+                            continue
+                        source = _EntryFile(self._map(number, offset + length), offset, length)
+                    self._append(_PUT, key, source, length, crc)
+            elif number > oldest: #Older segments may still hold what it hides
+                with self._write_lock:
+                    with self._lock:
+                        if self._locate(key) or self._tombstones.get(key, (None,))[0] != number: #Superseded, which hides older entries just as well
+                            continue
+                    self._append(_DELETE, key, None, 0, 0)
+                    
+        with self._write_lock:
+            with self._lock:
+                (size, live) = self._segments.pop(number)
+                self._maps.pop(number, None)
+                for (kind, key, offset, length, crc) in entries: #Those that hid nothing older
+                    if kind == _DELETE and self._tombstones.get(key, (None,))[0] == number:
+                        del self._tombstones[key]
+        for path in (self._index_path(number), self._segment_path(number)):
+            try:
+                os.unlink(path)
+            except (IOError, OSError) as e:
+                if e.errno != 2: #A segment without an index
+                    _logger.error("Unable to unlink %(path)s after compaction; it must be removed manually: %(error)s" % {
+                     'path': path,
+                     'error': str(e),
+                    })
+        return size
+        
+        
\ No newline at end of file
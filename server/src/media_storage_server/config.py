@@ -31,6 +31,8 @@ import ConfigParser
 import os
 import sys
 
+import compression
+
 class _Config(ConfigParser.RawConfigParser):
     """
     A simple wrapper around RawConfigParser to extend it with support for default values.
@@ -128,6 +130,14 @@ class _Settings(_Config):
     def http_port(self):
         return self.getint('http', 'port', 1234)
         
+    @property
+    def http_compression_workers(self):
+        return self.getint('http', 'compression_workers', 2)
+        
+    @property
+    def http_compression_queue_size(self):
+        return self.getint('http', 'compression_queue_size', 16)
+        
         
     @property
     def database_address(self):
@@ -169,7 +179,81 @@ class _Settings(_Config):
         """
         Returns all specialised families as a list of (name, uri) tuples.
         """
-        return self.has_section('families') and self.items('families') or []
+        return [
+         (name, uri) for (name, uri) in (self.has_section('families') and self.items('families') or [])
+         if not '.' in name #Dotted names are per-family settings
+        ]
+        
+    def family_concurrency(self, family):
+        """
+        Returns the number of records belonging to `family` (``None`` for the generic family) that
+        each maintainer may process at once.
+        """
+        if family is None:
+            return self.getint('storage', 'generic_concurrency', self.maintainer_family_concurrency)
+        return self.getint('families', family + '.concurrency', self.maintainer_family_concurrency)
+        
+    def family_migration(self, family):
+        """
+        Returns the (family:str, idle:int) to which content belonging to `family` (``None`` for the
+        generic family) is moved once it hasn't been accessed for `idle` seconds, or ``None`` if
+        it stays put.
+        
+        Definitions take the form '<family>:<seconds>'.
+        
+        @raise ValueError: The number of seconds could not be converted to an C{int}.
+        """
+        if family is None:
+            definition = self.get('storage', 'generic_migrate', '')
+        else:
+            definition = self.get('families', family + '.migrate', '')
+        if not definition:
+            return None
+        (target, idle) = definition.rsplit(':', 1)
+        return (target.strip(), int(idle))
+        
+    def family_layout(self, family):
+        """
+        Returns the directory layout in which new content belonging to `family` (``None`` for the
+        generic family) is stored: 'time', which buckets files by creation time, or 'hashed', which
+        fans them out over a fixed-depth tree of hash-prefix directories.
+        
+        @raise ValueError: The layout is not recognised.
+        """
+        if family is None:
+            layout = self.get('storage', 'generic_layout', 'time')
+        else:
+            layout = self.get('families', family + '.layout', 'time')
+        if not layout in ('time', 'hashed'):
+            raise ValueError("Unrecognised layout for %(family)r: %(layout)s" % {
+             'family': family,
+             'layout': layout,
+            })
+        return layout
+        
+    def family_compression(self, family):
+        """
+        Returns the compression options configured for `family` (``None`` for the generic family)
+        as a dictionary of {format: {option: value}}.
+        
+        Definitions take the form '<format>:<option>=<value>[,<option>=<value>...]', separated by
+        whitespace.
+        
+        @raise ValueError: An option's value could not be converted to an C{int} or is out of the
+            range the format accepts.
+        """
+        if family is None:
+            definition = self.get('storage', 'generic_compression', '')
+        else:
+            definition = self.get('families', family + '.compression', '')
+            
+        options = {}
+        for entry in definition.split():
+            (format, settings) = entry.split(':', 1)
+            options[format] = compression.filter_options(format, dict(
+             (name.strip(), value) for (name, value) in (setting.split('=', 1) for setting in settings.split(','))
+            ))
+        return options
         
         
     @property
@@ -189,6 +273,14 @@ class _Settings(_Config):
     def maintainer_deletion_sleep(self):
         return self.getint('maintainers', 'deletion_sleep', 300)
         
+    @property
+    def maintainer_deletion_concurrency(self):
+        return self.getint('maintainers', 'deletion_concurrency', 4)
+        
+    @property
+    def maintainer_deletion_batch_size(self):
+        return self.getint('maintainers', 'deletion_batch_size', 100)
+        
     @property
     def maintainer_compression_windows(self):
         return self.get('maintainers', 'compression_windows', '')
@@ -197,6 +289,69 @@ class _Settings(_Config):
     def maintainer_compression_sleep(self):
         return self.getint('maintainers', 'compression_sleep', 1800)
         
+    @property
+    def maintainer_compression_concurrency(self):
+        return self.getint('maintainers', 'compression_concurrency', 2)
+        
+    @property
+    def maintainer_compression_workers(self):
+        return self.getint('maintainers', 'compression_workers', 1)
+        
+    @property
+    def maintainer_compression_min_saving(self):
+        return self.getfloat('maintainers', 'compression_min_saving', 0.05)
+        
+    @property
+    def maintainer_compression_incompressible_mimes(self):
+        return self.get('maintainers', 'compression_incompressible_mimes', (
+         'audio/mpeg audio/ogg audio/mp4 audio/aac audio/flac application/ogg '
+         'image/jpeg image/png image/gif image/webp video/ '
+         'application/zip application/gzip application/x-gzip application/x-bzip2 application/x-xz '
+         'application/x-7z-compressed'
+        )).split()
+        
+    @property
+    def maintainer_schedule_capacity(self):
+        return self.getint('maintainers', 'schedule_capacity', 10000)
+        
+    @property
+    def maintainer_policy_retry_delay(self):
+        return self.getint('maintainers', 'policy_retry_delay', 60)
+        
+    @property
+    def maintainer_policy_retry_max_delay(self):
+        return self.getint('maintainers', 'policy_retry_max_delay', 3600)
+        
+    @property
+    def maintainer_family_concurrency(self):
+        return self.getint('maintainers', 'family_concurrency', 2)
+        
+    def maintainer_budget(self, name):
+        """
+        Returns the rates of 'bytes', 'ops', and 'queries' per second to which the `name`d
+        maintainer is held, with 0 meaning unlimited.
+        """
+        return dict(
+         (kind, self.getfloat('maintainers', name + '_' + kind + '_rate', 0.0))
+         for kind in ('bytes', 'ops', 'queries')
+        )
+        
+    @property
+    def maintainer_checkpoint_path(self):
+        return self.get('maintainers', 'checkpoint_path', None)
+        
+    @property
+    def maintainer_checkpoint_interval(self):
+        return self.getint('maintainers', 'checkpoint_interval', 30)
+        
+    @property
+    def maintainer_backoff_latency(self):
+        return self.getfloat('maintainers', 'backoff_latency', 0.0)
+        
+    @property
+    def maintainer_backoff_lag(self):
+        return self.getfloat('maintainers', 'backoff_lag', 0.0)
+        
     @property
     def maintainer_database_windows(self):
         return self.get('maintainers', 'database_windows', '')
@@ -205,6 +360,10 @@ class _Settings(_Config):
     def maintainer_database_sleep(self):
         return self.getint('maintainers', 'database_sleep', 43200)
         
+    @property
+    def maintainer_database_batch_size(self):
+        return self.getint('maintainers', 'database_batch_size', 1000)
+        
     @property
     def maintainer_filesystem_windows(self):
         return self.get('maintainers', 'filesystem_windows', '')
@@ -213,6 +372,70 @@ class _Settings(_Config):
     def maintainer_filesystem_sleep(self):
         return self.getint('maintainers', 'filesystem_sleep', 43200)
         
+    @property
+    def maintainer_filesystem_batch_size(self):
+        return self.getint('maintainers', 'filesystem_batch_size', 1000)
+        
+    @property
+    def maintainer_filesystem_retry_delay(self):
+        return self.getint('maintainers', 'filesystem_retry_delay', 300)
+        
+    @property
+    def maintainer_accounting_windows(self):
+        return self.get('maintainers', 'accounting_windows', '')
+        
+    @property
+    def maintainer_scrub_windows(self):
+        return self.get('maintainers', 'scrub_windows', '')
+        
+    @property
+    def maintainer_scrub_sleep(self):
+        return self.getint('maintainers', 'scrub_sleep', 604800)
+        
+    @property
+    def maintainer_eviction_windows(self):
+        return self.get('maintainers', 'eviction_windows', '')
+        
+    @property
+    def maintainer_eviction_sleep(self):
+        return self.getint('maintainers', 'eviction_sleep', 60)
+        
+    @property
+    def maintainer_eviction_high_watermark(self):
+        return self.getfloat('maintainers', 'eviction_high_watermark', 0.9)
+        
+    @property
+    def maintainer_eviction_low_watermark(self):
+        return self.getfloat('maintainers', 'eviction_low_watermark', 0.8)
+        
+    @property
+    def maintainer_eviction_pin_key(self):
+        return self.get('maintainers', 'eviction_pin_key', 'pinned')
+        
+    @property
+    def maintainer_migration_windows(self):
+        return self.get('maintainers', 'migration_windows', '')
+        
+    @property
+    def maintainer_migration_sleep(self):
+        return self.getint('maintainers', 'migration_sleep', 3600)
+        
+    @property
+    def maintainer_migration_concurrency(self):
+        return self.getint('maintainers', 'migration_concurrency', 2)
+        
+    @property
+    def maintainer_compaction_windows(self):
+        return self.get('maintainers', 'compaction_windows', '')
+        
+    @property
+    def maintainer_compaction_sleep(self):
+        return self.getint('maintainers', 'compaction_sleep', 3600)
+        
+    @property
+    def maintainer_compaction_threshold(self):
+        return self.getfloat('maintainers', 'compaction_threshold', 0.5)
+        
         
     @property
     def log_file_path(self):
@@ -263,6 +486,10 @@ class _Settings(_Config):
     def email_alert_cooldown(self):
         return self.getfloat('email', 'alert_cooldown', 300.0)
         
+    @property
+    def email_alert_queue_size(self):
+        return self.getint('email', 'alert_queue_size', 100)
+        
     @property
     def email_alert_subject(self):
         return self.get('email', 'alert_subject', 'Critical failure')
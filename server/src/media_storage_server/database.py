@@ -39,11 +39,21 @@ _COLLECTION = _DATABASE[CONFIG.database_collection]
 
 for index in ( #Ensure that indexes exist on all important attributes
  'physical.family', 'physical.ctime', 'physical.atime',
+ 'physical.size', 'physical.storedSize',
  'policy.delete.fixed', 'policy.delete.stale',
  'policy.compress.fixed', 'policy.compress.stale',
 ):
     _COLLECTION.ensure_index(index)
-    
+for field in ( #Due-time scans are ordered by time, then uid
+ 'policy.delete.fixed', 'policy.delete.staleTime',
+ 'policy.compress.fixed', 'policy.compress.staleTime',
+):
+    _COLLECTION.ensure_index([(field, pymongo.ASCENDING), ('_id', pymongo.ASCENDING)])
+#Access-ordered scans happen per family, by atime, then uid
+_COLLECTION.ensure_index([
+ ('physical.family', pymongo.ASCENDING), ('physical.atime', pymongo.ASCENDING), ('_id', pymongo.ASCENDING),
+])
+
 _logger = logging.getLogger("media_storage.database")
 
 def authenticate(f):
@@ -100,6 +110,61 @@ def enumerate_all(ctime, limit=250):
         })
         raise
         
+@authenticate
+def enumerate_due(field, after, until, limit):
+    """
+    Iterates over the records whose `field`, a timestamp, is no later than `until`, in order of
+    that timestamp and then uid, starting after `after`, the (timestamp, uid) of the last record
+    returned by the previous call, or ``None`` for the first invocation.
+    
+    Up to `limit` records are returned, each containing only its uid and `field`.
+    """
+    spec = {field: {'$lte': until}}
+    if after:
+        spec['$or'] = [
+         {field: {'$gt': after[0]}},
+         {field: after[0], '_id': {'$gt': after[1]}},
+        ]
+    try:
+        return _COLLECTION.find(
+         spec=spec,
+         fields=[field],
+         limit=limit,
+         sort=[(field, pymongo.ASCENDING), ('_id', pymongo.ASCENDING)],
+        )
+    except Exception as e:
+        _logger.error("Unable to retrieve records: %(error)s" % {
+         'error': str(e),
+        })
+        raise
+        
+@authenticate
+def enumerate_by_atime(query, after, limit):
+    """
+    Iterates over the records that match `query`, a Mongo query structure, least recently accessed
+    first, starting after `after`, the (atime, uid) of the last record returned by the previous
+    call, or ``None`` for the first invocation.
+    
+    Up to `limit` records are returned.
+    """
+    spec = dict(query)
+    if after:
+        spec['$or'] = [
+         {'physical.atime': {'$gt': after[0]}},
+         {'physical.atime': after[0], '_id': {'$gt': after[1]}},
+        ]
+    try:
+        return _COLLECTION.find(
+         spec=spec,
+         limit=limit,
+         sort=[('physical.atime', pymongo.ASCENDING), ('_id', pymongo.ASCENDING)],
+        )
+    except Exception as e:
+        _logger.error("Unable to retrieve records: %(error)s" % {
+         'error': str(e),
+        })
+        raise
+        
 @authenticate
 def enumerate_where(query):
     """
@@ -118,6 +183,19 @@ def enumerate_where(query):
         })
         raise
         
+@authenticate
+def count_where(query):
+    """
+    Returns the number of records that match `query`, a Mongo query structure.
+    """
+    try:
+        return _COLLECTION.find(spec=query).count()
+    except Exception as e:
+        _logger.error("Unable to count records: %(error)s" % {
+         'error': str(e),
+        })
+        raise
+        
 @authenticate
 def get_record(uid):
     """
@@ -173,20 +251,88 @@ def update_record(record):
         raise
         
 @authenticate
-def drop_record(uid):
+def update_fields(uid, changes, expected=None):
+    """
+    Sets the dotted fields in `changes` on the record associated with `uid`, leaving the rest of
+    the record alone, so that concurrent changes to other fields aren't lost.
+    
+    If `expected` is given, the change is only made if the record's dotted fields still have those
+    values, with ``None`` matching absent fields.
+    
+    A boolean value is returned, indicating whether a record was changed.
+    """
+    _logger.info("Updating fields of record for '%(uid)s'..." % {
+     'uid': uid,
+    })
+    spec = dict(expected or {})
+    spec['_id'] = uid
+    try:
+        result = _COLLECTION.update(spec, {'$set': changes}, safe=True)
+    except Exception as e:
+        _logger.error("Unable to update record: %(error)s" % {
+         'error': str(e),
+        })
+        raise
+    return bool(result and result.get('n'))
+    
+@authenticate
+def drop_record(uid, expected=None):
     """
     Removes the record associated with `uid` from the database, if it exists.
+    
+    If `expected` is given, the record is only removed if its dotted fields still have those
+    values, with ``None`` matching absent fields, as with ``update_fields()``.
+    
+    A boolean value is returned, indicating whether a record was removed.
     """
     _logger.info("Dropping record for '%(uid)s'..." % {
      'uid': uid,
     })
+    spec = dict(expected or {})
+    spec['_id'] = uid
     try:
-        _COLLECTION.remove(uid)
+        result = _COLLECTION.remove(spec, safe=True)
     except Exception as e:
         _logger.error("Unable to remove record: %(error)s" % {
          'error': str(e),
         })
         raise
+    return bool(result and result.get('n'))
+        
+@authenticate
+def drop_records(uids):
+    """
+    Removes the records associated with every uid in `uids` from the database, as one operation.
+    """
+    _logger.info("Dropping %(count)i records..." % {
+     'count': len(uids),
+    })
+    try:
+        _COLLECTION.remove({'_id': {'$in': list(uids)}})
+    except Exception as e:
+        _logger.error("Unable to remove records: %(error)s" % {
+         'error': str(e),
+        })
+        raise
+        
+@authenticate
+def find_existing(uids):
+    """
+    Provides the subset of `uids` for which records exist, as a set, through a single query.
+    """
+    _logger.debug("Testing existence of records for %(count)i uids..." % {
+     'count': len(uids),
+    })
+    try:
+        return set(record['_id'] for record in _COLLECTION.find(
+         spec={'_id': {'$in': list(uids)}},
+         fields=[],
+        ))
+    except Exception as e:
+        _logger.error("Unable to search for records: %(error)s" % {
+         'error': str(e),
+        })
+        raise
         
 @authenticate
 def record_exists(uid):
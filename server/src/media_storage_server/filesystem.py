@@ -12,17 +12,18 @@ Legal
  it under the terms of the GNU General Public License as published by
  the Free Software Foundation; either version 3 of the License, or
  (at your option) any later version.
-
+ 
  This program is distributed in the hope that it will be useful,
  but WITHOUT ANY WARRANTY; without even the implied warranty of
  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
  GNU General Public License for more details.
-
+ 
  You should have received a copy of the GNU General Public License
  along with this program. If not, see <http://www.gnu.org/licenses/>.
  
  (C) Neil Tallim, 2012 <flan@uguu.ca>
 """
+import hashlib
 import logging
 import time
 
@@ -36,6 +37,48 @@ from config import CONFIG
 
 _logger = logging.getLogger('media_storage.filesystem')
 
+class CountingReader(object):
+    """
+    A read-only file-like wrapper that tallies the size of everything read through it, so that
+    streamed content can be measured while it's being processed.
+    """
+    size = 0 #The number of bytes read so far
+    _data = None #The wrapped file-like object
+    
+    def __init__(self, data):
+        self._data = data
+        
+    def read(self, size=-1):
+        chunk = self._data.read(size)
+        self.size += len(chunk)
+        return chunk
+        
+    def close(self):
+        self._data.close()
+        
+class HashingReader(CountingReader):
+    """
+    A read-only file-like wrapper that tallies the size and SHA-1 digest of everything read through
+    it, so that content can be fingerprinted while it's being stored.
+    """
+    _hash = None #The running digest
+    
+    def __init__(self, data):
+        CountingReader.__init__(self, data)
+        self._hash = hashlib.sha1()
+        
+    def read(self, size=-1):
+        chunk = CountingReader.read(self, size)
+        self._hash.update(chunk)
+        return chunk
+        
+    def hexdigest(self):
+        """
+        Provides the digest of everything read so far, as a hex string.
+        """
+        return self._hash.hexdigest()
+        
+        
 class Filesystem(object):
     """
     An abstract notion of a filesystem, which may wrap conventional directory systems,
@@ -43,9 +86,22 @@ class Filesystem(object):
     identifiers of some sort.
     """
     _backend = None #The backend used to manage files
+    _compression_options = None #A dictionary of {format: {option: value}} for compression tuning
+    layout = None #The layout in which new files are stored, recorded with each record
     
-    def __init__(self, uri):
+    def __init__(self, uri, compression_options=None, layout='time'):
         self._backend = backends.get_backend(uri)
+        self._compression_options = compression_options or {}
+        self.layout = layout
+        
+    def get_compression_options(self, format, overrides=None):
+        """
+        Provides the compression tuning options to use when compressing content in this filesystem
+        as `format`, with any `overrides`, like those from a record's policy, taking precedence.
+        """
+        options = self._compression_options.get(format, {}).copy()
+        options.update(overrides or {})
+        return options
         
     def resolve_path(self, record):
         """
@@ -53,14 +109,15 @@ class Filesystem(object):
         """
         return self._backend.resolve_path(record)
         
-    def get(self, record):
+    def get(self, record, cache=True):
         """
-        Retrieves the data associated with `record`.
+        Retrieves the data associated with `record`; if `cache` is unset, the data is read in a way
+        that avoids displacing more useful content from the OS's caches.
         """
         _logger.debug("Retrieving filesystem entity for %(uid)s..." % {
          'uid': record['_id'],
         })
-        return self._backend.get(self.resolve_path(record))
+        return self._backend.get(self.resolve_path(record), cache)
         
     def put(self, record, data, tempfile=False):
         """
@@ -81,22 +138,77 @@ class Filesystem(object):
         })
         self._backend.make_permanent(self.resolve_path(record))
         
-    def unlink(self, record):
+    def discard(self, record):
+        """
+        Removes the file associated with `record` that was written with temporary markings, when
+        it won't be made permanent after all.
+        """
+        _logger.info("Discarding temporary filesystem entity for %(uid)s..." % {
+         'uid': record['_id'],
+        })
+        self._backend.discard(self.resolve_path(record))
+        
+    def unlink(self, record, prune=True):
         """
         Removes the file associated with the given `record`.
         
         If the directory in which the file resides is old enough that new files cannot resonably
         be placed inside (2 * resolution in minutes), then directories may be removed to free
-        allocation resources.
+        allocation resources, unless `prune` is unset, as when ``prune()`` will be called later.
         """
         _logger.info("Unlinking filesystem entity for %(uid)s..." % {
          'uid': record['_id'],
         })
         self._backend.unlink(
          self.resolve_path(record),
-         rmcontainer=(time.time() - record['physical']['ctime'] > CONFIG.storage_minute_resolution * 120)
+         rmcontainer=(prune and self._is_settled(record))
         )
         
+    def unlink_path(self, path):
+        """
+        Removes the file at the backend-specific `path`, for files that have no record.
+        """
+        _logger.info("Unlinking filesystem entity at %(path)s..." % {
+         'path': path,
+        })
+        self._backend.unlink(path)
+        
+    def prune(self, records):
+        """
+        Removes the directories that held the files associated with `records`, after they've been
+        unlinked, to the extent that ``unlink()`` would, examining each directory only once.
+        """
+        containers = {}
+        for record in records:
+            if self._is_settled(record):
+                path = self.resolve_path(record)
+                containers[path[:path.rfind('/')]] = path
+        for path in containers.values():
+            self._backend.prune(path)
+            
+    def _is_settled(self, record):
+        """
+        Indicates whether the directory that holds `record`'s file is too old to receive new files,
+        which is never the case for the hash-prefix directories of the 'hashed' layout.
+        """
+        if record['physical'].get('layout') == 'hashed':
+            return False
+        return time.time() - record['physical']['ctime'] > CONFIG.storage_minute_resolution * 120
+        
+    def get_usage(self):
+        """
+        Provides the fraction of the underlying storage that is in use.
+        """
+        (used, total) = self._backend.get_usage()
+        return total and float(used) / total or 0.0
+        
+    def compact(self, threshold, throttle=None):
+        """
+        Reclaims the space held by unlinked files, for backends that don't release it immediately,
+        returning the number of bytes reclaimed; see ``backends.common.BaseBackend.compact()``.
+        """
+        return self._backend.compact(threshold, throttle)
+        
     def file_exists(self, record):
         """
         Provides a boolean value that indicates whether the file associated with `record` exists.
@@ -106,9 +218,39 @@ class Filesystem(object):
         })
         return self._backend.file_exists(self.resolve_path(record))
         
-    def walk(self):
+    def find_missing(self, records, listings):
+        """
+        Identifies those `records` whose files do not exist, returning them as a list, by listing
+        the directory that should hold each file, rather than examining files individually.
+        
+        `listings` is a dictionary of the listings already made, by directory, which is extended as
+        new directories are listed, so that a directory spanning several calls is listed only once.
+        
+        Records in the 'hashed' layout are scattered across every hash-prefix directory, so that
+        listing would cover far more files than the records it checks; their files are examined
+        individually instead.
+        """
+        missing = []
+        for record in records:
+            if record['physical'].get('layout') == 'hashed':
+                if not self.file_exists(record):
+                    missing.append(record)
+                continue
+                
+            path = self.resolve_path(record)
+            (container, name) = path.rsplit('/', 1)
+            listing = listings.get(container)
+            if listing is None:
+                listing = listings[container] = self._backend.list_container(path)
+            if not name in listing:
+                missing.append(record)
+        return missing
+        
+    def walk(self, after=None):
         """
-        Returns a generator that recursively traverses the whole filesystem.
+        Returns a generator that recursively traverses the whole filesystem, in a stable order,
+        resuming with whatever follows the sub-path `after`, if given.
         """
-        return self._backend.walk()
+        return self._backend.walk(after)
         
+        
\ No newline at end of file
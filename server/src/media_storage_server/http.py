@@ -11,12 +11,12 @@ Legal
  it under the terms of the GNU General Public License as published by
  the Free Software Foundation; either version 3 of the License, or
  (at your option) any later version.
-
+ 
  This program is distributed in the hope that it will be useful,
  but WITHOUT ANY WARRANTY; without even the implied warranty of
  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
  GNU General Public License for more details.
-
+ 
  You should have received a copy of the GNU General Public License
  along with this program. If not, see <http://www.gnu.org/licenses/>.
  
@@ -24,6 +24,7 @@ Legal
 """
 import base64
 import collections
+import functools
 import json
 import logging
 import os
@@ -47,17 +48,81 @@ import compression
 import database
 import mail
 import filesystem
+import load
+import maintainence
 import state
+import workers
 
 _CHUNK_SIZE = 16 * 1024 #Write 16k at a time.
 _TEMPFILE_THRESHOLD = 128 * 1024 #Buffer up to 128k in memory
+_LAG_INTERVAL = 0.5 #The number of seconds between measurements of the IOLoop's lag
 
 _FILTER_RE = re.compile(r':(?P<filter>.+?):(?P<query>.+)')
+_RANGE_RE = re.compile(r'^bytes=(?P<start>\d*)-(?P<end>\d*)$')
 
 _TrustLevel = collections.namedtuple('TrustLevel', ('read', 'write',))
 
+DEFERRED = object() #Returned by a handler whose response will be completed later, on the IOLoop
+
 _logger = logging.getLogger("media_storage.http")
 
+def _parse_range(header, size):
+    """
+    Interprets a single-range `header`, as in 'bytes=0-499', 'bytes=500-', or 'bytes=-500',
+    against content of `size` bytes, returning the inclusive (start, end) offsets to serve.
+    
+    ``None`` is returned if the header is absent or not understood, including a range that ends
+    before it starts, in which case the whole entity should be served, as RFC 7233 requires;
+    ``ValueError`` is raised if the range cannot be satisfied.
+    """
+    match = header and _RANGE_RE.match(header.strip())
+    if not match or not (match.group('start') or match.group('end')):
+        return None
+        
+    if not match.group('start'): #Suffix range
+        start = max(0, size - int(match.group('end')))
+        end = size - 1
+    else:
+        start = int(match.group('start'))
+        end = match.group('end')
+        if end and int(end) < start: #Syntactically invalid, so the header is ignored
+            return None
+        end = min(size - 1, int(end or size - 1))
+    if start >= size:
+        raise ValueError("Range cannot be satisfied")
+    return (start, end)
+    
+def _measure(data):
+    """
+    Provides the length, in bytes, of the seekable file-like object `data`, which is left at its
+    start.
+    """
+    data.seek(0, 2)
+    size = data.tell()
+    data.seek(0)
+    return size
+    
+def _open_transient(path):
+    """
+    Opens the file at `path` for reading and unlinks it, so that its space is reclaimed as soon as
+    the returned handle is closed.
+    """
+    data = open(path, 'rb')
+    _unlink(path)
+    return data
+    
+def _unlink(path):
+    """
+    Removes the file at `path`, logging, rather than raising, any failure.
+    """
+    try:
+        os.unlink(path)
+    except Exception as e:
+        _logger.error("Unable to unlink '%(path)s': %(error)s" % {
+         'path': path,
+         'error': str(e),
+        })
+        
 def _get_trust(record, keys, host):
     """
     Determines which permissions to expose for a record, returning the result as a namedtuple with
@@ -125,6 +190,9 @@ class BaseHandler(tornado.web.RequestHandler):
     - 409 if the request made no sense
     - 500 if an internal exception happened
     - 503 if a short-term problem occurred
+    
+    Handlers that hand work off to other threads or processes return ``DEFERRED``, then pass a
+    function that produces the eventual response to `_resume()`.
     """
     def send_error(self, code, premature_termination=True, **kwargs):
         """
@@ -138,6 +206,7 @@ class BaseHandler(tornado.web.RequestHandler):
         if premature_termination:
             raise PrematureTermination("Request-processing prematurely terminated")
             
+    @tornado.web.asynchronous #Every path through _respond() finishes the request explicitly
     def post(self):
         """
         Handles an HTTP POST request.
@@ -146,9 +215,24 @@ class BaseHandler(tornado.web.RequestHandler):
          'path': self.request.path,
          'address': self.request.remote_ip,
         })
+        _logger.debug("Processing request...")
+        self._respond(self._post)
+        
+    def _resume(self, f):
+        """
+        Completes a deferred request by invoking `f`, which behaves like `_post()`, on the IOLoop;
+        this may be called from any thread.
+        """
+        tornado.ioloop.IOLoop.instance().add_callback(functools.partial(self._respond, f))
+        
+    def _respond(self, f):
+        """
+        Invokes `f`, which behaves like `_post()`, and sends its output or an appropriate error.
+        """
         try:
-            _logger.debug("Processing request...")
-            output = self._post()
+            output = f()
+            if output is DEFERRED:
+                return
         except filesystem.Error as e:
             summary = "Filesystem error; exception details follow:\n" + traceback.format_exc()
             _logger.critical(summary)
@@ -211,11 +295,35 @@ class StatusHandler(BaseHandler):
           },
           'threads': process.get_num_threads(),
          },
+         'workers': workers.get_stats(),
+         'maintainers': maintainence.get_stats(),
+         'load': load.get_stats(),
          'system': {
           'load': dict(zip(('t1', 't5', 't15'), os.getloadavg())),
          },
         }
         
+class MaintainersHandler(BaseHandler):
+    """
+    Lets trusted hosts inspect the maintainers and 'trigger', 'pause', or 'resume' the one named
+    in the request, if any, responding with the state of every maintainer.
+    """
+    def _post(self):
+        if not _get_trust(None, None, self.request.remote_ip).write:
+            self.send_error(403)
+            
+        request = _get_json(self.request.body) or {}
+        if request.get('action'):
+            try:
+                maintainence.control(request.get('name'), request['action'])
+            except KeyError:
+                self.send_error(404)
+            except ValueError:
+                self.send_error(409)
+        return {
+         'maintainers': maintainence.get_stats(),
+        }
+        
 class ListFamiliesHandler(BaseHandler):
     """
     Enumerates, in alphabetic order, every named family defined in the system, including those
@@ -234,9 +342,13 @@ class PutHandler(BaseHandler):
     
     The received request must either be a proxied nginx request or a multi-part form with the file
     included as binary data.
+    
+    Compression on the server happens in the ``workers`` process pool, with the response deferred
+    until the compressed data has been written; 503 is returned if the pool is saturated.
     """
     def _post(self):
-        (header, data) = self._get_payload()
+        compress_on_server = self.request.headers.get('Media-Storage-Compress-On-Server') == 'yes'
+        (header, data) = self._get_payload(on_disk=compress_on_server)
         
         current_time = time.time()
         try:
@@ -257,10 +369,13 @@ class PutHandler(BaseHandler):
              },
              'meta': header.get('meta') or {},
             }
-        except (KeyError, TypeError, AttributeError) as e:
+            record['physical']['layout'] = state.get_filesystem(record['physical']['family']).layout
+        except (KeyError, TypeError, AttributeError, ValueError) as e:
             _logger.error("Request received did not adhere to expected structure: %(error)s" % {
              'error': str(e),
             })
+            if compress_on_server:
+                _unlink(data)
             self.send_error(409)
             return
         else:
@@ -268,27 +383,93 @@ class PutHandler(BaseHandler):
              'uid': record['_id'],
             })
             
+        fs = state.get_filesystem(record['physical']['family'])
+        
         _logger.debug("Evaluating compression requirements...")
         target_compression = record['physical']['format'].get('comp')
-        if target_compression and self.request.headers.get('Media-Storage-Compress-On-Server') == 'yes':
-            _logger.info("Compressing file...")
-            data = compression.get_compressor(target_compression)(data)
-            
-        _logger.debug("Storing entity...")
-        database.add_record(record)
-        fs = state.get_filesystem(record['physical']['family'])
-        fs.put(record, data)
+        if compress_on_server:
+            if target_compression:
+                record['physical']['size'] = os.path.getsize(data)
+                _logger.info("Queueing file for compression...")
+                try:
+                    workers.compress(
+                     target_compression, fs.get_compression_options(target_compression), data,
+                     functools.partial(self._compressed, record, fs, data)
+                    )
+                except workers.SaturatedError as e:
+                    _logger.warn("Unable to queue file for compression: %(error)s" % {
+                     'error': str(e),
+                    })
+                    _unlink(data)
+                    self.send_error(503)
+                except Exception:
+                    _unlink(data)
+                    raise
+                return DEFERRED
+            data = _open_transient(data)
+        return self._store(record, fs, data)
+        
+    def _compressed(self, record, fs, source_path, path, error):
+        """
+        Receives the outcome of a compression job, on a pool-management thread, resuming the
+        request to store the compressed data at `path`, or to fail with `error`.
+        """
+        _unlink(source_path)
+        def _complete():
+            if error:
+                raise workers.WorkerError("Unable to compress '%(uid)s':\n%(error)s" % {
+                 'uid': record['_id'],
+                 'error': error,
+                })
+            return self._store(record, fs, _open_transient(path))
+        self._resume(_complete)
+        
+    def _store(self, record, fs, data):
+        """
+        Writes `data`, in its final form, and `record`, returning the response to send.
         
+        The SHA-1 of the bytes written is computed as they're stored and added to the record
+        afterwards, since the record must be added first, to claim its uid.
+        """
+        try:
+            target_compression = record['physical']['format'].get('comp')
+            record['physical']['storedSize'] = _measure(data)
+            if not target_compression:
+                record['physical']['size'] = record['physical']['storedSize']
+            #Otherwise, the size is known only if the content was compressed here; content that the
+            #client compressed is measured when it's first decompressed, by a transfer or a scrub
+            
+            _logger.debug("Storing entity...")
+            database.add_record(record)
+            data = filesystem.HashingReader(data)
+            fs.put(record, data)
+        finally:
+            data.close()
+            
+        try:
+            database.update_fields(record['_id'], {'physical.storedHash': data.hexdigest()}, expected={
+             'physical.storedHash': None,
+             'physical.storedSize': data.size,
+            })
+        except Exception as e: #The first scrub will record it instead
+            _logger.warn("Unable to record the SHA-1 of '%(uid)s': %(error)s" % {
+             'uid': record['_id'],
+             'error': str(e),
+            })
+            
         return {
          'uid': record['_id'],
          'keys': record['keys'],
         }
         
-    def _get_payload(self):
+    def _get_payload(self, on_disk=False):
         """
         Depending on whether the request came through an nginx proxy, this will determine the right
         way to expose the received data. Regardless of method, the values returned will be a JSON
         object descriptor and a file-like object containing the submitted bytes.
+        
+        If `on_disk` is set, the path of a file containing the submitted bytes is returned instead of
+        a file-like object, so that other processes can read it; the caller must unlink it.
         """
         header = _get_json(self.get_argument('header', ''))
         content=None
@@ -297,6 +478,8 @@ class PutHandler(BaseHandler):
             filepath = self.get_argument('content', None)
             if not filepath:
                 raise IOError("No file specified by nginx")
+            if on_disk:
+                return (header, filepath)
             content = open(filepath, 'rb')
             try:
                 _logger.debug("Unlinking nginx tempfile...")
@@ -306,6 +489,12 @@ class PutHandler(BaseHandler):
                  'path': filepath,
                  'error': str(e),
                 })
+        elif on_disk:
+            _logger.debug("Extracting payload from Tornado structure to disk...")
+            content = tempfile.NamedTemporaryFile(delete=False)
+            content.write(self.request.files['content'][0]['body'])
+            content.close()
+            return (header, content.name)
         else:
             _logger.debug("Extracting payload from Tornado structure...")
             content = tempfile.SpooledTemporaryFile(_TEMPFILE_THRESHOLD)
@@ -359,6 +548,9 @@ class PutHandler(BaseHandler):
                 if compress_format in compression.SUPPORTED_FORMATS:
                     policy['compress']['comp'] = compress_format
                     policy['compress'].update(_unpack_policy(compress_policy))
+                    options = compression.filter_options(compress_format, compress_policy.get('options'))
+                    if options:
+                        policy['compress']['options'] = options
                 else:
                     _logger.warn("Unsupported compression format specified: %(format)s" % {
                      'format': compress_format,
@@ -392,6 +584,7 @@ class DescribeHandler(BaseHandler):
         record['uid'] = record['_id']
         del record['_id']
         del record['physical']['minRes']
+        record['physical'].pop('layout', None)
         del record['keys']
         return record
         
@@ -401,7 +594,14 @@ class GetHandler(BaseHandler):
     format.
     
     Depending on the client's request and capabilities, decompression may occur locally.
+    
+    A single byte-range may be requested with a 'Range' header when the entity is uncompressed or
+    stored as gz-indexed, in which case the range applies to the decompressed content and only the
+    frames it covers are decompressed; other entities are always returned in full.
     """
+    _data = None #The file-like object from which the entity is being streamed
+    _measuring = None #The record whose logical size is being measured by the transfer, if any
+    
     def _post(self):
         request = _get_json(self.request.body)
         uid = request['uid']
@@ -422,14 +622,25 @@ class GetHandler(BaseHandler):
         current_time = int(time.time())
         record['physical']['atime'] = current_time
         record['stats']['accesses'] += 1
+        changes = {
+         'physical.atime': current_time,
+         'stats.accesses': record['stats']['accesses'],
+        }
         for policy in ('delete', 'compress'):
             if 'stale' in record['policy'][policy]:
-                record['policy'][policy]['staleTime'] = current_time + record['policy'][policy]['stale']
-        database.update_record(record)
+                record['policy'][policy]['staleTime'] = changes['policy.' + policy + '.staleTime'] = current_time + record['policy'][policy]['stale']
+        database.update_fields(uid, changes) #Only these, so as not to undo a concurrent migration
         
         fs = state.get_filesystem(record['physical']['family'])
         try:
-            data = fs.get(record)
+            try:
+                data = fs.get(record)
+            except filesystem.FileNotFoundError:
+                moved = database.get_record(uid) #Its file may have just been migrated
+                if not moved or moved['physical'] == record['physical']:
+                    raise
+                (record['physical'], fs) = (moved['physical'], state.get_filesystem(moved['physical']['family']))
+                data = fs.get(record)
         except filesystem.FileNotFoundError as e:
             _logger.error("Database record exists for '%(uid)s', but filesystem entry does not" % {
              'uid': uid,
@@ -439,22 +650,120 @@ class GetHandler(BaseHandler):
         else:
             _logger.debug("Evaluating decompression requirements...")
             applied_compression = record['physical']['format'].get('comp')
+            length = record['physical'].get(applied_compression and 'storedSize' or 'size')
+            remaining = -1 #Unbounded
+            if self.request.headers.get('Range') and applied_compression in (None, compression.COMPRESS_GZ_INDEXED):
+                if applied_compression:
+                    data = compression.IndexedReader(data)
+                    applied_compression = None
+                    size = data.size
+                else:
+                    size = _measure(data)
+                length = size
+                
+                try:
+                    byte_range = _parse_range(self.request.headers.get('Range'), size)
+                except ValueError:
+                    data.close()
+                    _logger.info("Request from %(address)s served with failure code 416" % {
+                     'address': self.request.remote_ip,
+                    })
+                    self.set_status(416) #Not send_error(), which would discard Content-Range
+                    self.set_header('Content-Range', 'bytes */%(size)i' % {'size': size,})
+                    return
+                if byte_range:
+                    (start, end) = byte_range
+                    _logger.debug("Serving bytes %(start)i-%(end)i of %(size)i..." % {
+                     'start': start,
+                     'end': end,
+                     'size': size,
+                    })
+                    data.seek(start)
+                    remaining = length = end - start + 1
+                    self.set_status(206)
+                    self.set_header('Content-Range', 'bytes %(start)i-%(end)i/%(size)i' % {
+                     'start': start,
+                     'end': end,
+                     'size': size,
+                    })
+                    
             supported_compressions = (c.strip() for c in (self.request.headers.get('Media-Storage-Supported-Compression') or '').split(';'))
             if applied_compression and not applied_compression in supported_compressions: #Must be decompressed first
-                data = compression.get_decompressor(applied_compression)(data)
+                data = compression.get_stream_decompressor(applied_compression)(data)
+                length = record['physical'].get('size')
+                if length is None: #Unmeasured; omit Content-Length and learn it from this transfer
+                    data = filesystem.CountingReader(data)
+                    self._measuring = record
                 applied_compression = None
                 
             _logger.debug("Returning entity...")
             self.set_header('Content-Type', record['physical']['format']['mime'])
+            if length is not None: #Older records may not have been measured yet
+                self.set_header('Content-Length', length)
             if applied_compression:
                 self.set_header('Media-Storage-Applied-Compression', applied_compression)
-            while True:
-                chunk = data.read(_CHUNK_SIZE)
-                if chunk:
-                    self.write(chunk)
-                else:
-                    break
-                    
+            self._data = data
+            self._stream(remaining)
+            return DEFERRED
+            
+    def _stream(self, remaining):
+        """
+        Writes the next chunk of the entity, of which `remaining` bytes are still to be sent (or
+        everything, if negative), continuing from the callback of the flush that sends it, so that
+        only one chunk is ever buffered; the request is finished once everything has been sent.
+        """
+        try:
+            chunk = remaining and self._data.read(remaining < 0 and _CHUNK_SIZE or min(_CHUNK_SIZE, remaining))
+            if not chunk:
+                if self._measuring:
+                    self._record_size(self._measuring, self._data.size)
+                self._close_data()
+                self.finish()
+                return
+                
+            if remaining > 0:
+                remaining -= len(chunk)
+            self.write(chunk)
+            self.flush(callback=functools.partial(self._stream, remaining))
+        except Exception as e:
+            self._close_data()
+            summary = "Unable to stream entity; exception details follow:\n" + traceback.format_exc()
+            _logger.error(summary)
+            mail.send_alert(summary)
+            if not self._headers_written:
+                self.send_error(500, premature_termination=False)
+            else: #The response can't be completed, so the client mustn't wait for the rest of it
+                self.request.connection.stream.close()
+                
+    def _record_size(self, record, size):
+        """
+        Sets the logical `size` of `record`, as measured by decompressing its content in full, unless
+        the record has changed since it was read.
+        """
+        physical = record['physical']
+        try:
+            database.update_fields(record['_id'], {'physical.size': size}, expected={
+             'physical.size': None,
+             'physical.storedSize': physical.get('storedSize'),
+             'physical.format.comp': physical['format'].get('comp'),
+            })
+        except Exception as e: #It'll be measured on a later transfer or scrub
+            _logger.warn("Unable to record the size of '%(uid)s': %(error)s" % {
+             'uid': record['_id'],
+             'error': str(e),
+            })
+            
+    def _close_data(self):
+        if self._data:
+            (data, self._data) = (self._data, None)
+            data.close()
+            
+    def on_connection_close(self):
+        """
+        Releases the entity if the client disconnects before it has been sent in full.
+        """
+        self._close_data()
+        
 class UnlinkHandler(BaseHandler):
     """
     Removes a stored entity from the system, permissions-depending.
@@ -475,7 +784,7 @@ class UnlinkHandler(BaseHandler):
         if not trust.write:
             self.send_error(403)
             return
-        
+            
         fs = state.get_filesystem(record['physical']['family'])
         try:
             fs.unlink(record)
@@ -509,8 +818,15 @@ class UpdateHandler(BaseHandler):
             self.send_error(403)
             return
             
-        self._update_policy(record, request)
-        
+        try:
+            self._update_policy(record, request)
+        except ValueError as e:
+            _logger.error("Request received specified invalid policy: %(error)s" % {
+             'error': str(e),
+            })
+            self.send_error(409)
+            return
+            
         for removed in request['meta']['removed']:
             if removed in record['meta']:
                 del record['meta'][removed]
@@ -536,6 +852,9 @@ class UpdateHandler(BaseHandler):
                 if compress_format in compression.SUPPORTED_FORMATS:
                     policy['compress'] = _unpack_policy(compress_policy)
                     policy['compress']['comp'] = compress_format
+                    options = compression.filter_options(compress_format, compress_policy.get('options'))
+                    if options:
+                        policy['compress']['options'] = options
                 else:
                     _logger.warn("Unsupported compression format specified: %(format)s" % {
                      'format': compress_format,
@@ -555,6 +874,8 @@ class QueryHandler(BaseHandler):
             query['keys.read'] = None #Anonymous records only
             
         def _assemble_range_block(name, attribute):
+            if not name in request: #Not sent by older clients
+                return
             attribute_block = {}
             _min = request[name]['min']
             _max = request[name]['max']
@@ -568,6 +889,8 @@ class QueryHandler(BaseHandler):
         _assemble_range_block('ctime', 'physical.ctime')
         _assemble_range_block('atime', 'physical.atime')
         _assemble_range_block('accesses', 'stats.accesses')
+        _assemble_range_block('size', 'physical.size')
+        _assemble_range_block('storedSize', 'physical.storedSize')
         
         query['physical.family'] = request['family']
         
@@ -626,6 +949,7 @@ class QueryHandler(BaseHandler):
             record['uid'] = record['_id']
             del record['_id']
             del record['physical']['minRes']
+            record['physical'].pop('layout', None)
             records.append(record)
         return {
          'records': records,
@@ -659,7 +983,7 @@ class HTTPService(threading.Thread):
          'port': port,
         })
         self._http_loop = tornado.ioloop.IOLoop.instance()
-        self._http_application = tornado.web.Application(handlers, log_function=(lambda x:''), xheaders=True)
+        self._http_application = tornado.web.Application(handlers, log_function=self._log_request, xheaders=True)
         self._http_server = tornado.httpserver.HTTPServer(self._http_application)
         self._http_server.listen(port)
         
@@ -672,11 +996,28 @@ class HTTPService(threading.Thread):
         _logger.info("HTTP server's kill-flag set")
         self._http_loop.stop()
         
+    def _log_request(self, handler):
+        """
+        Notes how long every request took to serve, in place of Tornado's own request-logging.
+        """
+        load.record_latency(handler.request.request_time())
+        
+    def _measure_lag(self, deadline):
+        """
+        Notes how long after `deadline` the IOLoop got around to running this, then schedules the
+        next measurement.
+        """
+        current_time = time.time()
+        load.record_lag(max(0.0, current_time - deadline))
+        deadline = current_time + _LAG_INTERVAL
+        self._http_loop.add_timeout(deadline, functools.partial(self._measure_lag, deadline))
+        
     def run(self):
         """
         Continuously accepts requests until killed; any exceptions that occur are logged.
         """
         _logger.info("Starting Tornado HTTP server engine...")
+        self._measure_lag(time.time())
         self._http_loop.start()
         _logger.info("Tornado HTTP server engine terminated")
         
@@ -687,3 +1028,4 @@ class PrematureTermination(Exception):
     request-processing flow.
     """
     
+    
\ No newline at end of file
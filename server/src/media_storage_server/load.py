@@ -0,0 +1,102 @@
+"""
+media-storage.load
+==================
+
+Tracks how responsive the webservice is, through the latency of recent requests and the lag of the
+IOLoop, so that background work can yield to online traffic.
+
+Legal
++++++
+ This file is part of media-storage.
+ media-storage is free software; you can redistribute it and/or modify
+ it under the terms of the GNU General Public License as published by
+ the Free Software Foundation; either version 3 of the License, or
+ (at your option) any later version.
+ 
+ This program is distributed in the hope that it will be useful,
+ but WITHOUT ANY WARRANTY; without even the implied warranty of
+ MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+ GNU General Public License for more details.
+ 
+ You should have received a copy of the GNU General Public License
+ along with this program. If not, see <http://www.gnu.org/licenses/>.
+ 
+ (C) Neil Tallim, 2012 <flan@uguu.ca>
+"""
+import collections
+import logging
+import threading
+import time
+
+from config import CONFIG
+
+_SAMPLE_PERIOD = 10.0 #Only samples taken within this many seconds are considered
+
+_latencies = collections.deque() #(time, seconds) for every recent request
+_lags = collections.deque() #(time, seconds) for every recent IOLoop measurement
+_lock = threading.Lock() #Guards the samples
+_pressure = (0.0, 1.0) #(time, pressure) as last computed, since it's consulted very frequently
+
+_logger = logging.getLogger("media_storage.load")
+
+def record_latency(seconds):
+    """
+    Notes that a request took `seconds` to serve.
+    """
+    _record(_latencies, seconds)
+    
+def record_lag(seconds):
+    """
+    Notes that the IOLoop ran a scheduled callback `seconds` late.
+    """
+    _record(_lags, seconds)
+    
+def _record(samples, seconds):
+    current_time = time.time()
+    with _lock:
+        samples.append((current_time, seconds))
+        _expire(samples, current_time)
+        
+def _expire(samples, current_time):
+    """
+    Discards samples older than the sample period; the lock must be held.
+    """
+    while samples and samples[0][0] < current_time - _SAMPLE_PERIOD:
+        samples.popleft()
+        
+def _mean(samples):
+    return samples and sum(seconds for (t, seconds) in samples) / len(samples) or 0.0
+    
+def get_stats():
+    """
+    Provides the mean request 'latency' and IOLoop 'lag' over the sample period, and the resulting
+    'pressure', as described by ``get_pressure()``.
+    """
+    current_time = time.time()
+    with _lock:
+        _expire(_latencies, current_time)
+        _expire(_lags, current_time)
+        (latency, lag) = (_mean(_latencies), _mean(_lags))
+    pressure = 1.0
+    if CONFIG.maintainer_backoff_latency > 0:
+        pressure = max(pressure, latency / CONFIG.maintainer_backoff_latency)
+    if CONFIG.maintainer_backoff_lag > 0:
+        pressure = max(pressure, lag / CONFIG.maintainer_backoff_lag)
+    return {
+     'latency': latency,
+     'lag': lag,
+     'pressure': pressure,
+    }
+    
+def get_pressure():
+    """
+    Provides the factor by which the webservice is exceeding its configured latency and lag
+    targets, never less than 1.0, which means that it's within them.
+    """
+    global _pressure
+    (computed, pressure) = _pressure
+    if time.time() - computed >= 1.0:
+        pressure = get_stats()['pressure']
+        _pressure = (time.time(), pressure)
+    return pressure
+    
@@ -13,18 +13,23 @@ Legal
  it under the terms of the GNU General Public License as published by
  the Free Software Foundation; either version 3 of the License, or
  (at your option) any later version.
-
+ 
  This program is distributed in the hope that it will be useful,
  but WITHOUT ANY WARRANTY; without even the implied warranty of
  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
  GNU General Public License for more details.
-
+ 
  You should have received a copy of the GNU General Public License
  along with this program. If not, see <http://www.gnu.org/licenses/>.
  
  (C) Neil Tallim, 2012 <flan@uguu.ca>
 """
+import collections
+import heapq
+import json
 import logging
+import multiprocessing.pool
+import os
 import re
 import threading
 import time
@@ -33,6 +38,8 @@ from config import CONFIG
 import compression
 import database
 import filesystem
+import load
+import mail
 import state
 
 #Window structures to determine when threads may run
@@ -40,9 +47,76 @@ DELETION_WINDOWS = None
 COMPRESSION_WINDOWS = None
 DATABASE_WINDOWS = None
 FILESYSTEM_WINDOWS = None
+ACCOUNTING_WINDOWS = None
+MIGRATION_WINDOWS = None
+EVICTION_WINDOWS = None
+SCRUB_WINDOWS = None
+COMPACTION_WINDOWS = None
+
+_MEASURE_CHUNK_SIZE = 256 * 1024 #Read 256k at a time when measuring decompressed content
+_LISTING_CACHE_SIZE = 64 #The number of directory listings to hold per family
+
+_STATS = {} #Progress reported by each maintainer, keyed by name
+_MAINTAINERS = {} #Every running maintainer, keyed by name
+_CHECKPOINTS = None #The persisted sweep progress of every maintainer, keyed by name
+_checkpoint_lock = threading.Lock() #Guards `_CHECKPOINTS` and the file that holds them
 
 _logger = logging.getLogger("media_storage.maintainence")
 
+def get_stats():
+    """
+    Provides the progress and scheduling state of every running maintainer, as a dictionary keyed
+    by name.
+    """
+    stats = dict((name, stats.copy()) for (name, stats) in _STATS.items())
+    for (name, maintainer) in _MAINTAINERS.items():
+        stats.setdefault(name, {}).update(maintainer.describe())
+    return stats
+    
+def control(name, action):
+    """
+    Applies `action`, one of 'trigger', 'pause', or 'resume', to the maintainer called `name`,
+    raising ``KeyError`` if no such maintainer is running or ``ValueError`` if `action` is unknown.
+    """
+    maintainer = _MAINTAINERS[name]
+    if not action in ('trigger', 'pause', 'resume'):
+        raise ValueError("Unknown maintainer action: %(action)r" % {
+         'action': action,
+        })
+    _logger.info("Applying %(action)s to %(name)s" % {
+     'action': action,
+     'name': name,
+    })
+    getattr(maintainer, action)()
+    
+def next_run(windows, current_time=None):
+    """
+    Provides the earliest time, no earlier than `current_time`, at which `windows` allow execution,
+    or ``None`` if they never do.
+    """
+    if current_time is None:
+        current_time = time.time()
+    ts = time.localtime(current_time)
+    tc = ts.tm_hour * 60 + ts.tm_min
+    for offset in xrange(8):
+        for (start, end) in sorted(windows.get((ts.tm_wday + offset) % 7, ())):
+            if offset == 0 and end <= tc: #Already over
+                continue
+            return max(current_time, time.mktime((
+             ts.tm_year, ts.tm_mon, ts.tm_mday + offset, start // 60, start % 60, 0, 0, 0, -1,
+            )))
+    return None
+    
+def _get_field(record, field):
+    """
+    Provides the value of the dotted `field` in `record`, or ``None`` if it's absent.
+    """
+    for key in field.split('.'):
+        if not isinstance(record, dict):
+            return None
+        record = record.get(key)
+    return record
+    
 def parse_windows():
     """
     Interprets the execution windows defined in the configuration file to determine when the threads
@@ -56,6 +130,16 @@ def parse_windows():
     DATABASE_WINDOWS = _parse_windows(CONFIG.maintainer_database_windows, 'database integrity')
     global FILESYSTEM_WINDOWS
     FILESYSTEM_WINDOWS = _parse_windows(CONFIG.maintainer_filesystem_windows, 'filesystem integrity')
+    global ACCOUNTING_WINDOWS
+    ACCOUNTING_WINDOWS = _parse_windows(CONFIG.maintainer_accounting_windows, 'size accounting')
+    global MIGRATION_WINDOWS
+    MIGRATION_WINDOWS = _parse_windows(CONFIG.maintainer_migration_windows, 'migration')
+    global EVICTION_WINDOWS
+    EVICTION_WINDOWS = _parse_windows(CONFIG.maintainer_eviction_windows, 'eviction')
+    global SCRUB_WINDOWS
+    SCRUB_WINDOWS = _parse_windows(CONFIG.maintainer_scrub_windows, 'scrub')
+    global COMPACTION_WINDOWS
+    COMPACTION_WINDOWS = _parse_windows(CONFIG.maintainer_compaction_windows, 'compaction')
     
 def _parse_windows(definition, name):
     """
@@ -95,11 +179,116 @@ def _parse_windows(definition, name):
 class _Maintainer(threading.Thread):
     """
     Provides the foundation of all maintenance threads.
+    
+    Running threads can be inspected and controlled through ``get_stats()`` and ``control()``. A
+    paused thread stops at its next opportunity; a triggered one works immediately, regardless of
+    its `_windows`, until it completes a pass.
     """
+    _windows = None #The windows in which the thread may work
+    _control = None #A condition, notified whenever the thread is controlled
+    _paused = False #Whether the thread has been paused
+    _triggered = False #Whether a pass has been requested
+    _status = 'starting' #What the thread is doing: 'running', 'waiting', 'sleeping', or 'paused'
+    _resume_time = None #When the thread expects to resume, while waiting or sleeping
+    
     def __init__(self):
         threading.Thread.__init__(self)
         self.daemon = True
+        self._control = threading.Condition()
+        
+    def start(self):
+        _MAINTAINERS[self.name] = self
+        threading.Thread.start(self)
+        
+    def describe(self):
+        """
+        Provides the thread's scheduling state, as a dictionary.
+        """
+        with self._control:
+            return {
+             'status': self._status,
+             'paused': self._paused,
+             'triggered': self._triggered,
+             'resumeTime': self._resume_time,
+             'nextWindow': next_run(self._windows),
+            }
+            
+    def trigger(self):
+        """
+        Requests an immediate pass, regardless of the thread's windows, resuming it if paused.
+        """
+        with self._control:
+            self._paused = False
+            self._triggered = True
+            self._notify()
+            
+    def pause(self):
+        """
+        Stops the thread at its next opportunity, until resumed or triggered.
+        """
+        with self._control:
+            self._paused = True
+            self._notify()
+            
+    def resume(self):
+        """
+        Allows a paused thread to work again.
+        """
+        with self._control:
+            self._paused = False
+            self._notify()
+            
+    def _notify(self):
+        """
+        Wakes the thread after its controls change; the control lock must be held.
+        """
+        self._control.notify_all()
+        
+    def _complete_pass(self):
+        """
+        Called by the thread when it finishes a pass, satisfying any trigger.
+        """
+        with self._control:
+            self._triggered = False
+            
+    def _eligible(self):
+        """
+        Indicates whether the thread may work now; the control lock must be held.
+        """
+        return not self._paused and (self._triggered or self._within_window(self._windows))
         
+    def _wait_for_window(self):
+        """
+        Blocks until the thread may work, sleeping until its next window opens, unless controlled.
+        """
+        with self._control:
+            while not self._eligible():
+                if self._paused:
+                    (self._status, self._resume_time) = ('paused', None)
+                    self._control.wait()
+                    continue
+                    
+                self._status = 'waiting'
+                self._resume_time = next_run(self._windows)
+                _logger.debug("%(name)s not in execution window; sleeping until %(time)s" % {
+                 'name': self.name,
+                 'time': self._resume_time and time.ctime(self._resume_time),
+                })
+                #Re-evaluated at least hourly, in case the clock or timezone changes
+                self._control.wait(max(1.0, min((self._resume_time or float('inf')) - time.time(), 3600)))
+            (self._status, self._resume_time) = ('running', None)
+            
+    def _sleep(self, seconds):
+        """
+        Sleeps for `seconds` between passes, returning early if triggered.
+        """
+        deadline = time.time() + seconds
+        with self._control:
+            (self._status, self._resume_time) = ('sleeping', deadline)
+            while not self._triggered and time.time() < deadline:
+                self._control.wait(deadline - time.time())
+            (self._status, self._resume_time) = ('running', None)
+            
     def _within_window(self, windows):
         """
         Provides a boolean value indicating whether the thread can execute or not.
@@ -115,42 +304,587 @@ class _Maintainer(threading.Thread):
                 return True
         return False
         
+class _TokenBucket(object):
+    """
+    Limits consumption to `rate` units per second, allowing bursts of up to a second's worth.
+    
+    Consumption beyond what's available is borrowed against future refills, with the consumer
+    sleeping until the debt is repaid, so that large requests are never starved by small ones.
+    """
+    _rate = 0.0 #Units added per second; 0 means unlimited
+    _tokens = 0.0 #Units available; negative while in debt
+    _updated = 0.0 #When `_tokens` was last refilled
+    _lock = None #Guards `_tokens`
+    
+    def __init__(self, rate):
+        self._rate = rate
+        self._tokens = rate
+        self._updated = time.time()
+        self._lock = threading.Lock()
+        
+    def consume(self, amount, scale=1.0):
+        """
+        Takes `amount` units, sleeping as long as needed to stay within the rate, divided by
+        `scale`, returning the number of seconds spent sleeping.
+        """
+        if not self._rate or not amount:
+            return 0.0
+        rate = self._rate / scale
+        with self._lock:
+            current_time = time.time()
+            self._tokens = min(rate, self._tokens + (current_time - self._updated) * rate) - amount
+            self._updated = current_time
+            delay = -self._tokens / rate
+        if delay > 0:
+            time.sleep(delay)
+            return delay
+        return 0.0
+        
+class _Budget(object):
+    """
+    Holds a maintainer to its configured rates of bytes read, operations, and database queries per
+    second, shared by all of its threads, scaled down while the webservice is under pressure.
+    """
+    waited = 0.0 #The number of seconds spent waiting for the budget to allow work
+    _buckets = None #A token-bucket for each kind of work
+    
+    def __init__(self, name):
+        self._buckets = dict(
+         (kind, _TokenBucket(rate))
+         for (kind, rate) in CONFIG.maintainer_budget(name).items()
+        )
+        
+    def throttle(self, bytes=0, ops=0, queries=0):
+        """
+        Blocks until the given amounts of work are allowed.
+        """
+        scale = load.get_pressure()
+        for (kind, amount) in (('bytes', bytes), ('ops', ops), ('queries', queries)):
+            self.waited += self._buckets[kind].consume(amount, scale)
+            
+    def reader(self, data):
+        """
+        Wraps the file-like `data` so that everything read through it is charged to the budget.
+        """
+        return _BudgetedReader(data, self)
+        
+class _BudgetedReader(object):
+    """
+    A read-only file-like wrapper that charges everything read through it to a ``_Budget``.
+    """
+    _data = None #The wrapped file-like object
+    _budget = None #The budget charged
+    
+    def __init__(self, data, budget):
+        self._data = data
+        self._budget = budget
+        
+    def read(self, size=-1):
+        chunk = self._data.read(size)
+        self._budget.throttle(bytes=len(chunk))
+        return chunk
+        
+    def close(self):
+        self._data.close()
+        
+class _Checkpoint(object):
+    """
+    The progress of a maintainer's sweep, persisted to ``CONFIG.maintainer_checkpoint_path``, so
+    that a sweep interrupted by a restart resumes where it left off, and published through
+    ``get_stats()``.
+    
+    `state` holds the time the sweep 'started', the maintainer-specific 'cursor' from which it
+    continues, the number of items 'examined', and, if known, the fraction of the total covered as
+    'coverage'; once a sweep finishes, the time it was 'completed' and its 'duration' are kept.
+    """
+    state = None #The dictionary described above
+    _name = None #The name of the maintainer
+    _saved = 0.0 #The time at which `state` was last persisted
+    
+    def __init__(self, name):
+        global _CHECKPOINTS
+        self._name = name
+        with _checkpoint_lock:
+            if _CHECKPOINTS is None:
+                _CHECKPOINTS = {}
+                path = CONFIG.maintainer_checkpoint_path
+                if path and os.path.isfile(path):
+                    try:
+                        _CHECKPOINTS = json.load(open(path))
+                    except Exception as e:
+                        _logger.error("Unable to read maintainer checkpoints; sweeps will start over: %(error)s" % {
+                         'error': str(e),
+                        })
+            self.state = _CHECKPOINTS.get(name) or {}
+        _STATS[name] = self.state
+        if self.in_progress:
+            _logger.info("%(name)s resuming sweep started at %(started)i, %(examined)i items in" % {
+             'name': name,
+             'started': self.state['started'],
+             'examined': self.state['examined'],
+            })
+            
+    @property
+    def in_progress(self):
+        """
+        Indicates whether a sweep has been started and not finished.
+        """
+        return 'started' in self.state and not self.state.get('completed', 0) >= self.state['started']
+        
+    def next_sweep(self, sleep):
+        """
+        Provides the time at which the next sweep should start, `sleep` seconds after the last one
+        was completed.
+        """
+        return self.state.get('completed', 0) + sleep
+        
+    def begin(self, total=None):
+        """
+        Starts a new sweep, over `total` items, if known.
+        """
+        self.state.update({
+         'started': time.time(),
+         'cursor': None,
+         'examined': 0,
+         'total': total,
+         'coverage': 0.0 if total else None,
+        })
+        self.save(force=True)
+        
+    def advance(self, cursor, examined):
+        """
+        Notes that the sweep has examined another `examined` items, up to `cursor`, persisting
+        progress at most every ``CONFIG.maintainer_checkpoint_interval`` seconds.
+        """
+        self.state['cursor'] = cursor
+        self.state['examined'] += examined
+        if self.state.get('total'):
+            self.state['coverage'] = min(1.0, float(self.state['examined']) / self.state['total'])
+        self.save()
+        
+    def finish(self):
+        """
+        Notes that the sweep has been completed.
+        """
+        current_time = time.time()
+        self.state.update({
+         'cursor': None,
+         'coverage': 1.0,
+         'completed': current_time,
+         'duration': current_time - self.state['started'],
+        })
+        _logger.info("%(name)s completed sweep of %(examined)i items in %(duration)is" % {
+         'name': self._name,
+         'examined': self.state['examined'],
+         'duration': self.state['duration'],
+        })
+        self.save(force=True)
+        
+    def save(self, force=False):
+        """
+        Writes the checkpoints of every maintainer to disk, atomically, if `force` is set or enough
+        time has passed since the last write.
+        """
+        path = CONFIG.maintainer_checkpoint_path
+        if not path or (not force and time.time() - self._saved < CONFIG.maintainer_checkpoint_interval):
+            return
+        self._saved = time.time()
+        with _checkpoint_lock:
+            _CHECKPOINTS[self._name] = self.state
+            try:
+                target = open(path + '.temp', 'wb')
+                try:
+                    json.dump(_CHECKPOINTS, target)
+                finally:
+                    target.close()
+                os.rename(path + '.temp', path)
+            except Exception as e:
+                _logger.error("Unable to write maintainer checkpoints: %(error)s" % {
+                 'error': str(e),
+                })
+                
+class _Dispatcher(object):
+    """
+    Runs a handler over records on a bounded pool of threads, with no more than a configured number
+    belonging to any one family in flight at once; records beyond that are parked until their
+    family has capacity, and may be refreshed before they're handled, since they may have waited a
+    while.
+    """
+    processed = 0 #The number of records handled successfully
+    failed = 0 #The number of records whose handling failed
+    _handler = None #The function that processes a record, returning True on success
+    _pool = None #The threads on which records are handled
+    _lock = None #A condition that guards the counters and is notified on every completion
+    _outstanding = 0 #The number of records submitted but not yet handled
+    _running = None #The number of records in flight, by family
+    _waiting = None #Records held back by their family's limit, by family
+    _limits = None #The concurrency limit of each family
+    _listener = None #Invoked, without arguments, whenever a record has been handled
+    _refresh = None #Given a parked record when it starts, returning its current state, or None to skip it
+    _parked = 0 #The number of records waiting on their family's limit
+    
+    def __init__(self, workers, handler, listener=None, refresh=None):
+        self._handler = handler
+        self._listener = listener
+        self._refresh = refresh
+        self._pool = multiprocessing.pool.ThreadPool(workers)
+        self._lock = threading.Condition()
+        self._running = {}
+        self._waiting = {}
+        self._limits = {}
+        
+    @property
+    def backlog(self):
+        """
+        The number of records submitted but not yet handled, excluding those that are parked, which
+        don't hold up records of other families.
+        """
+        return self._outstanding - self._parked
+        
+    @property
+    def parked(self):
+        """
+        The number of records waiting on their family's limit.
+        """
+        return self._parked
+        
+    def submit(self, record):
+        """
+        Queues `record` for handling, without blocking.
+        """
+        family = record['physical']['family']
+        if not family in state.get_families(): #Served by the generic filesystem
+            family = None
+        with self._lock:
+            if not family in self._limits:
+                self._limits[family] = max(1, CONFIG.family_concurrency(family))
+            self._outstanding += 1
+            if self._running.get(family, 0) < self._limits[family]:
+                self._start(family, record)
+            else:
+                self._waiting.setdefault(family, collections.deque()).append(record)
+                self._parked += 1
+                
+    def wait(self, limit=0):
+        """
+        Blocks until no more than `limit` submitted records remain unhandled.
+        """
+        with self._lock:
+            while self._outstanding > limit:
+                self._lock.wait()
+                
+    def _start(self, family, record, parked=False):
+        """
+        Hands `record` to the pool; the lock must be held.
+        """
+        self._running[family] = self._running.get(family, 0) + 1
+        self._pool.apply_async(self._handle, (family, record, parked))
+        
+    def _handle(self, family, record, parked):
+        """
+        Processes `record` on a pool thread, then starts the next record waiting on `family`.
+        """
+        success = None
+        try:
+            if parked and self._refresh:
+                current = self._refresh(record)
+            else:
+                current = record
+            if current:
+                success = self._handler(current)
+        except Exception as e:
+            _logger.error("Unable to process record '%(uid)s': %(error)s" % {
+             'uid': record['_id'],
+             'error': str(e),
+            })
+            success = False
+            
+        with self._lock:
+            if success:
+                self.processed += 1
+            elif success is not None:
+                self.failed += 1
+            self._outstanding -= 1
+            self._running[family] -= 1
+            waiting = self._waiting.get(family)
+            if waiting:
+                self._parked -= 1
+                self._start(family, waiting.popleft(), True)
+            self._lock.notify_all()
+        if self._listener:
+            self._listener()
+            
 class _PolicyMaintainer(_Maintainer):
     """
     Provides an abstract definition of the policy-managing maintener threads.
+    
+    Upcoming due-times are kept in a heap, loaded from sorted scans of the policy indexes, and the
+    thread sleeps until the next one arrives or the next rescan, every `_sleep_period` seconds,
+    which picks up new and changed records. Records that fail are retried with exponential backoff.
+    
+    Due records are processed concurrently, by up to `_concurrency` threads, with progress
+    published through ``get_stats()``, within the thread's `_budget`.
     """
+    _dispatcher = None #Processes due records on a pool of threads
+    _lock = None #Guards the schedule, which completing threads update
+    _wake = None #Set when a record finishes, since capacity or the schedule may have changed
+    _heap = None #(due-time, uid) pairs; entries that don't match `_scheduled` are stale
+    _scheduled = None #The due-time of every record in the heap, by uid
+    _in_flight = None #The uids of records being processed
+    _failures = None #The number of consecutive failures of each failing record, by uid
+    _retry_times = None #The time before which each failing record won't be retried, by uid
+    _horizon = 0 #The due-time up to which the heap is known to be complete
+    _until = 0 #The due-time up to which the last full scan was to load records
+    _cursors = None #The (due-time, uid) of the last record read from each index, by field
+    _capped = False #True if the last scan stopped short of the next rescan because the heap filled
+    _rescan = False #True if a rescan was requested by a trigger
+    
     def __init__(self):
         _Maintainer.__init__(self)
+        self._lock = threading.Lock()
+        self._wake = threading.Event()
+        self._heap = []
+        self._scheduled = {}
+        self._in_flight = set()
+        self._failures = {}
+        self._retry_times = {}
+        self._cursors = {}
         
     def run(self):
         """
-        Queries the database, looking for any records that match policy criteria. If any matches are
-        found, they're processed, and the operation continues until no new records are discovered.
+        Processes every record whose policy is due, as it becomes due, while within the thread's
+        execution windows.
         """
+        self._dispatcher = _Dispatcher(self._concurrency, self._handle, self._wake.set, self._refresh)
+        stats = _STATS[self.name] = {
+         'processed': 0,
+         'failed': 0,
+         'backlog': 0,
+         'rate': 0.0,
+         'throttled': 0.0,
+        }
+        next_scan = 0
+        (processed, scanned) = (0, time.time())
         while True:
-            while not self._within_window(self._windows):
-                _logger.debug("Not in execution window; sleeping")
-                time.sleep(60)
+            with self._control:
+                eligible = self._eligible()
+            if not eligible: #Let records in flight finish, then wait for the next window
+                self._dispatcher.wait()
+                self._on_idle()
+                self._wait_for_window()
                 
-            while True:
-                records_processed = False
-                for record in database.enumerate_where({
-                 '$or': [
-                  {self._fixed_field: {'$lt': int(time.time())}},
-                  {self._stale_query: {'$lt': int(time.time())}},
-                 ],
-                }):
-                    _logger.info("Discovered candidate record: %(uid)s" % {
-                     'uid': record['_id'],
-                    })
-                    #Some records may fail to be processed for a variety of reasons; they shouldn't be considered active
-                    records_processed = self._process_record(record) or records_processed
-                if not records_processed: #Nothing left to do
+            current_time = time.time()
+            if self._capped and not self._pending_before(self._horizon): #Load the next stretch
+                self._load(current_time, resume=True)
+            elif current_time >= next_scan or self._rescan:
+                self._rescan = False
+                self._load(current_time)
+                next_scan = current_time + self._sleep_period
+                stats['rate'] = (self._dispatcher.processed - processed) / max(1.0, current_time - scanned)
+                (processed, scanned) = (self._dispatcher.processed, current_time)
+                _logger.info("%(name)s: %(processed)i records processed, %(failed)i failures, %(rate).2f/s" % {
+                 'name': self.name,
+                 'processed': self._dispatcher.processed,
+                 'failed': self._dispatcher.failed,
+                 'rate': stats['rate'],
+                })
+                
+            self._wake.clear()
+            self._dispatch(current_time)
+            with self._lock:
+                due = self._heap and self._heap[0][0] or None
+                stats['processed'] = self._dispatcher.processed
+                stats['failed'] = self._dispatcher.failed
+                stats['backlog'] = self._dispatcher.backlog + self._dispatcher.parked + len([None for (due_time, uid) in self._heap if due_time <= current_time])
+                stats['throttled'] = self._budget.waited
+            if not self._dispatcher.backlog:
+                self._on_idle()
+                if self._triggered and not self._rescan and not (due and due <= current_time): #Nothing left to do
+                    self._complete_pass()
+                    
+            #Sleep until the next record is due, the schedule must be refreshed, or a record
+            #finishes, freeing capacity; but check the window at least once a minute
+            delay = min(next_scan, due or next_scan) - time.time()
+            if delay > 0:
+                self._wake.wait(min(delay, 60))
+            elif due is not None and due <= current_time: #Due records are waiting for capacity
+                self._wake.wait(60)
+                
+    def _load(self, current_time, resume=False):
+        """
+        Scans the policy indexes, in order, for records due before the next rescan, adding them to
+        the heap, up to ``CONFIG.maintainer_schedule_capacity`` entries, shared between the indexes.
+        
+        A full scan rebuilds the heap, keeping only records that are backing off; with `resume`,
+        each index is read onwards from where the last scan stopped. Records that are already
+        scheduled, in flight, or pending (see `_is_pending()`) are passed over without using any
+        of the capacity, so failing records can't crowd out those behind them.
+        """
+        if resume:
+            until = self._until
+        else:
+            until = self._until = current_time + self._sleep_period
+            self._cursors = {}
+            with self._lock: #Entries that are no longer due will be reloaded if still applicable
+                self._heap = [(due_time, uid) for (due_time, uid) in self._heap if uid in self._retry_times and self._scheduled.get(uid) == due_time]
+                heapq.heapify(self._heap)
+                self._scheduled = dict((uid, due_time) for (due_time, uid) in self._heap)
+                
+        capacity = max(1, CONFIG.maintainer_schedule_capacity)
+        horizon = until
+        loaded = 0
+        for field in (self._fixed_field, self._stale_query):
+            after = self._cursors.get(field)
+            while True: #Everything beyond the horizon set by an earlier index is loaded later
+                self._budget.throttle(queries=1)
+                records = list(database.enumerate_due(field, after, horizon, CONFIG.security_query_size))
+                with self._lock:
+                    for record in records:
+                        after = (_get_field(record, field), record['_id'])
+                        uid = record['_id']
+                        if uid in self._scheduled or uid in self._in_flight or self._is_pending(uid):
+                            continue
+                        self._schedule(uid, after[0])
+                        loaded += 1
+                self._cursors[field] = after
+                if len(records) < CONFIG.security_query_size:
+                    break
+                if loaded >= capacity:
+                    horizon = after[0]
                     break
                     
-            _logger.debug("All records processed; sleeping")
-            time.sleep(self._sleep_period)
+        self._horizon = horizon
+        self._capped = horizon < until
+        _logger.debug("%(name)s scheduled %(count)i records due before %(horizon)i" % {
+         'name': self.name,
+         'count': len(self._heap),
+         'horizon': horizon,
+        })
+        
+    def trigger(self):
+        """
+        Requests an immediate rescan and processing of every due record, regardless of windows.
+        """
+        self._rescan = True
+        _Maintainer.trigger(self)
+        
+    def _notify(self):
+        _Maintainer._notify(self)
+        self._wake.set()
+        
+    def _pending_before(self, due_time):
+        """
+        Indicates whether any record in the heap is due by `due_time`.
+        """
+        with self._lock:
+            return bool(self._heap) and self._heap[0][0] <= due_time
             
+    def _schedule(self, uid, due_time):
+        """
+        Adds `uid` to the heap at `due_time`, or later if it's backing off; the lock must be held.
+        """
+        if uid in self._in_flight:
+            return
+        due_time = max(due_time, self._retry_times.get(uid, 0))
+        if due_time < self._scheduled.get(uid, due_time + 1):
+            self._scheduled[uid] = due_time
+            heapq.heappush(self._heap, (due_time, uid))
+            
+    def _dispatch(self, current_time):
+        """
+        Submits every record that is due by `current_time`, while the dispatcher has capacity.
+        """
+        while self._dispatcher.backlog < self._concurrency * 2:
+            with self._lock:
+                if not self._heap or self._heap[0][0] > current_time:
+                    return
+                (due_time, uid) = heapq.heappop(self._heap)
+                if not self._scheduled.get(uid) == due_time: #Superseded
+                    continue
+                del self._scheduled[uid]
+                
+            self._budget.throttle(ops=1, queries=1)
+            record = database.get_record(uid)
+            if not record: #Removed in the meantime
+                continue
+            due_time = self._get_due_time(record)
+            if due_time is None: #Policy cleared in the meantime
+                continue
+            with self._lock:
+                if due_time > current_time: #Changed in the meantime, as by an access
+                    if due_time <= self._horizon:
+                        self._schedule(uid, due_time)
+                    continue
+                if uid in self._in_flight or self._is_pending(uid): #Already being handled
+                    continue
+                self._in_flight.add(uid)
+            _logger.info("Discovered candidate record: %(uid)s" % {
+             'uid': uid,
+            })
+            self._dispatcher.submit(record)
+            
+    def _get_due_time(self, record):
+        """
+        Provides the time at which `record`'s policy becomes due, or ``None`` if it has none.
+        """
+        times = [t for t in (_get_field(record, self._fixed_field), _get_field(record, self._stale_query)) if t is not None]
+        return times and min(times) or None
+        
+    def _refresh(self, record):
+        """
+        Re-reads `record`, which was parked behind its family's limit, on a dispatcher thread,
+        providing it if it's still due, or rescheduling it and providing ``None`` if not.
+        """
+        uid = record['_id']
+        self._budget.throttle(queries=1)
+        record = database.get_record(uid)
+        due_time = record and self._get_due_time(record)
+        if due_time is not None and due_time <= time.time():
+            return record
+        with self._lock: #Changed or removed while parked
+            self._in_flight.discard(uid)
+            if due_time is not None and due_time <= self._horizon:
+                self._schedule(uid, due_time)
+        return None
+        
+    def _handle(self, record):
+        """
+        Processes `record` on a dispatcher thread, scheduling a retry if that fails.
+        """
+        uid = record['_id']
+        success = False
+        try:
+            success = self._process_record(record)
+            return success
+        finally:
+            with self._lock:
+                self._in_flight.discard(uid)
+                if success:
+                    self._failures.pop(uid, None)
+                    self._retry_times.pop(uid, None)
+                else:
+                    failures = self._failures[uid] = self._failures.get(uid, 0) + 1
+                    delay = min(CONFIG.maintainer_policy_retry_max_delay, CONFIG.maintainer_policy_retry_delay * 2 ** (failures - 1))
+                    _logger.info("Record '%(uid)s' could not be processed; retrying in %(delay)is" % {
+                     'uid': uid,
+                     'delay': delay,
+                    })
+                    self._retry_times[uid] = time.time() + delay
+                    self._schedule(uid, self._retry_times[uid])
+                    
+    def _is_pending(self, uid):
+        """
+        Indicates whether the record identified by `uid` has been processed but is awaiting deferred
+        work, so it mustn't be scheduled again; the schedule's lock is held.
+        """
+        return False
+        
+    def _on_idle(self):
+        """
+        Called by the scheduling thread whenever no records are being processed; override this to
+        complete any deferred work.
+        """
+        
     def _process_record(self, record):
         """
         Performs any policy-specific actions on the given `record`.
@@ -160,33 +894,98 @@ class _PolicyMaintainer(_Maintainer):
 class DeletionMaintainer(_PolicyMaintainer):
     """
     Removes records and files when their policy settings say they should be deleted.
+    
+    Files are unlinked concurrently, as records come due, while the records themselves are dropped
+    in batches of `_batch_size`, or whenever the thread goes idle, after which the directories
+    that held the batch's files are pruned, each only once.
     """
+    _batch = None #Records whose files have been unlinked, awaiting removal from the database
+    _batched = None #The uids of records in `_batch` or being dropped
+    _batch_lock = None #Guards `_batch` and `_batched`
+    
     def __init__(self):
         _PolicyMaintainer.__init__(self)
         self.name = 'deletion-maintainer'
+        self._budget = _Budget('deletion')
         self._windows = DELETION_WINDOWS
         self._stale_query = 'policy.delete.staleTime'
         self._fixed_field = 'policy.delete.fixed'
         self._sleep_period = CONFIG.maintainer_deletion_sleep
+        self._concurrency = CONFIG.maintainer_deletion_concurrency
+        self._batch_size = CONFIG.maintainer_deletion_batch_size
+        self._batch = []
+        self._batched = set()
+        self._batch_lock = threading.Lock()
         
     def _process_record(self, record):
         """
-        Determines whether the given `record` is a candidate for deletion, removing it and the
-        associated file if it is.
+        Determines whether the given `record` is a candidate for deletion, removing the associated
+        file and queuing the record for removal if it is.
         """
         _logger.info("Unlinking record...")
-        filesystem = state.get_filesystem(record['physical']['family'])
+        fs = state.get_filesystem(record['physical']['family'])
         try:
-            filesystem.unlink(record)
+            fs.unlink(record, prune=False)
+        except filesystem.FileNotFoundError: #Unlinked before the record could be dropped
+            _logger.info("File for '%(uid)s' already unlinked" % {
+             'uid': record['_id'],
+            })
         except Exception as e:
             _logger.warn("Unable to unlink record: %(error)s" % {
              'error': str(e),
             })
             return False
-        else:
-            database.drop_record(record['_id'])
-            return True
             
+        with self._batch_lock:
+            self._batch.append(record)
+            self._batched.add(record['_id'])
+            full = len(self._batch) >= self._batch_size
+        if full:
+            self._drop_batch()
+        return True
+        
+    def _is_pending(self, uid):
+        with self._batch_lock:
+            return uid in self._batched
+            
+    def _on_idle(self):
+        self._drop_batch()
+        
+    def _drop_batch(self):
+        """
+        Removes every queued record from the database and prunes the directories that held them.
+        
+        If the records can't be dropped, they'll be found again, and, with their files already
+        gone, requeued.
+        """
+        with self._batch_lock:
+            (batch, self._batch) = (self._batch, [])
+        if not batch:
+            return
+            
+        self._budget.throttle(queries=1)
+        try:
+            database.drop_records([record['_id'] for record in batch])
+        except Exception as e:
+            _logger.error("Unable to drop %(count)i unlinked records; they will be retried: %(error)s" % {
+             'count': len(batch),
+             'error': str(e),
+            })
+        finally:
+            with self._batch_lock:
+                self._batched.difference_update(record['_id'] for record in batch)
+                
+        families = {}
+        for record in batch:
+            families.setdefault(record['physical']['family'], []).append(record)
+        for (family, records) in families.items():
+            try:
+                state.get_filesystem(family).prune(records)
+            except Exception as e:
+                _logger.warn("Unable to prune directories: %(error)s" % {
+                 'error': str(e),
+                })
+                
 class CompressionMaintainer(_PolicyMaintainer):
     """
     Compresses files when their policy settings say they should be compressed.
@@ -194,15 +993,21 @@ class CompressionMaintainer(_PolicyMaintainer):
     def __init__(self):
         _PolicyMaintainer.__init__(self)
         self.name = 'compression-maintainer'
+        self._budget = _Budget('compression')
         self._stale_query = 'policy.compress.staleTime'
         self._fixed_field = 'policy.compress.fixed'
         self._sleep_period = CONFIG.maintainer_compression_sleep
+        self._concurrency = CONFIG.maintainer_compression_concurrency
         self._windows = COMPRESSION_WINDOWS
         
     def _process_record(self, record):
         """
         Determines whether the given `record` is a candidate for compression, compressing the
         associated file and updating the record if it is.
+        
+        Only the fields compression affects are written, and only if the record's family and format
+        are still as they were read, so that a migration or another change made in the meantime is
+        never undone; the work is backed out instead, to be reconsidered later.
         """
         _logger.info("Compressing record '%(uid)s'..." % {
          'uid': record['_id'],
@@ -211,9 +1016,8 @@ class CompressionMaintainer(_PolicyMaintainer):
         target_compression = record['policy']['compress'].get('comp')
         if current_compression == target_compression:
             _logger.debug("File already compressed in target format")
-            record['policy']['compress'].clear() #Drop the compression policy
             try:
-                database.update_record(record)
+                self._update(record, {'policy.compress': {}}) #Drop the compression policy
             except Exception as e:
                 _logger.error("Unable to update record to reflect already-applied compression; compression routine will retry later: %(error)s" % {
                  'error': str(e),
@@ -222,100 +1026,235 @@ class CompressionMaintainer(_PolicyMaintainer):
             else:
                 return True
                 
-        filesystem = state.get_filesystem(record['physical']['family'])
-        data = filesystem.get(record)
+        fs = state.get_filesystem(record['physical']['family'])
+        options = fs.get_compression_options(target_compression, record['policy']['compress'].get('options'))
+        data = fs.get(record, cache=False)
         if current_compression: #Must be decompressed first
             _logger.info("Decompressing file...")
-            data = compression.get_decompressor(current_compression)(data)
-        data = compression.get_compressor(target_compression)(data)
+            data = compression.get_stream_decompressor(current_compression)(data)
+        else:
+            saving = self._probe(record, data, target_compression, options)
+            if saving is not None:
+                data.close()
+                return self._skip(record, target_compression, saving)
+        #Reading, (de)compression, hashing, and writing happen together, a chunk at a time
+        source = filesystem.CountingReader(self._budget.reader(data))
+        data = filesystem.HashingReader(
+         compression.get_stream_compressor(target_compression, workers=CONFIG.maintainer_compression_workers, options=options)(source)
+        )
         
         _logger.info("Updating entity...")
-        old_format = record['physical']['format'].copy()
-        record['physical']['format']['comp'] = target_compression
+        physical = record['physical']
         try:
-            filesystem.put(record, data, tempfile=True)
+            try:
+                fs.put(record, data, tempfile=True)
+            finally:
+                data.close()
         except Exception as e: #Harmless backout point
-            _logger.warn("Unable to write compressed file to disk; backing out with no consequences")
+            _logger.warn("Unable to write compressed file to disk; backing out with no consequences: %(error)s" % {
+             'error': str(e),
+            })
             return False
-        else:
-            old_compression_policy = record['policy']['compress'].copy()
-            record['policy']['compress'].clear() #Drop the compression policy
+            
+        self._budget.throttle(queries=1)
+        try:
+            updated = self._update(record, {
+             'physical.format.comp': target_compression,
+             'physical.storedHash': data.hexdigest(),
+             'physical.size': source.size,
+             'physical.storedSize': data.size,
+             'policy.compress': {}, #Drop the compression policy
+            })
+        except Exception as e: #Results in wasted space until the next attempt
+            _logger.error("Unable to update record; old file will be served, and new file will be replaced on a subsequent compression attempt: %(error)s" % {
+             'error': str(e),
+            })
+            return False
+        if not updated:
+            self._discard(fs, record)
+            return True
+            
+        try:
+            fs.make_permanent(record)
+        except Exception as e:
+            _logger.error("Unable to update on-disk file; rolling back database update: %(error)s" % {
+             'error': str(e),
+            })
             try:
-                database.update_record(record)
-            except Exception as e: #Results in wasted space until the next attempt
-                _logger.error("Unable to update record; old file will be served, and new file will be replaced on a subsequent compression attempt: %(error)s" % {
+                database.update_fields(record['_id'], {
+                 'physical.format.comp': current_compression,
+                 'physical.storedHash': physical.get('storedHash'),
+                 'physical.size': physical.get('size'),
+                 'physical.storedSize': physical.get('storedSize'),
+                 'policy.compress': record['policy']['compress'],
+                }, expected={
+                 'physical.format.comp': target_compression,
+                 'physical.storedHash': data.hexdigest(),
+                })
+            except Exception as e:
+                _logger.error("Unable to roll back database update; '%(uid)s' is inaccessible and must be manually decompressed from '%(comp)s' format: %(error)s" % {
                  'error': str(e),
+                 'uid': record['_id'],
+                 'comp': target_compression,
                 })
-                return False
-            else:
-                try:
-                    filesystem.make_permanent(record)
-                except Exception as e:
-                    _logger.error("Unable to update on-disk file; rolling back database update: %(error)s" % {
-                     'error': str(e),
-                    })
-                    record['policy']['compress'] = old_compression_policy
-                    record['physical']['format'] = old_format
-                    try:
-                        database.update_record(record)
-                    except Exception as e:
-                        _logger.error("Unable to roll back database update; '%(uid)s' is inaccessible and must be manually decompressed from '%(comp)s' format: %(error)s" % {
-                         'error': str(e),
-                         'uid': record['_id'],
-                         'comp': target_compression,
-                        })
-                    return False
-                    
-                record['physical']['format'] = old_format
-                try:
-                    filesystem.unlink(record)
-                except Exception as e: #Results in wasted space, but non-fatal
-                    _logger.error("Unable to unlink old file; space occupied by '%(uid)s' non-recoverable unless unlinked manually: %(family)r | %(file)s : %(error)s" % {
-                     'family': record['physical']['family'],
-                     'file': filesystem.resolve_path(record),
-                     'uid': record['_id'],
-                     'error': str(e),
-                    })
-                return True
+            return False
+            
+        #The old file was replaced when the new one was made permanent
+        return True
+        
+    def _update(self, record, changes):
+        """
+        Applies `changes` to `record` in the database, provided that its family and format haven't
+        changed since it was read, returning a boolean value that indicates whether they were.
+        """
+        if database.update_fields(record['_id'], changes, expected={
+         'physical.family': record['physical']['family'],
+         'physical.format.comp': record['physical']['format'].get('comp'),
+         'physical.storedSize': record['physical'].get('storedSize'),
+        }):
+            return True
+        _logger.info("Record '%(uid)s' changed during compression; it will be reconsidered later" % {
+         'uid': record['_id'],
+        })
+        return False
+        
+    def _discard(self, fs, record):
+        """
+        Removes the compressed copy of `record` written to `fs`, which won't be used.
+        """
+        try:
+            fs.discard(record)
+        except Exception as e: #Wasted space, but nothing refers to the file
+            _logger.error("Unable to unlink unused compressed copy of '%(uid)s'; it must be removed manually: %(error)s" % {
+             'uid': record['_id'],
+             'error': str(e),
+            })
+            
+    def _probe(self, record, data, target_compression, options):
+        """
+        Determines whether compressing `data`, the uncompressed content of `record`, with the given
+        tuning `options`, is worthwhile, returning ``None`` if it is, or the expected fractional
+        saving otherwise.
+        
+        Content with a MIME-type known to be compressed already is rejected without being read.
+        """
+        mime = record['physical']['format']['mime']
+        for incompressible in CONFIG.maintainer_compression_incompressible_mimes:
+            if mime == incompressible or (incompressible.endswith('/') and mime.startswith(incompressible)):
+                _logger.info("MIME-type %(mime)s is not considered compressible" % {
+                 'mime': mime,
+                })
+                return 0.0
                 
+        saving = compression.estimate_saving(data, target_compression, options=options)
+        _logger.debug("Sampled saving for '%(uid)s' in '%(comp)s' format: %(saving).3f" % {
+         'uid': record['_id'],
+         'comp': target_compression,
+         'saving': saving,
+        })
+        if saving < CONFIG.maintainer_compression_min_saving:
+            return saving
+        return None
+        
+    def _skip(self, record, target_compression, saving):
+        """
+        Drops the compression policy of `record`, noting why, so that it is not reconsidered.
+        """
+        _logger.info("Compression of '%(uid)s' would save too little space (%(saving).3f); skipping" % {
+         'uid': record['_id'],
+         'saving': saving,
+        })
+        try:
+            self._update(record, {
+             'policy.compress': {},
+             'stats.compressionSkipped': {
+              'comp': target_compression,
+              'saving': saving,
+              'time': int(time.time()),
+             },
+            })
+        except Exception as e:
+            _logger.error("Unable to update record to reflect skipped compression; compression routine will retry later: %(error)s" % {
+             'error': str(e),
+            })
+            return False
+        return True
+        
 class DatabaseMaintainer(_Maintainer):
     """
     Iterates over the database and removes records that are not associated with filesystem entries.
+    
+    Records arrive in ctime order, so each page falls into a handful of time-bucket directories;
+    each directory is listed once and the page is checked against the listings in memory. Records
+    in the 'hashed' layout, which could be in any directory, are checked individually.
+    
+    The ctime reached is checkpointed, so a sweep survives restarts.
     """
     def __init__(self):
         _Maintainer.__init__(self)
         self.name = 'database-maintainer'
+        self._windows = DATABASE_WINDOWS
+        self._budget = _Budget('database')
         
     def run(self):
         """
         Cycles through every database record in order, removing any records associated
         with files that do not exist.
         """
-        ctime = -1.0
+        checkpoint = _Checkpoint(self.name)
+        listings = {} #Directory listings, by family, then directory
         while True:
-            while not self._within_window(DATABASE_WINDOWS):
-                _logger.debug("Not in execution window; sleeping" % {
-                 'name': self.name,
-                })
-                time.sleep(60)
+            if not checkpoint.in_progress:
+                delay = checkpoint.next_sweep(CONFIG.maintainer_database_sleep) - time.time()
+                if delay > 0:
+                    _logger.debug("All records processed; sleeping")
+                    self._sleep(delay)
+                self._budget.throttle(queries=1)
+                checkpoint.begin(total=database.count_where({}))
+                listings.clear()
                 
-            records_retrieved = False
-            for record in database.enumerate_all(ctime):
-                ctime = record['physical']['ctime']
-                records_retrieved = True
-                
-                filesystem = state.get_filesystem(record['physical']['family'])
-                if not filesystem.file_exists(record):
-                    _logger.warn("Discovered database record for '%(uid)s' without matching file; dropping record..." % {
-                     'uid': record['_id'],
-                    })
-                    database.drop_record(record['_id'])
-                    
-            if not records_retrieved: #Cycle complete
-                _logger.debug("All records processed; sleeping")
-                time.sleep(CONFIG.maintainer_database_sleep)
+            self._wait_for_window()
+            
+            ctime = checkpoint.state['cursor']
+            if ctime is None:
                 ctime = -1.0
+            self._budget.throttle(queries=1)
+            records = list(database.enumerate_all(ctime, limit=CONFIG.maintainer_database_batch_size))
+            if not records: #Cycle complete
+                checkpoint.finish()
+                self._complete_pass()
+                continue
                 
+                
+            families = {}
+            for record in records:
+                families.setdefault(record['physical']['family'], []).append(record)
+            for (family, family_records) in families.items():
+                family_listings = listings.setdefault(family, {})
+                if len(family_listings) > _LISTING_CACHE_SIZE: #Older buckets won't come up again
+                    family_listings.clear()
+                fs = state.get_filesystem(family)
+                listed = len(family_listings)
+                family_missing = fs.find_missing(family_records, family_listings)
+                examined = len([record for record in family_records if record['physical'].get('layout') == 'hashed'])
+                self._budget.throttle(ops=len(family_listings) - listed + examined) #Charged after the fact
+                for record in family_missing:
+                    self._budget.throttle(ops=1)
+                    if not fs.file_exists(record): #Confirm, in case it was written after the listing
+                        _logger.warn("Discovered database record for '%(uid)s' without matching file; dropping record..." % {
+                         'uid': record['_id'],
+                        })
+                        self._budget.throttle(queries=1)
+                        if not database.drop_record(record['_id'], expected={
+                         'physical.family': record['physical']['family'],
+                         'physical.format.comp': record['physical']['format'].get('comp'),
+                        }):
+                            _logger.info("Record '%(uid)s' was migrated or recompressed meanwhile; leaving it" % {
+                             'uid': record['_id'],
+                            })
+            checkpoint.advance(records[-1]['physical']['ctime'], len(records))
+            
+            
 class FilesystemMaintainer(_Maintainer):
     """
     Iterates over the filesystem and removes files that are not associated with database records.
@@ -323,69 +1262,665 @@ class FilesystemMaintainer(_Maintainer):
     This thread should be disabled by default, since it would allow for the deletion of all data if
     the Mongo database is dropped for any reason, and, in smaller data-centres, a full filesystem
     backup may not exist.
+    
+    Families are walked in order, and the family and directory reached are checkpointed, so a
+    sweep survives restarts, and one that fails partway is resumed from there.
     """
     def __init__(self):
         _Maintainer.__init__(self)
         self.name = 'filesystem-maintainer'
+        self._windows = FILESYSTEM_WINDOWS
+        self._budget = _Budget('filesystem')
         
     def run(self):
         """
         Cycles through every filesystem entry in order, removing any files associated
         with database records that do not exist.
         """
+        checkpoint = _Checkpoint(self.name)
         while True:
-            for family in state.get_families():
+            if not checkpoint.in_progress:
+                delay = checkpoint.next_sweep(CONFIG.maintainer_filesystem_sleep) - time.time()
+                if delay > 0:
+                    _logger.debug("All records processed; sleeping")
+                    self._sleep(delay)
+                checkpoint.begin()
+                
+            cursor = checkpoint.state['cursor'] or {}
+            complete = True
+            for family in sorted(state.get_families()): #None comes first
+                if cursor and family < cursor['family']: #Already walked
+                    continue
                 _logger.info("Processing family %(family)r..." % {
                  'family': family,
                 })
-                filesystem = state.get_filesystem(family)
-                self._walk(filesystem.walk())
+                fs = state.get_filesystem(family)
+                after = cursor and family == cursor['family'] and cursor['path'] or None
+                if not self._walk(fs, fs.walk(after), checkpoint, family):
+                    complete = False
+                    break
+            if complete:
+                checkpoint.finish()
+                self._complete_pass()
+            else: #The cursor is left where the walk stopped, to be resumed from there
+                checkpoint.save(force=True)
+                self._sleep(CONFIG.maintainer_filesystem_retry_delay)
                 
-            _logger.debug("All records processed; sleeping")
-            time.sleep(CONFIG.maintainer_filesystem_sleep)
-            
-    def _walk(self, walker):
+    def _walk(self, fs, walker, checkpoint, family):
         """
         Traverses the filesystem by iterating over `walker`, checking with the database to ensure
-        that every encountered file has a corresponding record. If not, the file is unlinked.
+        that every encountered file has a corresponding record, one directory at a time. If not,
+        the file is unlinked.
+        
+        Each directory is recorded in `checkpoint`, as part of `family`, once it has been checked.
+        
+        A boolean value is returned, indicating whether the traversal was completed.
         """
+        batch_size = CONFIG.maintainer_filesystem_batch_size
         try:
             for (path, files) in walker:
-                for filename in files:
+                self._wait_for_window()
+                
+                self._budget.throttle(ops=1)
+                for i in xrange(0, len(files), batch_size):
+                    self._budget.throttle(queries=1)
                     try:
-                        if not self._keep_file(filename):
-                            _logger.warn("Discovered orphaned file '%(name)s'; unlinking..." % {
-                             'name': filename,
-                            })
-                            try:
-                                filesystem.unlink(path + '/' + filename)
-                            except Exception as e:
-                                _logger.warn("Unable to unlink file: %(error)s" % {
-                                 'error': str(e),
-                                })
+                        orphans = self._find_orphans(files[i:i + batch_size])
                     except Exception as e:
                         _logger.warn("Unable to query database: %(error)s" % {
                          'error': str(e),
                         })
+                        continue
+                        
+                    for filename in orphans:
+                        _logger.warn("Discovered orphaned file '%(name)s'; unlinking..." % {
+                         'name': filename,
+                        })
+                        self._budget.throttle(ops=1)
+                        try:
+                            fs.unlink_path(path + '/' + filename)
+                        except Exception as e:
+                            _logger.warn("Unable to unlink file: %(error)s" % {
+                             'error': str(e),
+                            })
+                checkpoint.advance({'family': family, 'path': path}, len(files))
         except Exception as e:
-            _logger.warn("Unable to traverse filesystem: %(error)s" % {
+            _logger.error("Unable to traverse %(family)r; the sweep will resume from the last directory checked: %(error)s" % {
+             'family': family,
+             'error': str(e),
+            })
+            return False
+        return True
+        
+    def _find_orphans(self, filenames):
+        """
+        Determines, through a single database query, which of the given `filenames` have no
+        corresponding database record, returning them as a list.
+        """
+        uids = [filename.split('.', 1)[0] for filename in filenames] #Strip any temporary marking
+        existing = database.find_existing(set(uids))
+        return [filename for (filename, uid) in zip(filenames, uids) if not uid in existing]
+        
+        
+class AccountingMaintainer(_Maintainer):
+    """
+    Makes a single pass over every record that predates size accounting, measuring its content and
+    recording `physical.size` and `physical.storedSize`, then exits.
+    """
+    def __init__(self):
+        _Maintainer.__init__(self)
+        self.name = 'accounting-maintainer'
+        self._windows = ACCOUNTING_WINDOWS
+        self._budget = _Budget('accounting')
+        
+    def run(self):
+        """
+        Cycles through every unmeasured record in order of ctime, measuring each one's file.
+        """
+        ctime = -1.0
+        measured = 0
+        while True:
+            self._wait_for_window()
+            
+            records_retrieved = False
+            for record in database.enumerate_where({
+             'physical.ctime': {'$gt': ctime},
+             '$or': [
+              {'physical.size': {'$exists': False}},
+              {'physical.storedSize': {'$exists': False}},
+             ],
+            }):
+                ctime = record['physical']['ctime']
+                records_retrieved = True
+                self._budget.throttle(ops=1, queries=1)
+                try:
+                    self._measure(record)
+                except Exception as e: #Usually a missing file, which the database maintainer handles
+                    _logger.warn("Unable to measure '%(uid)s': %(error)s" % {
+                     'uid': record['_id'],
+                     'error': str(e),
+                    })
+                else:
+                    measured += 1
+                    
+            if not records_retrieved: #Pass complete
+                _logger.info("Size accounting complete; %(count)i records measured" % {
+                 'count': measured,
+                })
+                with self._control:
+                    (self._status, self._triggered) = ('finished', False)
+                return
+                
+    def _measure(self, record):
+        """
+        Determines the uncompressed and on-disk sizes of `record`'s content, updating the record,
+        provided that its family and format haven't changed in the meantime.
+        """
+        fs = state.get_filesystem(record['physical']['family'])
+        data = fs.get(record, cache=False)
+        try:
+            data.seek(0, 2)
+            stored_size = data.tell()
+            data.seek(0)
+            
+            current_compression = record['physical']['format'].get('comp')
+            if not current_compression:
+                size = stored_size
+            elif current_compression == compression.COMPRESS_GZ_INDEXED: #The footer says
+                size = compression.IndexedReader(data).size
+            else:
+                data = filesystem.CountingReader(compression.get_stream_decompressor(current_compression)(self._budget.reader(data)))
+                while data.read(_MEASURE_CHUNK_SIZE):
+                    pass
+                size = data.size
+        finally:
+            data.close()
+            
+        if not database.update_fields(record['_id'], {
+         'physical.size': size,
+         'physical.storedSize': stored_size,
+        }, expected={
+         'physical.format.comp': current_compression,
+         'physical.family': record['physical']['family'],
+        }):
+            _logger.info("Record '%(uid)s' changed while being measured; leaving it for a later pass" % {
+             'uid': record['_id'],
+            })
+            
+class MigrationMaintainer(_Maintainer):
+    """
+    Moves content between families, according to ``CONFIG.family_migration()``, so that, for
+    example, content that hasn't been accessed in a month leaves fast storage for slower storage.
+    
+    Each file is streamed into its new family and verified; the record is then switched over only
+    if it hasn't changed in the meantime, after which the old file is unlinked.
+    """
+    def __init__(self):
+        _Maintainer.__init__(self)
+        self.name = 'migration-maintainer'
+        self._windows = MIGRATION_WINDOWS
+        self._budget = _Budget('migration')
+        
+    def run(self):
+        """
+        Periodically sweeps every family with a migration rule, least recently accessed content
+        first, moving everything that has been idle long enough.
+        """
+        dispatcher = _Dispatcher(CONFIG.maintainer_migration_concurrency, self._move)
+        stats = _STATS[self.name] = {
+         'migrated': 0,
+         'failed': 0,
+        }
+        while True:
+            self._wait_for_window()
+            for family in sorted(state.get_families()):
+                rule = CONFIG.family_migration(family)
+                if not rule:
+                    continue
+                if not rule[0] in state.get_families():
+                    _logger.error("Unable to migrate %(family)r content to unknown family %(target)r" % {
+                     'family': family,
+                     'target': rule[0],
+                    })
+                    continue
+                self._sweep(dispatcher, family, rule[1])
+            dispatcher.wait()
+            stats['migrated'] = dispatcher.processed
+            stats['failed'] = dispatcher.failed
+            self._complete_pass()
+            self._sleep(CONFIG.maintainer_migration_sleep)
+            
+    def _sweep(self, dispatcher, family, idle):
+        """
+        Moves every record in `family` that hasn't been accessed for `idle` seconds, a page at a
+        time, in order of access.
+        """
+        query = {
+         'physical.family': family,
+         'physical.atime': {'$lt': time.time() - idle},
+        }
+        after = None
+        while True:
+            self._wait_for_window()
+            self._budget.throttle(queries=1)
+            records = list(database.enumerate_by_atime(query, after, CONFIG.security_query_size))
+            if not records:
+                return
+            after = (records[-1]['physical']['atime'], records[-1]['_id'])
+            for record in records:
+                dispatcher.submit(record)
+            dispatcher.wait(CONFIG.security_query_size) #Keep about a page queued while fetching the next
+            
+    def _move(self, record):
+        """
+        Copies `record`'s file to the family named by its family's rule, then points the record at
+        it, returning True on success.
+        """
+        physical = record['physical']
+        target = CONFIG.family_migration(physical['family'])[0]
+        _logger.info("Migrating '%(uid)s' from %(family)r to %(target)r..." % {
+         'uid': record['_id'],
+         'family': physical['family'],
+         'target': target,
+        })
+        source_fs = state.get_filesystem(physical['family'])
+        target_fs = state.get_filesystem(target)
+        moved = record.copy()
+        moved['physical'] = physical.copy()
+        moved['physical']['family'] = target
+        moved['physical']['layout'] = target_fs.layout
+        
+        self._budget.throttle(ops=1)
+        data = filesystem.HashingReader(self._budget.reader(source_fs.get(record, cache=False)))
+        try:
+            target_fs.put(moved, data) #Nothing refers to the new file until the record is updated
+        except Exception:
+            self._discard(target_fs, moved)
+            raise
+        finally:
+            data.close()
+        if data.hexdigest() != physical.get('storedHash', data.hexdigest()) or data.size != physical.get('storedSize', data.size):
+            _logger.error("Copy of '%(uid)s' does not match its record; abandoning migration" % {
+             'uid': record['_id'],
+            })
+            self._discard(target_fs, moved)
+            return False
+            
+        self._budget.throttle(queries=1)
+        if not database.update_fields(record['_id'], {
+         'physical.family': target,
+         'physical.layout': target_fs.layout,
+         'physical.storedSize': data.size, #Filled in for records that predate them
+         'physical.storedHash': data.hexdigest(),
+        }, expected={
+         'physical.family': physical['family'],
+         'physical.format.comp': physical['format'].get('comp'),
+         'physical.storedSize': physical.get('storedSize'),
+         'physical.storedHash': physical.get('storedHash'),
+        }):
+            _logger.info("Record '%(uid)s' changed during migration; it will be reconsidered later" % {
+             'uid': record['_id'],
+            })
+            self._discard(target_fs, moved)
+            return False
+            
+        try:
+            source_fs.unlink(record)
+        except Exception as e: #Wasted space, but nothing refers to the file any more
+            _logger.error("Unable to unlink migrated file for '%(uid)s'; it must be removed manually: %(error)s" % {
+             'uid': record['_id'],
+             'error': str(e),
+            })
+        return True
+        
+    def _discard(self, fs, record):
+        """
+        Removes the copy of `record` written, perhaps only in part, to `fs` by an abandoned migration.
+        """
+        try:
+            fs.unlink(record)
+        except filesystem.FileNotFoundError: #Never created
+            pass
+        except Exception as e: #Wasted space, but nothing refers to the file
+            _logger.error("Unable to unlink abandoned copy of '%(uid)s' in %(family)r; it must be removed manually: %(error)s" % {
+             'uid': record['_id'],
+             'family': record['physical']['family'],
              'error': str(e),
             })
             
-    def _keep_file(self, filename):
+class EvictionMaintainer(_Maintainer):
+    """
+    Watches how full each family's storage is and, when it passes the high watermark, deletes
+    content that would eventually be deleted as stale anyway, least recently accessed first, until
+    it falls below the low watermark; content pinned through its metadata is never evicted.
+    """
+    def __init__(self):
+        _Maintainer.__init__(self)
+        self.name = 'eviction-maintainer'
+        self._windows = EVICTION_WINDOWS
+        self._budget = _Budget('eviction')
+        
+    def run(self):
         """
-        Determines, through a database query, whether the given `filename` has a corresponding
-        database record.
+        Checks every family's usage periodically, evicting content from any that are too full.
         """
-        while not self._within_window(FILESYSTEM_WINDOWS):
-            _logger.debug("Not in execution window; sleeping")
-            time.sleep(60)
+        stats = _STATS[self.name] = {
+         'evicted': 0,
+         'usage': {},
+        }
+        while True:
+            self._wait_for_window()
+            for family in sorted(state.get_families()):
+                fs = state.get_filesystem(family)
+                try:
+                    usage = stats['usage'][family or ''] = fs.get_usage()
+                except Exception as e:
+                    _logger.error("Unable to determine usage of %(family)r: %(error)s" % {
+                     'family': family,
+                     'error': str(e),
+                    })
+                    continue
+                if usage > CONFIG.maintainer_eviction_high_watermark:
+                    try:
+                        stats['evicted'] += self._evict(family, fs, usage)
+                        stats['usage'][family or ''] = fs.get_usage()
+                    except Exception as e:
+                        _logger.error("Unable to evict content from %(family)r: %(error)s" % {
+                         'family': family,
+                         'error': str(e),
+                        })
+            self._complete_pass()
+            self._sleep(CONFIG.maintainer_eviction_sleep)
             
-        sep_pos = filename.find('.')
-        if sep_pos > -1:
-            uid = filename[:sep_pos]
+    def _evict(self, family, fs, usage):
+        """
+        Deletes eligible content from `family`, whose filesystem is `fs`, until its usage falls below
+        the low watermark or nothing eligible remains, returning the number of records deleted.
+        
+        Each record is dropped before its file is unlinked, so no record is ever left pointing at
+        nothing; if the file can't be unlinked, the record is restored.
+        
+        Usage is what the storage physically holds, so, for backends that keep the space of unlinked
+        files until it's compacted, like pack://, each page of evictions is followed by compaction.
+        """
+        _logger.warn("%(family)r is %(usage).1f%% full; evicting stale-eligible content..." % {
+         'family': family,
+         'usage': usage * 100,
+        })
+        query = {
+         'policy.delete.stale': {'$ne': None},
+         'meta.' + CONFIG.maintainer_eviction_pin_key: {'$in': [None, False]},
+        }
+        if family is None: #Unmapped families are served by the generic filesystem
+            query['physical.family'] = {'$nin': [name for name in state.get_families() if name is not None]}
         else:
-            uid = filename
+            query['physical.family'] = family
+            
+        evicted = 0
+        after = None
+        while usage >= CONFIG.maintainer_eviction_low_watermark:
+            self._budget.throttle(queries=1)
+            records = list(database.enumerate_by_atime(query, after, CONFIG.security_query_size))
+            if not records:
+                break
+            after = (records[-1]['physical']['atime'], records[-1]['_id'])
             
-        return database.record_exists(uid)
+            unlinked = []
+            for record in records:
+                self._budget.throttle(ops=1, queries=1)
+                try:
+                    database.drop_record(record['_id'])
+                except Exception as e:
+                    _logger.warn("Unable to drop '%(uid)s' for eviction: %(error)s" % {
+                     'uid': record['_id'],
+                     'error': str(e),
+                    })
+                    continue
+                try:
+                    fs.unlink(record, prune=False)
+                except filesystem.FileNotFoundError: #Gone already; the record needed to go too
+                    pass
+                except Exception as e:
+                    _logger.warn("Unable to evict '%(uid)s'; restoring its record: %(error)s" % {
+                     'uid': record['_id'],
+                     'error': str(e),
+                    })
+                    self._restore(record)
+                    continue
+                unlinked.append(record)
+                usage = fs.get_usage()
+                if usage < CONFIG.maintainer_eviction_low_watermark:
+                    break
+                    
+            if unlinked:
+                evicted += len(unlinked)
+                try:
+                    fs.prune(unlinked)
+                except Exception as e:
+                    _logger.warn("Unable to prune directories: %(error)s" % {
+                     'error': str(e),
+                    })
+                if usage >= CONFIG.maintainer_eviction_low_watermark and fs.compact(CONFIG.maintainer_compaction_threshold, self._throttle):
+                    usage = fs.get_usage()
+                    
+        summary = "Evicted %(count)i records from %(family)r, leaving it %(usage).1f%% full" % {
+         'count': evicted,
+         'family': family,
+         'usage': usage * 100,
+        }
+        if usage >= CONFIG.maintainer_eviction_low_watermark:
+            summary += "; nothing else is eligible for eviction"
+        _logger.warn(summary)
+        mail.send_alert(summary)
+        return evicted
+        
+    def _throttle(self, size):
+        """
+        Charges the rewriting of a file of `size` bytes, during compaction, to the budget.
+        """
+        self._budget.throttle(bytes=size, ops=1)
+        
+    def _restore(self, record):
+        """
+        Re-adds `record`, dropped for eviction, after its file couldn't be unlinked.
+        """
+        try:
+            database.add_record(record)
+        except Exception as e:
+            message = "Unable to restore the record of '%(uid)s', whose file could not be evicted; the file is orphaned: %(error)s" % {
+             'uid': record['_id'],
+             'error': str(e),
+            }
+            _logger.error(message)
+            mail.send_alert(message)
+            
+class ScrubMaintainer(_Maintainer):
+    """
+    Re-reads every file, within the thread's budget and without disturbing the OS's caches, to
+    detect silent corruption, verifying each against its recorded SHA-1 and size or, for
+    compressed files without a recorded SHA-1, by decompressing it. Files without a recorded
+    SHA-1, which predate fingerprinting, have theirs recorded, so later sweeps can verify them.
+    
+    Problems are recorded as `stats.scrubFailed` and alerted. Sweeps are checkpointed, like the
+    database maintainer's.
+    """
+    def __init__(self):
+        _Maintainer.__init__(self)
+        self.name = 'scrub-maintainer'
+        self._windows = SCRUB_WINDOWS
+        self._budget = _Budget('scrub')
+        
+    def run(self):
+        """
+        Cycles through every record in order of ctime, verifying each one's file.
+        """
+        checkpoint = _Checkpoint(self.name)
+        while True:
+            if not checkpoint.in_progress:
+                delay = checkpoint.next_sweep(CONFIG.maintainer_scrub_sleep) - time.time()
+                if delay > 0:
+                    _logger.debug("All records scrubbed; sleeping")
+                    self._sleep(delay)
+                self._budget.throttle(queries=1)
+                checkpoint.begin(total=database.count_where({}))
+                checkpoint.state['corrupt'] = 0
+                
+            self._wait_for_window()
+            ctime = checkpoint.state['cursor']
+            if ctime is None:
+                ctime = -1.0
+            self._budget.throttle(queries=1)
+            records = list(database.enumerate_all(ctime, limit=CONFIG.security_query_size))
+            if not records: #Cycle complete
+                checkpoint.finish()
+                self._complete_pass()
+                continue
+                
+            for record in records:
+                self._wait_for_window()
+                self._budget.throttle(ops=1)
+                try:
+                    problem = self._scrub(record)
+                except filesystem.FileNotFoundError: #The database maintainer's concern
+                    problem = None
+                except Exception as e:
+                    _logger.warn("Unable to scrub '%(uid)s': %(error)s" % {
+                     'uid': record['_id'],
+                     'error': str(e),
+                    })
+                    problem = None
+                if problem:
+                    checkpoint.state['corrupt'] = checkpoint.state.get('corrupt', 0) + 1
+                    self._report(record, problem)
+            checkpoint.advance(records[-1]['physical']['ctime'], len(records))
+            
+    def _scrub(self, record):
+        """
+        Reads `record`'s file in full, returning a description of any problem found, or ``None``.
+        """
+        physical = record['physical']
+        fs = state.get_filesystem(physical['family'])
+        data = filesystem.HashingReader(self._budget.reader(fs.get(record, cache=False)))
+        try:
+            current_compression = physical['format'].get('comp')
+            if current_compression and (not physical.get('storedHash') or physical.get('size') is None):
+                content = filesystem.CountingReader(compression.get_stream_decompressor(current_compression)(data))
+                try:
+                    while content.read(_MEASURE_CHUNK_SIZE):
+                        pass
+                except Exception as e:
+                    return "test-decompression from '%(comp)s' failed: %(error)s" % {
+                     'comp': current_compression,
+                     'error': str(e),
+                    }
+                if physical.get('size') is None: #Stored compressed by the client; now it's known
+                    self._budget.throttle(queries=1)
+                    database.update_fields(record['_id'], {'physical.size': content.size}, expected={
+                     'physical.size': None,
+                     'physical.family': physical['family'],
+                     'physical.storedSize': physical.get('storedSize'),
+                     'physical.format.comp': current_compression,
+                    })
+                elif content.size != physical['size']:
+                    return "decompressed to %(actual)i bytes, not %(expected)i" % {
+                     'actual': content.size,
+                     'expected': physical['size'],
+                    }
+            else:
+                while data.read(_MEASURE_CHUNK_SIZE):
+                    pass
+        finally:
+            data.close()
+            
+        if physical.get('storedHash') and data.hexdigest() != physical['storedHash']:
+            return "SHA-1 is %(actual)s, not %(expected)s" % {
+             'actual': data.hexdigest(),
+             'expected': physical['storedHash'],
+            }
+        if physical.get('storedSize') is not None and data.size != physical['storedSize']:
+            return "%(actual)i bytes are stored, not %(expected)i" % {
+             'actual': data.size,
+             'expected': physical['storedSize'],
+            }
+            
+        if not physical.get('storedHash'): #Stored before uploads were fingerprinted; checked from now on
+            self._budget.throttle(queries=1)
+            database.update_fields(record['_id'], {
+             'physical.storedHash': data.hexdigest(),
+             'physical.storedSize': data.size,
+            }, expected={
+             'physical.storedHash': None,
+             'physical.family': physical['family'],
+             'physical.storedSize': physical.get('storedSize'),
+             'physical.format.comp': physical['format'].get('comp'),
+            })
+        return None
+        
+    def _report(self, record, problem):
+        """
+        Records and alerts the `problem` found with `record`'s file.
+        """
+        summary = "Scrubbing found '%(uid)s' in %(family)r to be corrupt: %(problem)s" % {
+         'uid': record['_id'],
+         'family': record['physical']['family'],
+         'problem': problem,
+        }
+        _logger.error(summary)
+        mail.send_alert(summary)
+        self._budget.throttle(queries=1)
+        try:
+            database.update_fields(record['_id'], {
+             'stats.scrubFailed': {
+              'problem': problem,
+              'time': int(time.time()),
+             },
+            })
+        except Exception as e:
+            _logger.error("Unable to record corruption of '%(uid)s': %(error)s" % {
+             'uid': record['_id'],
+             'error': str(e),
+            })
+            
+class CompactionMaintainer(_Maintainer):
+    """
+    Rewrites the storage of families whose backends keep the space of unlinked files, like pack://,
+    once enough of it is held that way, reclaiming the space.
+    """
+    def __init__(self):
+        _Maintainer.__init__(self)
+        self.name = 'compaction-maintainer'
+        self._windows = COMPACTION_WINDOWS
+        self._budget = _Budget('compaction')
+        
+    def run(self):
+        """
+        Compacts every family periodically.
+        """
+        stats = _STATS[self.name] = {
+         'reclaimed': 0,
+        }
+        while True:
+            self._wait_for_window()
+            for family in sorted(state.get_families()):
+                self._wait_for_window()
+                try:
+                    stats['reclaimed'] += state.get_filesystem(family).compact(
+                     CONFIG.maintainer_compaction_threshold, self._throttle
+                    )
+                except Exception as e:
+                    _logger.error("Unable to compact %(family)r: %(error)s" % {
+                     'family': family,
+                     'error': str(e),
+                    })
+            self._complete_pass()
+            self._sleep(CONFIG.maintainer_compaction_sleep)
+            
+    def _throttle(self, size):
+        """
+        Charges the rewriting of a file of `size` bytes to the budget, pausing first if the window
+        has closed.
+        """
+        self._wait_for_window()
+        self._budget.throttle(bytes=size, ops=1)
         
+        
\ No newline at end of file
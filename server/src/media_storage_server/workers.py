@@ -0,0 +1,159 @@
+"""
+media-storage.workers
+=====================
+
+Provides a bounded pool of processes on which CPU-heavy work requested through the webservice is
+performed, so that it neither blocks the request-handling thread nor contends for the GIL.
+
+Legal
++++++
+ This file is part of media-storage.
+ media-storage is free software; you can redistribute it and/or modify
+ it under the terms of the GNU General Public License as published by
+ the Free Software Foundation; either version 3 of the License, or
+ (at your option) any later version.
+ 
+ This program is distributed in the hope that it will be useful,
+ but WITHOUT ANY WARRANTY; without even the implied warranty of
+ MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+ GNU General Public License for more details.
+ 
+ You should have received a copy of the GNU General Public License
+ along with this program. If not, see <http://www.gnu.org/licenses/>.
+ 
+ (C) Neil Tallim, 2012 <flan@uguu.ca>
+"""
+import logging
+import multiprocessing
+import os
+import tempfile
+import threading
+import traceback
+
+import compression
+
+_CHUNK_SIZE = 32 * 1024 #Write 32k at a time
+
+_pool = None #The pool of worker processes
+_workers = 0 #The number of processes in the pool
+_queue_size = 0 #The number of jobs that may be pending at once
+_pending = 0 #The number of jobs submitted but not yet completed
+_completed = 0 #The number of jobs completed since the pool was started
+_lock = threading.Lock() #Guards the counters
+
+_logger = logging.getLogger("media_storage.workers")
+
+def start(workers, queue_size):
+    """
+    Spawns `workers` processes, allowing up to `queue_size` jobs to be pending at any time.
+    
+    This must happen before any other threads are started, since the processes are forked.
+    """
+    global _pool, _workers, _queue_size
+    _logger.info("Starting %(workers)i compression worker processes..." % {
+     'workers': workers,
+    })
+    _workers = workers
+    _queue_size = max(workers, queue_size)
+    _pool = multiprocessing.Pool(workers)
+    
+def stop():
+    """
+    Terminates the pool, abandoning any pending jobs.
+    """
+    if _pool:
+        _logger.info("Terminating compression worker processes...")
+        _pool.terminate()
+        _pool.join()
+        
+def get_stats():
+    """
+    Provides a dictionary describing the pool's load: the number of 'workers', the number of jobs
+    'pending' (running or waiting), how many of those are 'queued' behind busy workers, the
+    'capacity' for pending jobs, and the number 'completed'.
+    """
+    with _lock:
+        return {
+         'workers': _workers,
+         'pending': _pending,
+         'queued': max(0, _pending - _workers),
+         'capacity': _queue_size,
+         'completed': _completed,
+        }
+        
+def compress(format, options, path, callback):
+    """
+    Compresses the file at `path` in `format`, with the given tuning `options`, on the pool.
+    
+    When the job finishes, `callback` is invoked, on a pool-management thread, with the path of a
+    tempfile that contains the compressed data, which the callee must unlink, and ``None``; if the
+    job failed, the path is ``None`` and the second argument describes the problem. Either way, the
+    job stops counting as pending once `callback` returns.
+    
+    ``SaturatedError`` is raised if too many jobs are already pending; if the job can't be submitted
+    at all, the pool's exception is raised and `callback` is never invoked.
+    """
+    global _pending
+    with _lock:
+        if _pending >= _queue_size:
+            raise SaturatedError("%(pending)i compression jobs are already pending" % {
+             'pending': _pending,
+            })
+        _pending += 1
+        
+    def _complete(result):
+        global _pending, _completed
+        try:
+            callback(*result)
+        except Exception: #Escaping, it would stop the pool from delivering any other results
+            _logger.error("Unable to deliver the result of a compression job; exception details follow:\n" + traceback.format_exc())
+        finally:
+            with _lock:
+                _pending -= 1
+                _completed += 1
+    try:
+        _pool.apply_async(_compress_file, (format, options, path), callback=_complete)
+    except Exception:
+        with _lock:
+            _pending -= 1
+        raise
+        
+def _compress_file(format, options, path):
+    """
+    Runs in a worker process, compressing the file at `path` into a new tempfile, returning its
+    path and ``None``, or ``None`` and a traceback if anything went wrong.
+    
+    Nothing may escape, since the pool invokes a job's callback only if it returns normally.
+    """
+    try:
+        (descriptor, target_path) = tempfile.mkstemp()
+        try:
+            target = os.fdopen(descriptor, 'wb')
+            data = compression.get_stream_compressor(format, options=options)(open(path, 'rb'))
+            try:
+                while True:
+                    chunk = data.read(_CHUNK_SIZE)
+                    if not chunk:
+                        break
+                    target.write(chunk)
+            finally:
+                target.close()
+                data.close()
+        except Exception:
+            os.unlink(target_path)
+            raise
+        return (target_path, None)
+    except BaseException:
+        return (None, traceback.format_exc())
+        
+        
+class SaturatedError(Exception):
+    """
+    Indicates that the pool cannot accept any more work at the moment.
+    """
+    
+class WorkerError(Exception):
+    """
+    Indicates that a job failed in a worker process.
+    """
+    
\ No newline at end of file
@@ -0,0 +1,219 @@
+"""
+Shared scaffolding for the server's tests.
+
+Importing this module puts the server's modules on the path and, since the database module connects
+to MongoDB as soon as it's imported, installs an in-memory equivalent of its interface in its place,
+so that maintainers can be exercised against real filesystems without a database server.
+"""
+import copy
+import logging
+import os
+import shutil
+import StringIO
+import sys
+import tempfile
+import time
+import types
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'src', 'media_storage_server'))
+logging.getLogger().addHandler(logging.NullHandler()) #Which also keeps Tornado from adding a console handler
+
+_MISSING = object()
+
+def _get_field(record, field):
+    """
+    Provides the value of the dotted `field` in `record`, or `_MISSING`.
+    """
+    for part in field.split('.'):
+        if not isinstance(record, dict) or not part in record:
+            return _MISSING
+        record = record[part]
+    return record
+    
+def _set_field(record, field, value):
+    parts = field.split('.')
+    for part in parts[:-1]:
+        record = record.setdefault(part, {})
+    record[parts[-1]] = value
+    
+def _matches(record, spec):
+    """
+    Evaluates the subset of Mongo's query language that the server uses against `record`.
+    """
+    for (field, condition) in spec.items():
+        if field == '$or':
+            if not any(_matches(record, alternative) for alternative in condition):
+                return False
+            continue
+        value = _get_field(record, field)
+        if isinstance(condition, dict) and condition and all(key.startswith('$') for key in condition):
+            for (operator, operand) in condition.items():
+                present = value is not _MISSING and value is not None
+                if operator == '$exists':
+                    if (value is not _MISSING) != operand:
+                        return False
+                elif operator == '$in':
+                    if not (value if present else None) in operand:
+                        return False
+                elif operator == '$nin':
+                    if (value if present else None) in operand:
+                        return False
+                elif operator == '$ne':
+                    if (value if present else None) == operand:
+                        return False
+                elif not present:
+                    return False
+                elif operator == '$gt' and not value > operand:
+                    return False
+                elif operator == '$gte' and not value >= operand:
+                    return False
+                elif operator == '$lt' and not value < operand:
+                    return False
+                elif operator == '$lte' and not value <= operand:
+                    return False
+        elif condition is None:
+            if not value in (_MISSING, None):
+                return False
+        elif value != condition:
+            return False
+    return True
+    
+    
+class InMemoryDatabase(types.ModuleType):
+    """
+    Implements the interface of the server's database module over a dictionary of records.
+    """
+    def __init__(self):
+        types.ModuleType.__init__(self, 'database')
+        self.records = {}
+        
+    def reset(self):
+        self.records.clear()
+        
+    def _find(self, spec, sort_field, limit=None):
+        records = sorted(
+         (record for record in self.records.values() if _matches(record, spec)),
+         key=lambda record: (_get_field(record, sort_field), record['_id']),
+        )
+        return [copy.deepcopy(record) for record in records[:limit]]
+        
+    def enumerate_all(self, ctime, limit=250):
+        return self._find({'physical.ctime': {'$gt': ctime}}, 'physical.ctime', limit)
+        
+    def enumerate_due(self, field, after, until, limit):
+        spec = {field: {'$lte': until}}
+        if after:
+            spec['$or'] = [
+             {field: {'$gt': after[0]}},
+             {field: after[0], '_id': {'$gt': after[1]}},
+            ]
+        return self._find(spec, field, limit)
+        
+    def enumerate_by_atime(self, query, after, limit):
+        spec = dict(query)
+        if after:
+            spec['$or'] = [
+             {'physical.atime': {'$gt': after[0]}},
+             {'physical.atime': after[0], '_id': {'$gt': after[1]}},
+            ]
+        return self._find(spec, 'physical.atime', limit)
+        
+    def enumerate_where(self, query):
+        return self._find(query, 'physical.ctime')
+        
+    def count_where(self, query):
+        return len(self._find(query, 'physical.ctime'))
+        
+    def get_record(self, uid):
+        record = self.records.get(uid)
+        return record and copy.deepcopy(record)
+        
+    def add_record(self, record):
+        if record['_id'] in self.records:
+            raise ValueError("Duplicate uid: %(uid)s" % {'uid': record['_id'],})
+        self.records[record['_id']] = copy.deepcopy(record)
+        
+    def update_record(self, record):
+        self.records[record['_id']] = copy.deepcopy(record)
+        
+    def update_fields(self, uid, changes, expected=None):
+        record = self.records.get(uid)
+        if record is None or not _matches(record, expected or {}):
+            return False
+        for (field, value) in changes.items():
+            _set_field(record, field, value)
+        return True
+        
+    def drop_record(self, uid, expected=None):
+        record = self.records.get(uid)
+        if record is None or not _matches(record, expected or {}):
+            return False
+        del self.records[uid]
+        return True
+        
+    def drop_records(self, uids):
+        for uid in uids:
+            self.records.pop(uid, None)
+            
+    def find_existing(self, uids):
+        return set(uid for uid in uids if uid in self.records)
+        
+    def record_exists(self, uid):
+        return uid in self.records
+        
+database = sys.modules['database'] = InMemoryDatabase()
+
+import filesystem
+import state
+
+def make_record(uid, family=None, ctime=None, **physical):
+    """
+    Builds a minimal record for `uid`, in `family`, with any `physical` fields given.
+    """
+    record = {
+     '_id': uid,
+     'keys': {'read': None, 'write': None},
+     'physical': {
+      'family': family,
+      'ctime': ctime or time.time(),
+      'atime': int(ctime or time.time()),
+      'minRes': 5,
+      'format': {'mime': 'application/octet-stream', 'comp': None},
+     },
+     'policy': {
+      'delete': {},
+      'compress': {},
+     },
+     'stats': {'accesses': 0},
+     'meta': {},
+    }
+    record['physical'].update(physical)
+    return record
+    
+    
+class FilesystemTestCase(object):
+    """
+    A mixin that gives each test a fresh database and a local filesystem in a temporary directory,
+    registered as the generic family.
+    """
+    def setUp(self):
+        database.reset()
+        state._FAMILIES.clear()
+        self.path = tempfile.mkdtemp()
+        self.fs = filesystem.Filesystem('file://' + self.path)
+        state.register_family(None, self.fs)
+        
+    def tearDown(self):
+        shutil.rmtree(self.path)
+        
+    def store(self, record, content):
+        """
+        Writes `content` for `record` and adds the record to the database.
+        """
+        self.fs.put(record, StringIO.StringIO(content))
+        database.add_record(record)
+        
+    def stored_path(self, record):
+        return os.path.join(self.path, self.fs.resolve_path(record))
+        
+        
\ No newline at end of file
@@ -0,0 +1,213 @@
+"""
+Tests for the formats and the gz-indexed container provided by media_storage_server.compression.
+
+Run from the server directory with 'python -m unittest discover -s tests'.
+"""
+import bz2
+import os
+import random
+import StringIO
+import sys
+import unittest
+import zlib
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'src', 'media_storage_server'))
+import compression
+
+def _content(size, seed=0):
+    """
+    Produces `size` bytes of moderately compressible content.
+    """
+    generator = random.Random(seed)
+    words = [''.join(chr(generator.randint(97, 122)) for i in range(generator.randint(1, 12))) for j in range(512)]
+    output = []
+    length = 0
+    while length < size:
+        word = generator.choice(words) + ' '
+        output.append(word)
+        length += len(word)
+    return ''.join(output)[:size]
+    
+def _compress(content, workers=1, **options):
+    return compression.compress_gz_indexed(StringIO.StringIO(content), workers=workers, options=options).read()
+    
+    
+class IndexedRoundTripTest(unittest.TestCase):
+    def _check(self, content, workers=1, **options):
+        container = _compress(content, workers, **options)
+        self.assertEqual(compression.decompress_gz_indexed(StringIO.StringIO(container)).read(), content)
+        reader = compression.IndexedReader(StringIO.StringIO(container))
+        self.assertEqual(reader.size, len(content))
+        self.assertEqual(reader.read(), content)
+        return container
+        
+    def test_default_frame_size(self):
+        self._check(_content(3 * 1024 * 1024))
+        
+    def test_odd_frame_sizes(self):
+        content = _content(100003)
+        for frame_size in (1, 7, 4095, 65537, 100002, 100003, 100004):
+            self._check(content[:20000] if frame_size < 16 else content, frame_size=frame_size)
+            
+    def test_parallel(self):
+        self._check(_content(500000), workers=3, frame_size=12345, level=9)
+        
+    def test_empty_input(self):
+        container = self._check('')
+        self.assertTrue(container)
+        self.assertEqual(compression.IndexedReader(StringIO.StringIO(container)).read(10), '')
+        self._check('', frame_size=1)
+        
+    def test_single_byte(self):
+        self._check('x', frame_size=1)
+        self._check('x', frame_size=4096)
+        
+        
+class IndexedSeekTest(unittest.TestCase):
+    def test_seek_and_read(self):
+        content = _content(250000, seed=1)
+        for frame_size in (1000, 4097, 65536):
+            container = _compress(content, frame_size=frame_size)
+            reader = compression.IndexedReader(StringIO.StringIO(container))
+            generator = random.Random(frame_size)
+            for i in range(200):
+                start = generator.randint(0, len(content))
+                size = generator.randint(0, 3 * frame_size)
+                reader.seek(start)
+                self.assertEqual(reader.read(size), content[start:start + size])
+                self.assertEqual(reader.tell(), min(len(content), start + size))
+                
+    def test_relative_seeks(self):
+        content = _content(50000, seed=2)
+        reader = compression.IndexedReader(StringIO.StringIO(_compress(content, frame_size=999)))
+        reader.seek(-100, 2)
+        self.assertEqual(reader.read(), content[-100:])
+        reader.seek(10)
+        reader.seek(5000, 1)
+        self.assertEqual(reader.read(2000), content[5010:7010])
+        reader.seek(len(content) + 10)
+        self.assertEqual(reader.read(10), '')
+        
+    def test_frame_boundaries(self):
+        content = _content(10000, seed=3)
+        reader = compression.IndexedReader(StringIO.StringIO(_compress(content, frame_size=1000)))
+        for boundary in range(0, 10001, 1000):
+            start = max(0, boundary - 1)
+            reader.seek(start)
+            self.assertEqual(reader.read(2), content[start:start + 2])
+            
+    def test_not_a_container(self):
+        self.assertRaises(ValueError, compression.IndexedReader, StringIO.StringIO('x' * 100))
+        
+        
+class ParallelRoundTripTest(unittest.TestCase):
+    """
+    Compressing with several workers must still produce a single stream, which any conventional
+    decoder can read.
+    """
+    content = _content(3 * 1024 * 1024 + 17, seed=4)
+    
+    def _check(self, format, decode):
+        compressor = compression.get_compressor(format, workers=3)
+        compressed = compressor(StringIO.StringIO(self.content)).read()
+        self.assertEqual(decode(compressed), self.content)
+        streamed = compression.get_stream_compressor(format, workers=3)(StringIO.StringIO(self.content)).read()
+        self.assertEqual(decode(streamed), self.content)
+        self.assertEqual(compression.get_decompressor(format)(StringIO.StringIO(compressed)).read(), self.content)
+        
+    def test_gz(self):
+        self._check(compression.COMPRESS_GZ, zlib.decompress)
+        
+    def test_bz2(self):
+        self._check(compression.COMPRESS_BZ2, bz2.decompress)
+        
+    @unittest.skipUnless(compression.lzma, "no lzma library is available")
+    def test_lzma(self):
+        self._check(compression.COMPRESS_LZMA, lambda data: compression.lzma.LZMADecompressor().decompress(data))
+        
+        
+class OptionalFormatTest(unittest.TestCase):
+    """
+    zstd and lz4 must round-trip through every interface, with and without workers, producing a
+    single frame that their libraries' own decoders accept.
+    """
+    content = _content(2 * 1024 * 1024 + 5, seed=5)
+    
+    def _check(self, format, decode, **options):
+        for workers in (1, 3):
+            compressed = compression.get_compressor(format, workers=workers, options=options)(StringIO.StringIO(self.content)).read()
+            self.assertEqual(decode(compressed), self.content)
+            self.assertEqual(compression.get_decompressor(format)(StringIO.StringIO(compressed)).read(), self.content)
+            streamed = compression.get_stream_compressor(format, workers=workers, options=options)(StringIO.StringIO(self.content)).read()
+            self.assertEqual(decode(streamed), self.content)
+            self.assertEqual(compression.get_stream_decompressor(format)(StringIO.StringIO(streamed)).read(), self.content)
+            
+    @unittest.skipUnless(compression.zstd, "no zstd library is available")
+    def test_zstd(self):
+        decode = lambda data: compression.zstd.ZstdDecompressor().decompressobj().decompress(data)
+        self._check(compression.COMPRESS_ZSTD, decode)
+        self._check(compression.COMPRESS_ZSTD, decode, level=19)
+        
+    @unittest.skipUnless(compression.zstd, "no zstd library is available")
+    def test_zstd_threads(self):
+        (compressor, header) = compression._new_compressor(compression.COMPRESS_ZSTD, {}, workers=3)
+        compressed = header + compressor.compress(self.content) + compressor.flush()
+        self.assertEqual(compression.zstd.ZstdDecompressor().decompressobj().decompress(compressed), self.content)
+        
+    @unittest.skipUnless(compression.lz4, "no lz4 library is available")
+    def test_lz4(self):
+        self._check(compression.COMPRESS_LZ4, compression.lz4.decompress)
+        self._check(compression.COMPRESS_LZ4, compression.lz4.decompress, level=9)
+        
+        
+class MultiStreamTest(unittest.TestCase):
+    """
+    Files compressed in parallel by earlier versions are concatenated streams, which must still be
+    read in full.
+    """
+    def _check(self, format, compress):
+        blocks = [_content(100000, seed=seed) for seed in range(3)]
+        data = ''.join(compress(block) for block in blocks)
+        content = ''.join(blocks)
+        self.assertEqual(compression.get_decompressor(format)(StringIO.StringIO(data)).read(), content)
+        reader = compression.get_stream_decompressor(format)(StringIO.StringIO(data))
+        self.assertEqual(reader.read(), content)
+        
+    def test_bz2(self):
+        self._check(compression.COMPRESS_BZ2, bz2.compress)
+        
+    @unittest.skipUnless(compression.lzma, "no lzma library is available")
+    def test_lzma(self):
+        def compress(block):
+            compressor = compression.lzma.LZMACompressor()
+            return compressor.compress(block) + compressor.flush()
+        self._check(compression.COMPRESS_LZMA, compress)
+        
+        
+class OptionValidationTest(unittest.TestCase):
+    def test_frame_size_must_be_positive(self):
+        for frame_size in (0, -1, -4096):
+            self.assertRaises(ValueError, compression.filter_options, compression.COMPRESS_GZ_INDEXED, {'frame_size': frame_size})
+            self.assertRaises(ValueError, compression.IndexedCompressingReader, StringIO.StringIO('x' * 1000), 1, {'frame_size': frame_size})
+            
+    def test_level_range(self):
+        for (format, level) in (
+         (compression.COMPRESS_GZ, 10),
+         (compression.COMPRESS_GZ, -1),
+         (compression.COMPRESS_GZ_INDEXED, 12),
+         (compression.COMPRESS_BZ2, 0),
+        ):
+            self.assertRaises(ValueError, compression.filter_options, format, {'level': level})
+            
+    def test_valid_options(self):
+        self.assertEqual(
+         compression.filter_options(compression.COMPRESS_GZ_INDEXED, {'level': '6', 'frame_size': 4096, 'preset': 3}),
+         {'level': 6, 'frame_size': 4096},
+        )
+        self.assertRaises(ValueError, compression.filter_options, compression.COMPRESS_GZ, {'level': 'high'})
+        
+        
+if __name__ == '__main__':
+    unittest.main()
+    
+    
\ No newline at end of file
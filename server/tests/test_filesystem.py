@@ -0,0 +1,88 @@
+"""
+Tests for media_storage_server.filesystem's detection of missing files and walking of the local
+backend.
+
+Run from the server directory with 'python -m unittest discover -s tests'.
+"""
+import os
+import shutil
+import unittest
+
+from support import make_record, FilesystemTestCase
+from backends import local
+
+class FindMissingTest(FilesystemTestCase, unittest.TestCase):
+    def test_time_layout_is_listed(self):
+        records = [make_record(uid, ctime=1000000000.0) for uid in ('a', 'b', 'c')]
+        for record in records:
+            self.store(record, 'content')
+        os.unlink(self.stored_path(records[1]))
+        listings = {}
+        self.assertEqual([record['_id'] for record in self.fs.find_missing(records, listings)], ['b'])
+        self.assertEqual(len(listings), 1)
+        
+    def test_hashed_layout_is_examined_individually(self):
+        records = [make_record(uid, layout='hashed') for uid in ('a', 'b', 'c')]
+        for record in records:
+            self.store(record, 'content')
+        os.unlink(self.stored_path(records[2]))
+        listings = {}
+        self.assertEqual([record['_id'] for record in self.fs.find_missing(records, listings)], ['c'])
+        self.assertEqual(listings, {})
+        
+        
+class WalkTest(FilesystemTestCase, unittest.TestCase):
+    _FILES = (
+     'top', '1000/0/a', '1000/0/b', '1000/2/c', '1000/10/d', '1000/10/e', '1000/10/9/f',
+     '999/5/g', '20000/h', 'hashed/ab/cd/i',
+    )
+    
+    def setUp(self):
+        FilesystemTestCase.setUp(self)
+        for name in self._FILES:
+            path = os.path.join(self.path, name)
+            if not os.path.isdir(os.path.dirname(path)):
+                os.makedirs(os.path.dirname(path))
+            open(path, 'wb').close()
+        os.makedirs(os.path.join(self.path, '1000/7')) #Empty
+        
+    def _walk(self, after=None):
+        return [(path, sorted(files)) for (path, files) in self.fs.walk(after)]
+        
+    def test_order(self):
+        self.assertEqual(self._walk(), [
+         ('', ['top']),
+         ('999', []), ('999/5', ['g']),
+         ('1000', []), ('1000/0', ['a', 'b']), ('1000/2', ['c']), ('1000/7', []), ('1000/10', ['d', 'e']), ('1000/10/9', ['f']),
+         ('20000', ['h']),
+         ('hashed', []), ('hashed/ab', []), ('hashed/ab/cd', ['i']),
+        ])
+        
+    def test_without_scandir(self):
+        walk = self._walk()
+        scandir = local.scandir
+        local.scandir = None
+        try:
+            self.assertEqual(self._walk(), walk)
+            self.assertEqual(self._walk('1000/2'), walk[walk.index(('1000/2', ['c'])) + 1:])
+        finally:
+            local.scandir = scandir
+            
+    def test_resume(self):
+        walk = self._walk()
+        for (i, (path, files)) in enumerate(walk):
+            if path: #The root, as a cursor, is no different from the start
+                self.assertEqual(self._walk(path), walk[i + 1:], path)
+                
+    def test_resume_after_pruned_directory(self):
+        walk = self._walk()
+        shutil.rmtree(os.path.join(self.path, '1000/2'))
+        remaining = [entry for entry in walk if entry[0] != '1000/2']
+        self.assertEqual(self._walk('1000/2'), remaining[remaining.index(('1000/0', ['a', 'b'])) + 1:])
+        self.assertEqual(self._walk('1000/3'), remaining[remaining.index(('1000/7', [])):])
+        
+        
+if __name__ == '__main__':
+    unittest.main()
+    
+    
\ No newline at end of file
@@ -0,0 +1,96 @@
+"""
+Tests for the byte-range support of media_storage_server.http.GetHandler.
+
+Run from the server directory with 'python -m unittest discover -s tests'.
+"""
+import json
+import StringIO
+import unittest
+
+from support import make_record, FilesystemTestCase
+import compression
+
+try:
+    import tornado.ioloop
+    import tornado.testing
+    import tornado.web
+    import http
+except ImportError:
+    http = None
+    
+_CONTENT = ''.join(chr(i % 251) for i in xrange(100000))
+
+@unittest.skipUnless(http, "tornado is not available")
+class ParseRangeTest(unittest.TestCase):
+    def test_ranges(self):
+        for (header, expected) in (
+         ('bytes=0-499', (0, 499)),
+         ('bytes=500-', (500, 999)),
+         ('bytes=-100', (900, 999)),
+         ('bytes=-5000', (0, 999)),
+         ('bytes=990-5000', (990, 999)),
+         ('bytes=5-5', (5, 5)),
+         (' bytes=1-2 ', (1, 2)),
+        ):
+            self.assertEqual(http._parse_range(header, 1000), expected, header)
+            
+    def test_ignored(self):
+        for header in (None, '', 'bytes=-', 'bytes=5-3', 'bytes=0-1,5-6', 'items=0-1', 'bytes=a-b'):
+            self.assertEqual(http._parse_range(header, 1000), None, header)
+            
+    def test_unsatisfiable(self):
+        for (header, size) in (('bytes=1000-', 1000), ('bytes=1000-1001', 1000), ('bytes=-0', 1000), ('bytes=0-', 0)):
+            self.assertRaises(ValueError, http._parse_range, header, size)
+            
+            
+@unittest.skipUnless(http, "tornado is not available")
+class GetRangeTest(FilesystemTestCase, tornado.testing.AsyncHTTPTestCase if http else unittest.TestCase):
+    def setUp(self):
+        FilesystemTestCase.setUp(self)
+        tornado.testing.AsyncHTTPTestCase.setUp(self)
+        self.store(make_record('plain', size=len(_CONTENT), storedSize=len(_CONTENT)), _CONTENT)
+        indexed = compression.compress_gz_indexed(StringIO.StringIO(_CONTENT), options={'frame_size': 4096}).read()
+        record = make_record('indexed', size=len(_CONTENT), storedSize=len(indexed))
+        record['physical']['format']['comp'] = compression.COMPRESS_GZ_INDEXED
+        self.store(record, indexed)
+        
+    def tearDown(self):
+        tornado.testing.AsyncHTTPTestCase.tearDown(self)
+        FilesystemTestCase.tearDown(self)
+        
+    def get_new_ioloop(self):
+        return tornado.ioloop.IOLoop.instance() #Deferred responses are completed on it
+        
+    def get_app(self):
+        return tornado.web.Application([('/get', http.GetHandler)])
+        
+    def _get(self, uid, byte_range):
+        return self.fetch('/get', method='POST', body=json.dumps({'uid': uid}), headers={'Range': byte_range})
+        
+    def test_partial_content(self):
+        for uid in ('plain', 'indexed'):
+            for (byte_range, start, end) in (('bytes=0-0', 0, 0), ('bytes=4090-10000', 4090, 10000), ('bytes=-10', 99990, 99999), ('bytes=99000-', 99000, 99999)):
+                response = self._get(uid, byte_range)
+                self.assertEqual(response.code, 206, (uid, byte_range))
+                self.assertEqual(response.headers['Content-Range'], 'bytes %i-%i/100000' % (start, end))
+                self.assertEqual(int(response.headers['Content-Length']), end - start + 1)
+                self.assertEqual(response.body, _CONTENT[start:end + 1])
+                
+    def test_unsatisfiable(self):
+        for uid in ('plain', 'indexed'):
+            response = self._get(uid, 'bytes=100000-')
+            self.assertEqual(response.code, 416)
+            self.assertEqual(response.headers['Content-Range'], 'bytes */100000')
+            
+    def test_invalid_range_is_ignored(self):
+        for uid in ('plain', 'indexed'):
+            response = self._get(uid, 'bytes=5-3')
+            self.assertEqual(response.code, 200)
+            self.assertFalse('Content-Range' in response.headers)
+            self.assertEqual(response.body, _CONTENT)
+            
+            
+if __name__ == '__main__':
+    unittest.main()
+    
+    
\ No newline at end of file
@@ -0,0 +1,119 @@
+"""
+Tests for the aggregation and delivery of alerts by media_storage_server.mail.
+
+Run from the server directory with 'python -m unittest discover -s tests'.
+"""
+import Queue
+import threading
+import time
+import unittest
+
+import support
+from config import CONFIG
+import mail
+
+class DigestTest(unittest.TestCase):
+    def test_single_alert(self):
+        pending = {}
+        mail._AlertDispatcher()._collect(pending, (1000000000.0, 'disk on fire'))
+        message = mail._build_digest(pending)
+        self.assertEqual(message.get_payload(), 'disk on fire')
+        self.assertEqual(message['Subject'], CONFIG.email_alert_subject)
+        
+    def test_repeats_are_collapsed(self):
+        dispatcher = mail._AlertDispatcher()
+        pending = mail.collections.OrderedDict()
+        for (timestamp, message) in ((1.0, 'disk on fire'), (2.0, 'database down'), (3.0, 'disk on fire')):
+            dispatcher._collect(pending, (timestamp, message))
+        dispatcher._collect(pending, None) #A wake-up, not an alert
+        self.assertEqual(pending, {'disk on fire': [2, 1.0, 3.0], 'database down': [1, 2.0, 2.0]})
+        
+        message = mail._build_digest(pending)
+        self.assertTrue(message['Subject'].endswith('(3 alerts)'))
+        body = message.get_payload()
+        self.assertTrue(body.startswith('3 alerts raised (2 distinct)'))
+        self.assertTrue(body.index('disk on fire') < body.index('database down'))
+        self.assertTrue('=== 2 occurrence(s)' in body)
+        
+        
+class DispatchTest(unittest.TestCase):
+    """
+    Drives a dispatcher of its own, with a fresh queue, capturing what it would send.
+    """
+    def setUp(self):
+        if not CONFIG.has_section('email'):
+            CONFIG.add_section('email')
+        CONFIG.set('email', 'alert', 'yes')
+        CONFIG.set('email', 'alert_cooldown', '3600')
+        self.sent = []
+        self.release = threading.Event()
+        self.release.set()
+        self._send_message = mail._send_message
+        mail._send_message = self._capture
+        mail._ALERT_QUEUE = Queue.Queue(2)
+        mail._dispatcher = None #Any earlier dispatcher stays blocked on the old queue
+        mail._unsent = 0
+        
+    def tearDown(self):
+        self.release.set()
+        mail.flush()
+        mail._send_message = self._send_message
+        CONFIG.remove_option('email', 'alert')
+        CONFIG.remove_option('email', 'alert_cooldown')
+        
+    def _capture(self, message):
+        self.sending = True
+        self.release.wait()
+        self.sent.append(message)
+        
+    def _wait_for_sending(self):
+        for i in range(500):
+            if self.sent or getattr(self, 'sending', False):
+                return
+            time.sleep(0.01)
+        self.fail("nothing was sent")
+        
+    def test_alerts_wait_for_cooldown(self):
+        mail.send_alert('first')
+        self._wait_for_sending()
+        mail.send_alert('second')
+        mail.send_alert('second')
+        time.sleep(0.1)
+        self.assertEqual([message.get_payload() for message in self.sent], ['first'])
+        
+        mail.flush()
+        self.assertEqual(len(self.sent), 2)
+        self.assertTrue(self.sent[1]['Subject'].endswith('(2 alerts)'))
+        self.assertEqual(mail._unsent, 0)
+        
+    def test_flush_with_full_queue(self):
+        self.release.clear()
+        mail.send_alert('first')
+        self._wait_for_sending() #The dispatcher is now held, sending
+        mail.send_alert('second')
+        mail.send_alert('third')
+        mail.send_alert('fourth') #Discarded, with the queue full
+        self.assertTrue(mail._ALERT_QUEUE.full())
+        
+        threading.Timer(0.2, self.release.set).start()
+        mail.flush()
+        self.assertEqual(mail._unsent, 0)
+        self.assertFalse(mail._FLUSH_REQUESTED.is_set())
+        self.assertEqual(len(self.sent), 2)
+        self.assertTrue('second' in self.sent[1].get_payload() and 'third' in self.sent[1].get_payload())
+        
+    def test_flush_timeout_restores_cooldown(self):
+        self.release.clear()
+        mail.send_alert('first')
+        self._wait_for_sending()
+        mail.send_alert('second')
+        mail.send_alert('third')
+        mail.flush(timeout=0.1)
+        self.assertFalse(mail._FLUSH_REQUESTED.is_set())
+        self.assertEqual(mail._unsent, 3)
+        
+        
+if __name__ == '__main__':
+    unittest.main()
+    
+    
\ No newline at end of file
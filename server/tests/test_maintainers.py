@@ -0,0 +1,177 @@
+"""
+Tests for the scheduling of policy maintainers in media_storage_server.maintainence, and for
+CompressionMaintainer's care not to undo changes made to records while it works.
+
+Run from the server directory with 'python -m unittest discover -s tests'.
+"""
+import os
+import threading
+import time
+import unittest
+
+from support import database, make_record, FilesystemTestCase
+from config import CONFIG
+import maintainence
+
+class _Scheduler(maintainence._PolicyMaintainer):
+    """
+    A policy maintainer whose records succeed or fail as `outcomes` dictates, by uid, and which is
+    driven a step at a time by the tests, rather than by `run()`.
+    """
+    def __init__(self, outcomes):
+        maintainence._PolicyMaintainer.__init__(self)
+        self.name = 'test-maintainer'
+        self._budget = maintainence._Budget(self.name)
+        self._fixed_field = 'policy.delete.fixed'
+        self._stale_query = 'policy.delete.staleTime'
+        self._sleep_period = 3600
+        self._concurrency = 2
+        self._dispatcher = maintainence._Dispatcher(self._concurrency, self._handle, self._wake.set, self._refresh)
+        self.outcomes = outcomes
+        self.processed = []
+        self.release = threading.Event()
+        self.release.set()
+        
+    def step(self, current_time, load=False):
+        """
+        Loads the schedule, if `load` is set, then dispatches everything due by `current_time`,
+        waiting for it to be handled.
+        """
+        if load:
+            self._load(current_time)
+        self._dispatch(current_time)
+        self._dispatcher.wait()
+        
+    def _process_record(self, record):
+        self.release.wait()
+        self.processed.append(record['_id'])
+        return self.outcomes.get(record['_id'], True)
+        
+        
+class SchedulerTest(unittest.TestCase):
+    def setUp(self):
+        database.reset()
+        self.now = time.time()
+        for uid in ('a', 'b'):
+            record = make_record(uid)
+            record['policy']['delete'] = {'fixed': int(self.now) - 10}
+            database.add_record(record)
+            
+    def test_failures_back_off(self):
+        scheduler = _Scheduler({'a': False})
+        scheduler.step(self.now, load=True)
+        self.assertEqual(sorted(scheduler.processed), ['a', 'b'])
+        self.assertEqual(scheduler._dispatcher.failed, 1)
+        
+        delay = CONFIG.maintainer_policy_retry_delay
+        retry_time = scheduler._retry_times['a']
+        self.assertTrue(self.now + delay <= retry_time <= time.time() + delay)
+        self.assertEqual(scheduler._scheduled, {'a': retry_time})
+        
+        scheduler.step(retry_time - 1, load=True) #A rescan mustn't bring it forward
+        self.assertEqual(scheduler._scheduled, {'a': retry_time})
+        self.assertEqual(scheduler.processed.count('a'), 1)
+        
+        scheduler.step(retry_time)
+        self.assertEqual(scheduler.processed.count('a'), 2)
+        self.assertEqual(scheduler._failures['a'], 2)
+        self.assertTrue(scheduler._retry_times['a'] >= time.time() + min(2 * delay, CONFIG.maintainer_policy_retry_max_delay) - 1)
+        
+        scheduler._failures['a'] = 20
+        scheduler.step(scheduler._retry_times['a'])
+        self.assertTrue(scheduler._retry_times['a'] <= time.time() + CONFIG.maintainer_policy_retry_max_delay)
+        
+        scheduler.outcomes['a'] = True
+        scheduler.step(scheduler._retry_times['a'])
+        self.assertEqual((scheduler._failures, scheduler._retry_times, scheduler._scheduled), ({}, {}, {}))
+        
+    def test_records_in_flight_are_not_repeated(self):
+        scheduler = _Scheduler({})
+        scheduler.release.clear()
+        scheduler._load(self.now)
+        scheduler._dispatch(self.now)
+        self.assertEqual(scheduler._in_flight, set(['a', 'b']))
+        
+        scheduler._load(self.now) #Still due, but already being handled
+        self.assertEqual(scheduler._heap, [])
+        with scheduler._lock:
+            scheduler._schedule('a', self.now)
+        self.assertEqual(scheduler._heap, [])
+        scheduler._dispatch(self.now)
+        self.assertEqual(scheduler._dispatcher.backlog, 2)
+        
+        scheduler.release.set()
+        scheduler._dispatcher.wait()
+        self.assertEqual(sorted(scheduler.processed), ['a', 'b'])
+        self.assertEqual(scheduler._in_flight, set())
+        
+    def test_superseded_entries_are_skipped(self):
+        scheduler = _Scheduler({})
+        scheduler._load(self.now)
+        with scheduler._lock:
+            scheduler._schedule('a', self.now - 100) #Brought forward; the old entry is stale
+        self.assertEqual(len(scheduler._heap), 3)
+        scheduler.step(self.now)
+        self.assertEqual(sorted(scheduler.processed), ['a', 'b'])
+        
+        
+        
+class CompressionTest(FilesystemTestCase, unittest.TestCase):
+    def setUp(self):
+        FilesystemTestCase.setUp(self)
+        self.compressor = maintainence.CompressionMaintainer()
+        self.content = 'compress me' * 10000
+        self.record = make_record('a', storedSize=len(self.content), size=len(self.content))
+        self.record['policy']['compress'] = {'comp': 'gz'}
+        self.store(self.record, self.content)
+        
+    def _interfere(self, changes):
+        """
+        Makes the next write to the filesystem apply `changes` to the record, as a concurrent
+        migration would.
+        """
+        put = self.fs.put
+        def interfering_put(record, data, tempfile=False):
+            put(record, data, tempfile=tempfile)
+            database.update_fields(record['_id'], changes)
+        self.fs.put = interfering_put
+        
+    def test_compression_is_recorded(self):
+        self.assertTrue(self.compressor._process_record(database.get_record('a')))
+        record = database.get_record('a')
+        self.assertEqual(record['physical']['format']['comp'], 'gz')
+        self.assertEqual(record['physical']['size'], len(self.content))
+        self.assertTrue(record['physical']['storedSize'] < len(self.content))
+        self.assertEqual(record['policy']['compress'], {})
+        self.assertEqual(os.path.getsize(self.stored_path(record)), record['physical']['storedSize'])
+        
+    def test_concurrent_change_backs_out(self):
+        self._interfere({'physical.family': 'elsewhere'})
+        self.compressor._process_record(database.get_record('a'))
+        record = database.get_record('a')
+        self.assertEqual(record['physical']['family'], 'elsewhere')
+        self.assertEqual(record['physical']['format']['comp'], None)
+        self.assertEqual(record['policy']['compress'], {'comp': 'gz'})
+        with open(self.stored_path(self.record), 'rb') as f:
+            self.assertEqual(f.read(), self.content)
+        self.assertFalse(os.path.exists(self.stored_path(self.record) + '.temp'))
+        
+    def test_skip_is_recorded(self):
+        self.compressor._skip(database.get_record('a'), 'gz', 0.01)
+        record = database.get_record('a')
+        self.assertEqual(record['policy']['compress'], {})
+        self.assertEqual(record['stats']['compressionSkipped']['comp'], 'gz')
+        
+    def test_skip_leaves_changed_record(self):
+        stale = database.get_record('a')
+        database.update_fields('a', {'physical.format.comp': 'bz2'})
+        self.compressor._skip(stale, 'gz', 0.01)
+        record = database.get_record('a')
+        self.assertEqual(record['policy']['compress'], {'comp': 'gz'})
+        self.assertFalse('compressionSkipped' in record['stats'])
+        
+        
+if __name__ == '__main__':
+    unittest.main()
+    
+    
\ No newline at end of file
@@ -0,0 +1,207 @@
+"""
+Tests for the segment-file backend provided by media_storage_server.backends.pack.
+
+Run from the server directory with 'python -m unittest discover -s tests'.
+"""
+import logging
+import os
+import shutil
+import StringIO
+import sys
+import tempfile
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'src', 'media_storage_server'))
+from backends import pack
+from backends.common import FileNotFoundError
+
+logging.getLogger('media_storage').addHandler(logging.NullHandler())
+
+class PackBackendTest(unittest.TestCase):
+    def setUp(self):
+        self._path = tempfile.mkdtemp()
+        
+    def tearDown(self):
+        shutil.rmtree(self._path)
+        
+    def _open(self, segment_size=None):
+        return pack.PackBackend(self._path, segment_size and ['segment_size=%(size)i' % {'size': segment_size,}] or [])
+        
+    def _put(self, backend, path, content, tempfile=False):
+        backend.put(path, StringIO.StringIO(content), tempfile)
+        
+    def _read(self, backend, path, cache=True):
+        data = backend.get(path, cache=cache)
+        try:
+            return data.read()
+        finally:
+            data.close()
+            
+    def _segments(self):
+        return sorted(name for name in os.listdir(self._path) if name.endswith('.seg'))
+        
+    def test_put_and_get(self):
+        backend = self._open()
+        self._put(backend, 'ab/cd/one', 'first')
+        self._put(backend, 'ab/cd/two', '')
+        self._put(backend, 'ab/ef/three', 'x' * 100000)
+        self.assertEqual(self._read(backend, 'ab/cd/one'), 'first')
+        self.assertEqual(self._read(backend, 'ab/cd/one', cache=False), 'first')
+        self.assertEqual(self._read(backend, 'ab/cd/two'), '')
+        self.assertEqual(self._read(backend, 'ab/ef/three'), 'x' * 100000)
+        self.assertEqual(backend.list_container('ab/cd/one'), set(['one', 'two']))
+        self.assertEqual([(container, sorted(names)) for (container, names) in backend.walk()], [('ab/cd', ['one', 'two']), ('ab/ef', ['three'])])
+        self.assertEqual([container for (container, names) in backend.walk('ab/cd')], ['ab/ef'])
+        self.assertTrue(backend.file_exists('ab/cd/one'))
+        self.assertFalse(backend.file_exists('ab/cd/four'))
+        self.assertRaises(FileNotFoundError, backend.get, 'ab/cd/four')
+        
+    def test_seek(self):
+        backend = self._open()
+        self._put(backend, 'a/b', '0123456789')
+        data = backend.get('a/b')
+        data.seek(4)
+        self.assertEqual(data.read(3), '456')
+        data.seek(-2, 2)
+        self.assertEqual(data.read(), '89')
+        self.assertEqual(data.tell(), 10)
+        
+    def test_overwrite(self):
+        backend = self._open()
+        self._put(backend, 'a/b', 'old')
+        self._put(backend, 'a/b', 'new')
+        self.assertEqual(self._read(backend, 'a/b'), 'new')
+        self.assertEqual(self._read(self._open(), 'a/b'), 'new')
+        
+    def test_make_permanent(self):
+        backend = self._open()
+        self._put(backend, 'a/b', 'content', tempfile=True)
+        self.assertRaises(FileNotFoundError, backend.get, 'a/b')
+        backend.make_permanent('a/b')
+        self.assertEqual(self._read(backend, 'a/b'), 'content')
+        self.assertEqual(backend.list_container('a/b'), set(['b']))
+        
+    def test_unlink(self):
+        backend = self._open()
+        self._put(backend, 'a/b', 'content')
+        self._put(backend, 'a/c', 'other')
+        backend.unlink('a/b')
+        self.assertRaises(FileNotFoundError, backend.get, 'a/b')
+        self.assertRaises(FileNotFoundError, backend.unlink, 'a/b')
+        self.assertEqual(backend.list_container('a/c'), set(['c']))
+        backend.unlink('a/c')
+        self.assertEqual(list(backend.walk()), [])
+        
+    def test_superseded_tombstones_are_dead(self):
+        backend = self._open()
+        self._put(backend, 'a/b', 'content')
+        backend.unlink('a/b')
+        self._put(backend, 'a/b', 'again')
+        ((size, live),) = backend._segments.values()
+        self.assertEqual(live, pack._ENTRY.size + len('a/b') + len('again'))
+        
+        backend.unlink('a/b')
+        self._put(backend, 'a/d', 'x')
+        backend.unlink('a/d')
+        ((size, live),) = backend._segments.values()
+        self.assertEqual(live, 2 * (pack._ENTRY.size + len('a/b')))
+        
+    def test_reload(self):
+        backend = self._open(segment_size=64)
+        for i in range(20):
+            self._put(backend, 'a/%(i)02i' % {'i': i,}, 'content %(i)i' % {'i': i,} * 5)
+        for i in range(0, 20, 3):
+            backend.unlink('a/%(i)02i' % {'i': i,})
+        self.assertTrue(len(self._segments()) > 1)
+        
+        reloaded = self._open(segment_size=64)
+        self.assertEqual(reloaded._segments, backend._segments)
+        for i in range(20):
+            path = 'a/%(i)02i' % {'i': i,}
+            if i % 3:
+                self.assertEqual(self._read(reloaded, path), 'content %(i)i' % {'i': i,} * 5)
+            else:
+                self.assertFalse(reloaded.file_exists(path))
+                
+        for name in os.listdir(self._path): #Without indexes, every segment is scanned
+            if name.endswith('.idx'):
+                os.unlink(os.path.join(self._path, name))
+        self.assertEqual(self._open(segment_size=64)._segments, backend._segments)
+        
+    def test_compact(self):
+        backend = self._open(segment_size=256)
+        content = dict(('a/%(i)03i' % {'i': i,}, 'content %(i)i' % {'i': i,} * 4) for i in range(60))
+        for path in sorted(content):
+            self._put(backend, path, content[path])
+        for path in sorted(content)[:50]:
+            backend.unlink(path)
+            del content[path]
+        self._put(backend, 'a/000', 'revived')
+        content['a/000'] = 'revived'
+        segments = len(self._segments())
+        
+        reclaimed = backend.compact(0.5)
+        self.assertTrue(reclaimed > 0)
+        self.assertTrue(len(self._segments()) < segments)
+        for backend in (backend, self._open(segment_size=256)):
+            self.assertEqual(sorted(name for (container, names) in backend.walk() for name in names), sorted(path.split('/')[1] for path in content))
+            for (path, data) in content.items():
+                self.assertEqual(self._read(backend, path), data)
+                
+    def test_compact_keeps_tombstones_for_older_segments(self):
+        backend = self._open(segment_size=64)
+        self._put(backend, 'a/old', 'x' * 100) #Alone in the oldest segment, which stays mostly live
+        self._put(backend, 'a/gone', 'y' * 100)
+        self._put(backend, 'a/filler', 'z' * 100)
+        backend.unlink('a/filler')
+        backend.unlink('a/gone')
+        backend.compact(0.0)
+        reloaded = self._open(segment_size=64)
+        self.assertFalse(reloaded.file_exists('a/gone'))
+        self.assertFalse(reloaded.file_exists('a/filler'))
+        self.assertEqual(self._read(reloaded, 'a/old'), 'x' * 100)
+        
+    def test_torn_tail(self):
+        backend = self._open()
+        self._put(backend, 'a/b', 'intact')
+        self._put(backend, 'a/c', 'torn' * 100)
+        backend._active_file.close()
+        (segment,) = self._segments()
+        path = os.path.join(self._path, segment)
+        with open(path, 'r+b') as f:
+            f.truncate(os.path.getsize(path) - 10)
+        intact_size = pack._ENTRY.size + len('a/b') + len('intact')
+        
+        reloaded = self._open()
+        self.assertEqual(self._read(reloaded, 'a/b'), 'intact')
+        self.assertFalse(reloaded.file_exists('a/c'))
+        self.assertEqual(os.path.getsize(path), intact_size)
+        self._put(reloaded, 'a/c', 'rewritten')
+        self.assertEqual(self._read(self._open(), 'a/c'), 'rewritten')
+        
+    def test_corrupt_tail(self):
+        backend = self._open()
+        self._put(backend, 'a/b', 'intact')
+        self._put(backend, 'a/c', 'corrupt')
+        backend._active_file.close()
+        (segment,) = self._segments()
+        with open(os.path.join(self._path, segment), 'r+b') as f:
+            f.seek(-1, 2)
+            f.write('!')
+        reloaded = self._open()
+        self.assertEqual(self._read(reloaded, 'a/b'), 'intact')
+        self.assertFalse(reloaded.file_exists('a/c'))
+        
+    def test_usage_is_physical(self):
+        backend = self._open()
+        self._put(backend, 'a/b', 'x' * 100000)
+        backend.unlink('a/b')
+        stats = os.statvfs(self._path)
+        (used, total) = backend.get_usage()
+        self.assertEqual(total, stats.f_blocks * stats.f_frsize)
+        self.assertTrue(used > 0)
+        
+        
+if __name__ == '__main__':
+    unittest.main()
+    
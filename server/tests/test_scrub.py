@@ -0,0 +1,69 @@
+"""
+Tests for the verification of stored files by media_storage_server.maintainence.ScrubMaintainer.
+
+Run from the server directory with 'python -m unittest discover -s tests'.
+"""
+import hashlib
+import unittest
+
+from support import database, make_record, FilesystemTestCase
+import maintainence
+
+class ScrubTest(FilesystemTestCase, unittest.TestCase):
+    def setUp(self):
+        FilesystemTestCase.setUp(self)
+        self.scrubber = maintainence.ScrubMaintainer()
+        
+    def _corrupt(self, record):
+        with open(self.stored_path(record), 'r+b') as f:
+            f.seek(3)
+            byte = f.read(1)
+            f.seek(3)
+            f.write(chr(ord(byte) ^ 0xff))
+            
+    def test_intact_file_passes(self):
+        content = 'scrub me' * 1000
+        record = make_record('a', storedSize=len(content), storedHash=hashlib.sha1(content).hexdigest())
+        self.store(record, content)
+        self.assertEqual(self.scrubber._scrub(record), None)
+        
+    def test_corruption_is_flagged(self):
+        content = 'scrub me' * 1000
+        record = make_record('a', storedSize=len(content), storedHash=hashlib.sha1(content).hexdigest())
+        self.store(record, content)
+        self._corrupt(record)
+        problem = self.scrubber._scrub(record)
+        self.assertTrue(problem and 'SHA-1' in problem)
+        
+    def test_truncation_is_flagged(self):
+        content = 'scrub me' * 1000
+        record = make_record('a', storedSize=len(content))
+        self.store(record, content)
+        with open(self.stored_path(record), 'r+b') as f:
+            f.truncate(100)
+        self.assertTrue('bytes are stored' in self.scrubber._scrub(record))
+        
+    def test_first_scrub_records_the_hash(self):
+        content = 'fingerprint me' * 1000
+        record = make_record('a', storedSize=len(content))
+        self.store(record, content)
+        self.assertEqual(self.scrubber._scrub(record), None)
+        stored = database.get_record('a')
+        self.assertEqual(stored['physical']['storedHash'], hashlib.sha1(content).hexdigest())
+        
+        self._corrupt(stored) #Now that it's fingerprinted, damage of any kind is caught
+        problem = self.scrubber._scrub(stored)
+        self.assertTrue(problem and 'SHA-1' in problem)
+        
+    def test_hash_not_recorded_over_a_changed_record(self):
+        content = 'fingerprint me' * 1000
+        record = make_record('a', storedSize=len(content))
+        self.store(record, content)
+        database.update_fields('a', {'physical.format.comp': 'gz'}) #As by a concurrent compression
+        self.scrubber._scrub(record)
+        self.assertFalse('storedHash' in database.get_record('a')['physical'])
+        
+        
+if __name__ == '__main__':
+    unittest.main()
+    
@@ -0,0 +1,165 @@
+"""
+Tests for media_storage_server.workers' bounded compression pool, and the webservice's use of it.
+
+Run from the server directory with 'python -m unittest discover -s tests'.
+"""
+import json
+import os
+import tempfile
+import threading
+import time
+import unittest
+import urllib
+import zlib
+
+from support import database, FilesystemTestCase
+import workers
+
+try:
+    import tornado.ioloop
+    import tornado.testing
+    import tornado.web
+    import http
+except ImportError:
+    http = None
+    
+def _wait_for_idle(timeout=10.0):
+    """
+    Waits until no compression jobs are pending, failing if that takes longer than `timeout`.
+    """
+    for i in range(int(timeout * 100)):
+        if not workers.get_stats()['pending']:
+            return
+        time.sleep(0.01)
+    raise AssertionError("compression jobs are still pending")
+    
+    
+class _PoolTestCase(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        workers.start(1, 1)
+        
+    @classmethod
+    def tearDownClass(cls):
+        workers.stop()
+        
+    def setUp(self):
+        (descriptor, self.source) = tempfile.mkstemp()
+        with os.fdopen(descriptor, 'wb') as f:
+            f.write('compress me' * 1000)
+            
+    def tearDown(self):
+        if os.path.exists(self.source):
+            os.unlink(self.source)
+            
+            
+class PoolTest(_PoolTestCase):
+    def test_result_is_delivered(self):
+        results = []
+        workers.compress('gz', {}, self.source, lambda *result: results.append(result))
+        _wait_for_idle()
+        ((path, error),) = results
+        self.assertEqual(error, None)
+        try:
+            with open(path, 'rb') as f:
+                self.assertEqual(zlib.decompress(f.read()), 'compress me' * 1000)
+        finally:
+            os.unlink(path)
+            
+    def test_failure_is_delivered(self):
+        results = []
+        workers.compress('gz', {}, self.source + '.missing', lambda *result: results.append(result))
+        _wait_for_idle()
+        ((path, error),) = results
+        self.assertEqual(path, None)
+        self.assertTrue('IOError' in error)
+        
+    def test_saturation(self):
+        release = threading.Event()
+        results = []
+        def _blocked(*result):
+            release.wait()
+            results.append(result)
+        workers.compress('gz', {}, self.source, _blocked)
+        try:
+            self.assertRaises(workers.SaturatedError, workers.compress, 'gz', {}, self.source, _blocked)
+        finally:
+            release.set()
+        _wait_for_idle()
+        self.assertEqual(len(results), 1)
+        os.unlink(results[0][0])
+        
+    def test_failing_callback_frees_its_slot(self):
+        def _failing(path, error):
+            os.unlink(path)
+            raise ValueError("callback failed")
+        workers.compress('gz', {}, self.source, _failing)
+        _wait_for_idle()
+        
+        results = []
+        workers.compress('gz', {}, self.source, lambda *result: results.append(result))
+        _wait_for_idle()
+        self.assertEqual(len(results), 1)
+        os.unlink(results[0][0])
+        
+        
+@unittest.skipUnless(http, "tornado is not available")
+class PutTest(FilesystemTestCase, _PoolTestCase, tornado.testing.AsyncHTTPTestCase if http else unittest.TestCase):
+    def setUp(self):
+        FilesystemTestCase.setUp(self)
+        _PoolTestCase.setUp(self)
+        tornado.testing.AsyncHTTPTestCase.setUp(self)
+        
+    def tearDown(self):
+        tornado.testing.AsyncHTTPTestCase.tearDown(self)
+        _PoolTestCase.tearDown(self)
+        FilesystemTestCase.tearDown(self)
+        
+    def get_new_ioloop(self):
+        return tornado.ioloop.IOLoop.instance() #Deferred responses are completed on it
+        
+    def get_app(self):
+        return tornado.web.Application([('/put', http.PutHandler)])
+        
+    def _put(self):
+        return self.fetch('/put', method='POST', headers={'Media-Storage-Compress-On-Server': 'yes'}, body=urllib.urlencode({
+         'nginx': 'yes',
+         'content': self.source,
+         'header': json.dumps({'physical': {'format': {'mime': 'text/plain', 'comp': 'gz'}}}),
+        }))
+        
+    def test_compressed_on_server(self):
+        response = self._put()
+        self.assertEqual(response.code, 200)
+        record = database.get_record(json.loads(response.body)['uid'])
+        self.assertEqual(record['physical']['size'], len('compress me' * 1000))
+        with open(self.stored_path(record), 'rb') as f:
+            self.assertEqual(zlib.decompress(f.read()), 'compress me' * 1000)
+        self.assertFalse(os.path.exists(self.source))
+        self.assertEqual(workers.get_stats()['pending'], 0)
+        
+    def test_saturated(self):
+        release = threading.Event()
+        def _blocked(path, error):
+            release.wait()
+            os.unlink(path)
+        (descriptor, source) = tempfile.mkstemp()
+        os.close(descriptor)
+        workers.compress('gz', {}, source, _blocked)
+        try:
+            with tornado.testing.ExpectLog('media_storage.http', 'Unable to queue'):
+                with tornado.testing.ExpectLog('tornado.access', '503'):
+                    response = self._put()
+        finally:
+            release.set()
+            _wait_for_idle()
+            os.unlink(source)
+        self.assertEqual(response.code, 503)
+        self.assertFalse(os.path.exists(self.source))
+        self.assertEqual(database.records, {})
+        
+        
+if __name__ == '__main__':
+    unittest.main()
+    
+    
\ No newline at end of file
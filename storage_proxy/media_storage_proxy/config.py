@@ -188,6 +188,10 @@ class _Settings(_Config):
     def email_alert_cooldown(self):
         return self.getfloat('email', 'alert_cooldown', 300.0)
         
+    @property
+    def email_alert_queue_size(self):
+        return self.getint('email', 'alert_queue_size', 100)
+        
     @property    
     def email_alert_subject(self):
         return self.get('email', 'alert_subject', 'Critical failure')
@@ -4,8 +4,9 @@ media-storage : mail
 
 Offers e-mail handling for important alerts.
 
-This module is shared by every server facet of the media-storage project and
-changes to one instance should be reflected in all.
+This module is shared by every server facet of the media-storage project; the
+server's copy is canonical, and the others are regenerated from it with
+tools/sync_shared.py, which also reports copies that have drifted.
  
 Legal
 -----
@@ -26,15 +27,26 @@ along with this program. If not, see <http://www.gnu.org/licenses/>.
  
 (C) Neil Tallim, 2011
 """
+import collections
 import logging
 from email.mime.text import MIMEText
+import Queue
 import smtplib
+import threading
 import time
 
 from config import CONFIG
 
 _logger = logging.getLogger('media_storage-mail')
 
+_ALERT_QUEUE = Queue.Queue(CONFIG.email_alert_queue_size) #Alerts waiting to be aggregated and sent
+_FLUSH_REQUESTED = threading.Event() #Set while a flush is waiting, so that alerts are sent regardless of cooldown
+_unsent = 0 #The number of alerts accepted but not yet sent
+_unsent_condition = threading.Condition() #Guards `_unsent`, notified whenever alerts are sent
+
+_dispatcher = None #The thread that delivers alerts, created on first use
+_dispatcher_lock = threading.Lock()
+
 def _send_message(message):
     """
     Sends the given message to the configured SMTP host.
@@ -68,22 +80,167 @@ def _send_message(message):
         except Exception:
             pass
             
-_ALERT_COOLDOWN = 0.0
-def send_alert(message):
+class _AlertDispatcher(threading.Thread):
     """
-    If alerts are enabled and the alert cooldown period has elapsed, constructs and sends an alert
-    e-mail to the configured recipient, using the configured SMTP server.
+    Drains the alert queue, collapsing repeated messages, and sends one digest e-mail per cooldown
+    period, so that callers never wait on SMTP.
     """
-    global _ALERT_COOLDOWN
-    if not CONFIG.email_alert or time.time() < _ALERT_COOLDOWN:
-        return
-    _ALERT_COOLDOWN = time.time() + CONFIG.email_alert_cooldown
-    _logger.warn('Sending alert e-mail...')
-    
-    msg = MIMEText(message)
-    msg['Subject'] = CONFIG.email_alert_subject
+    def __init__(self):
+        threading.Thread.__init__(self)
+        self.daemon = True
+        self.name = 'alert-dispatcher'
+        
+    def run(self):
+        """
+        Aggregates alerts as they arrive, sending whatever has accumulated as soon as the cooldown
+        period allows it.
+        """
+        pending = collections.OrderedDict() #message: [count, first-seen, last-seen]
+        next_send = 0.0
+        while True:
+            if pending:
+                if _FLUSH_REQUESTED.is_set():
+                    timeout = 0.0
+                else:
+                    timeout = max(0.0, next_send - time.time())
+            else:
+                timeout = None
+                
+            try:
+                self._collect(pending, _ALERT_QUEUE.get(True, timeout))
+            except Queue.Empty:
+                pass
+            if not pending or (time.time() < next_send and not _FLUSH_REQUESTED.is_set()):
+                continue
+                
+            #Collect only what's already waiting, so that a steady stream of alerts can't defer
+            #the digest indefinitely
+            for i in xrange(_ALERT_QUEUE.qsize()):
+                try:
+                    self._collect(pending, _ALERT_QUEUE.get_nowait())
+                except Queue.Empty:
+                    break
+                    
+            total = sum(count for (count, first, last) in pending.itervalues())
+            try:
+                _send_message(_build_digest(pending))
+            except Exception as e:
+                _logger.error('Unable to assemble alert digest: %(error)s' % {
+                 'error': str(e),
+                })
+            pending.clear()
+            next_send = time.time() + CONFIG.email_alert_cooldown
+            _mark_sent(total)
+            
+    def _collect(self, pending, alert):
+        """
+        Adds `alert` to `pending`, collapsing it into an identical message if one is already there.
+        """
+        if alert: #None is used only to wake the thread
+            (timestamp, message) = alert
+            entry = pending.get(message)
+            if entry:
+                entry[0] += 1
+                entry[2] = timestamp
+            else:
+                pending[message] = [1, timestamp, timestamp]
+                
+def _mark_sent(count):
+    """
+    Notes that `count` alerts have been sent, or discarded, waking anything waiting on a flush.
+    """
+    global _unsent
+    with _unsent_condition:
+        _unsent -= count
+        _unsent_condition.notify_all()
+        
+def _build_digest(pending):
+    """
+    Renders the aggregated alerts in `pending` as a single e-mail message.
+    """
+    total = sum(count for (count, first, last) in pending.itervalues())
+    if total == 1:
+        body = pending.keys()[0]
+        subject = CONFIG.email_alert_subject
+    else:
+        sections = []
+        for (message, (count, first, last)) in pending.iteritems():
+            sections.append('=== %(count)i occurrence(s); first at %(first)s, last at %(last)s ===\n%(message)s' % {
+             'count': count,
+             'first': time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(first)),
+             'last': time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(last)),
+             'message': message,
+            })
+        body = '%(total)i alerts raised (%(distinct)i distinct); details follow:\n\n' % {
+         'total': total,
+         'distinct': len(pending),
+        } + '\n\n'.join(sections)
+        subject = '%(subject)s (%(total)i alerts)' % {
+         'subject': CONFIG.email_alert_subject,
+         'total': total,
+        }
+        
+    _logger.warn('Sending alert e-mail covering %(total)i alert(s)...' % {
+     'total': total,
+    })
+    msg = MIMEText(body)
+    msg['Subject'] = subject
     msg['From'] = CONFIG.email_alert_from
     msg['To'] = CONFIG.email_alert_to
+    return msg
     
-    _send_message(msg)
+def _get_dispatcher():
+    """
+    Starts the dispatcher thread, if it isn't already running, and returns it.
+    """
+    global _dispatcher
+    with _dispatcher_lock:
+        if not _dispatcher:
+            _dispatcher = _AlertDispatcher()
+            _dispatcher.start()
+        return _dispatcher
+        
+def send_alert(message):
+    """
+    If alerts are enabled, queues `message` for delivery to the configured recipient, using the
+    configured SMTP server.
     
+    This never blocks: alerts are aggregated by a background thread and sent as a digest once per
+    cooldown period. If the queue is full, the alert is logged and discarded.
+    """
+    if not CONFIG.email_alert:
+        return
+    global _unsent
+    _get_dispatcher()
+    with _unsent_condition: #Counted first, so that a flush can't miss it while it's queued
+        _unsent += 1
+    try:
+        _ALERT_QUEUE.put_nowait((time.time(), message))
+    except Queue.Full:
+        _logger.error('Alert queue full; discarding alert')
+        _mark_sent(1)
+        
+def flush(timeout=5.0):
+    """
+    Sends any pending alerts immediately, ignoring the cooldown period, waiting up to `timeout`
+    seconds for delivery to complete, including that of alerts still queued; this should be called
+    before shutting down.
+    """
+    if not CONFIG.email_alert or not _dispatcher:
+        return
+    deadline = time.time() + timeout
+    _FLUSH_REQUESTED.set()
+    try:
+        try:
+            _ALERT_QUEUE.put_nowait(None)
+        except Queue.Full: #The dispatcher will wake for the alerts already queued
+            pass
+        with _unsent_condition:
+            while _unsent > 0 and time.time() < deadline:
+                _unsent_condition.wait(deadline - time.time())
+    finally:
+        _FLUSH_REQUESTED.clear()
+    if _unsent > 0:
+        _logger.warn('%(count)i alert(s) could not be sent before shutdown' % {
+         'count': _unsent,
+        })
@@ -0,0 +1,59 @@
+#!/usr/bin/env python
+"""
+Regenerates the modules that are shared between the media-storage facets from
+their canonical copies, in the server, since each facet is deployed on its own
+and can't import them from the others.
+
+Usage: sync_shared.py [--check]
+
+With --check, nothing is written; copies that differ from their canonical
+modules are listed and the exit status is 1.
+"""
+__author__ = 'Neil Tallim'
+
+import os
+import shutil
+import sys
+
+_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+#canonical-path: [copy-path, ...], relative to the root of the project
+_SHARED = {
+ 'server/src/media_storage_server/compression.py': [
+  'clients/python/media_storage/compression.py',
+ ],
+ 'server/src/media_storage_server/mail.py': [
+  'caching_proxy/media_storage_proxy/mail.py',
+  'storage_proxy/media_storage_proxy/mail.py',
+ ],
+}
+
+def _read(path):
+    with open(os.path.join(_ROOT, path), 'rb') as f:
+        return f.read()
+        
+def main(check):
+    drifted = []
+    for (canonical, copies) in sorted(_SHARED.items()):
+        content = _read(canonical)
+        for copy in copies:
+            if _read(copy) == content:
+                continue
+            drifted.append(copy)
+            if not check:
+                shutil.copyfile(os.path.join(_ROOT, canonical), os.path.join(_ROOT, copy))
+                print("Regenerated %(copy)s from %(canonical)s" % {
+                 'copy': copy,
+                 'canonical': canonical,
+                })
+    if check and drifted:
+        for copy in drifted:
+            print("%(copy)s differs from its canonical module" % {
+             'copy': copy,
+            })
+        return 1
+    return 0
+    
+if __name__ == '__main__':
+    sys.exit(main('--check' in sys.argv[1:]))
+    